@@ -0,0 +1,98 @@
+###############################################################################
+#   volumina: volume slicing and editing library
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+#		   http://ilastik.org/license/
+###############################################################################
+import unittest as ut
+import time
+import numpy
+
+from PyQt4.QtGui import QColor, QImage
+from qimage2ndarray import byte_view
+
+from volumina.colortables import create_random_16bit
+from volumina.pixelpipeline.compiledColortable import CompiledColortable, compileColortable
+
+def _bgra(colorTable):
+    colors = numpy.zeros((len(colorTable), 4), dtype=numpy.uint8)
+    for i, c in enumerate(colorTable):
+        color = QColor.fromRgba(c)
+        colors[i] = (color.blue(), color.green(), color.red(), color.alpha())
+    return colors
+
+class CompiledColortableTest( ut.TestCase ):
+    def setUp( self ):
+        self.colorTable = [QColor(255, 0, 0).rgba(), QColor(0, 128, 0, 10).rgba(), QColor(1, 2, 3, 0).rgba()]
+
+    def testCompile( self ):
+        compiled = compileColortable(self.colorTable)
+        self.assertEqual( compiled.colors.tolist(), _bgra(self.colorTable).tolist() )
+        self.assertEqual( len(compiled), 3 )
+        self.assertFalse( compiled.colors.flags.writeable )
+        # QColors are accepted as well
+        self.assertTrue( compileColortable([QColor.fromRgba(c) for c in self.colorTable]) is compiled )
+        mixed = [QColor.fromRgba(self.colorTable[0])] + self.colorTable[1:]
+        self.assertTrue( compileColortable(mixed) is compiled )
+        # ... and arrays of (signed or unsigned) QRgb values
+        self.assertTrue( compileColortable(numpy.array(self.colorTable, dtype=numpy.uint32)) is compiled )
+        self.assertTrue( compileColortable(numpy.array(self.colorTable, dtype=numpy.uint32).view(numpy.int32)) is compiled )
+
+    def testShared( self ):
+        compiled = compileColortable(self.colorTable)
+        self.assertTrue( compileColortable(list(self.colorTable)) is compiled )
+        self.assertTrue( compileColortable(compiled) is compiled )
+        other = compileColortable(self.colorTable[:2])
+        self.assertNotEqual( compiled, other )
+        self.assertEqual( compiled, CompiledColortable(compiled.colors) )
+        self.assertEqual( hash(compiled), hash(CompiledColortable(compiled.colors)) )
+
+    def testApply( self ):
+        compiled = compileColortable(self.colorTable)
+        expected_colors = _bgra(self.colorTable)
+        for dtype in (numpy.uint8, numpy.uint16, numpy.int16, numpy.uint32, numpy.int64):
+            a = numpy.array([[0, 1, 2, 3], [4, 5, 255, 100]], dtype=dtype)
+            img = QImage(4, 2, QImage.Format_ARGB32)
+            compiled.apply(a, byte_view(img))
+            # Values are taken modulo the length of the table
+            self.assertTrue( (byte_view(img) == expected_colors[a % 3]).all(), dtype )
+
+    def testVariants( self ):
+        compiled = compileColortable(self.colorTable)
+        zero = compiled.withTransparentZero()
+        self.assertEqual( zero.colors[0].tolist(), [0, 0, 0, 0] )
+        self.assertEqual( zero.colors[1:].tolist(), compiled.colors[1:].tolist() )
+        inserted = compiled.withTransparentInserted()
+        self.assertEqual( len(inserted), 4 )
+        self.assertEqual( inserted.colors[1:].tolist(), compiled.colors.tolist() )
+        self.assertTrue( compiled.withTransparentZero() is zero )
+        # The original table is unchanged
+        self.assertEqual( compiled.colors.tolist(), _bgra(self.colorTable).tolist() )
+
+    def testCompile16bit( self ):
+        colorTable = create_random_16bit()
+        start = time.time()
+        compiled = compileColortable(colorTable)
+        t = time.time() - start
+        print "\ncompiling a 65536 entry colortable: %.2f msec" % (1000*t)
+        self.assertEqual( compiled.colors[:300].tolist(), _bgra(colorTable[:300]).tolist() )
+        self.assertTrue( compileColortable(create_random_16bit()) is compiled )
+
+
+if __name__=='__main__':
+    ut.main()
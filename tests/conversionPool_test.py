@@ -0,0 +1,140 @@
+###############################################################################
+#   volumina: volume slicing and editing library
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+#		   http://ilastik.org/license/
+###############################################################################
+import unittest as ut
+import numpy
+
+from PyQt4.QtGui import QImage
+from qimage2ndarray import byte_view
+
+from volumina.config import cfg
+from volumina.pixelpipeline import numpyKernels
+from volumina.pixelpipeline.compiledColortable import CompiledColortable
+from volumina.pixelpipeline import conversionPool as conversionPoolModule
+from volumina.pixelpipeline.conversionPool import ConversionPool, conversionPool, startConversionPool
+
+def _reference(shape, convert, format=QImage.Format_ARGB32_Premultiplied):
+    img = QImage(shape[1], shape[0], format)
+    convert(byte_view(img))
+    return byte_view(img)
+
+
+class ConversionPoolTest( ut.TestCase ):
+    @classmethod
+    def setUpClass( cls ):
+        cls.pool = ConversionPool(2, 2**16, table_bytes=1024)
+
+    @classmethod
+    def tearDownClass( cls ):
+        cls.pool.shutdown()
+
+    def setUp( self ):
+        numpy.random.seed(0)
+
+    def testGray( self ):
+        for dtype in (numpy.uint8, numpy.uint16, numpy.float32):
+            a = (numpy.random.random((30, 50)) * 200).astype(dtype)
+            n = numpy.asarray([10, 150], dtype=numpy.float32)
+            img = self.pool.convert('gray', [a], a.shape, (n,))
+            expected = _reference(a.shape, lambda out: numpyKernels.gray2qimage_ARGB32Premultiplied(a, out, n))
+            self.assertTrue( numpy.all(byte_view(img) == expected) )
+
+    def testAlphaModulated( self ):
+        a = (numpy.random.random((30, 50)) * 255).astype(numpy.float32)
+        tintColor = numpy.asarray([1.0, 0.5, 0.0], dtype=numpy.float32)
+        n = numpy.asarray([0, 255], dtype=numpy.float32)
+        img = self.pool.convert('alphamodulated', [a[:, ::2]], (30, 25), (tintColor, n))
+        expected = _reference((30, 25), lambda out: numpyKernels.alphamodulated2qimage_ARGB32Premultiplied(a[:, ::2], out, tintColor, n))
+        self.assertTrue( numpy.all(byte_view(img) == expected) )
+
+    def testColortable( self ):
+        a = (numpy.random.random((30, 50)) * 100).astype(numpy.uint32)
+        colortables = [ CompiledColortable((numpy.random.random((17, 4)) * 255).astype(numpy.uint8))
+                        for _ in range(20) ]
+        # More colortables than fit into the shared memory at the same time
+        for colortable in colortables + colortables[:2]:
+            img = self.pool.applyColortable(a, colortable)
+            self.assertEqual( img.format(), QImage.Format_ARGB32 )
+            expected = _reference(a.shape, lambda out: colortable.apply(a, out), QImage.Format_ARGB32)
+            self.assertTrue( numpy.all(byte_view(img) == expected) )
+
+        # Registered once
+        colortable = colortables[-1]
+        table = self.pool._tables[colortable]
+        self.pool.applyColortable(a, colortable)
+        self.assertEqual( self.pool._tables[colortable], table )
+
+        # Too large for the shared memory
+        self.assertTrue( self.pool.applyColortable(a, CompiledColortable(numpy.zeros((1000, 4), numpy.uint8))) is None )
+
+    def testRGBA( self ):
+        channels = [ (numpy.random.random((30, 50)) * 255).astype(numpy.uint8), 7,
+                     numpy.random.random((30, 50)).astype(numpy.float32), 255 ]
+        normalize = [None, None, (0.0, 1.0), None]
+        img = self.pool.convert('rgba', channels, (30, 50), (normalize,))
+        expected = _reference((30, 50), lambda out: numpyKernels.rgba2qimage_ARGB32Premultiplied(channels, out, normalize))
+        self.assertTrue( numpy.all(byte_view(img) == expected) )
+
+    def testTooLarge( self ):
+        a = numpy.zeros((200, 200), dtype=numpy.uint8)
+        self.assertTrue( self.pool.convert('gray', [a], a.shape, ((0, 255),)) is None )
+
+    def testDisabled( self ):
+        processes = cfg.get('pixelpipeline', 'conversion_processes')
+        layers = cfg.get('pixelpipeline', 'conversion_layers')
+        try:
+            cfg.set('pixelpipeline', 'conversion_processes', '0')
+            self.assertTrue( startConversionPool() is None )
+            self.assertTrue( conversionPool('grayscale') is None )
+
+            # Only the started pool is used
+            cfg.set('pixelpipeline', 'conversion_processes', '2')
+            self.assertTrue( conversionPool('grayscale') is None )
+            conversionPoolModule._conversionPool = self.pool
+            cfg.set('pixelpipeline', 'conversion_layers', 'rgba')
+            self.assertTrue( conversionPool('grayscale') is None )
+            self.assertTrue( conversionPool('rgba') is self.pool )
+        finally:
+            conversionPoolModule._conversionPool = None
+            cfg.set('pixelpipeline', 'conversion_processes', processes)
+            cfg.set('pixelpipeline', 'conversion_layers', layers)
+
+    def testStartOnce( self ):
+        processes = cfg.get('pixelpipeline', 'conversion_processes')
+        try:
+            cfg.set('pixelpipeline', 'conversion_processes', '1')
+            pool = startConversionPool()
+            self.assertTrue( pool is not None )
+            self.assertTrue( startConversionPool() is pool )
+            self.assertTrue( conversionPool('grayscale') is pool )
+            a = numpy.arange(20, dtype=numpy.uint8).reshape(4, 5)
+            img = pool.convert('gray', [a], a.shape, ((0, 255),))
+            self.assertTrue( numpy.all(byte_view(img)[:,:,0] == a) )
+        finally:
+            if conversionPoolModule._conversionPool is not None:
+                conversionPoolModule._conversionPool.shutdown()
+            conversionPoolModule._conversionPool = None
+            cfg.set('pixelpipeline', 'conversion_processes', processes)
+
+
+
+if __name__=='__main__':
+    ut.main()
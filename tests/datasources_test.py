@@ -21,9 +21,14 @@
 ###############################################################################
 import unittest as ut
 import os
+import time
+import threading
+from concurrent.futures import CancelledError
 from abc import ABCMeta, abstractmethod
 import volumina._testing
-from volumina.pixelpipeline.datasources import ArraySource, RelabelingArraySource
+from volumina.pixelpipeline.datasources import ArraySource, ArrayRequest, RelabelingArraySource, ConstantSource, \
+                                               HaloAdjustedDataSource, DownsampledDataSource, \
+                                               BlockCachedDataSource, MinMaxSource, HistogramSketch
 import numpy as np
 from volumina.slicingtools import sl, slicing2shape
 try:
@@ -70,6 +75,93 @@ class GenericArraySourceTest:
         assert self.samesource == self.source
         assert self.othersource != self.source
 
+class _SlowArray( object ):
+    """
+    An array-like object (e.g. a dataset on disk), whose reads block until released.
+    """
+    def __init__( self, array ):
+        self.array = array
+        self.release = threading.Event()
+        self.threads = []
+
+    def __getitem__( self, slicing ):
+        self.release.wait()
+        self.threads.append( threading.current_thread() )
+        return self.array[slicing]
+
+class ArrayRequestTest( ut.TestCase ):
+    def setUp( self ):
+        self.raw = np.arange(100).reshape((1,10,10,1,1))
+        self.slicing = sl[0:1, 2:5, 3:9, 0:1, 0:1]
+
+    def testSubmit( self ):
+        array = _SlowArray(self.raw)
+        req = ArrayRequest(array, self.slicing).submit()
+        finished = []
+        req.notify_finished( finished.append )
+        self.assertEqual( finished, [] )
+        while not req._future.running():
+            time.sleep(0.001)
+        array.release.set()
+        result = req.wait()
+        self.assertTrue( np.all(result == self.raw[self.slicing]) )
+        self.assertEqual( len(finished), 1 )
+        self.assertTrue( finished[0] is result )
+        # Read once, in the background
+        self.assertEqual( len(array.threads), 1 )
+        self.assertNotEqual( array.threads[0], threading.current_thread() )
+
+        # Callbacks of finished requests are called immediately
+        req.notify_finished( finished.append )
+        self.assertEqual( len(finished), 2 )
+
+    def testCancel( self ):
+        array = _SlowArray(self.raw)
+        # Occupy all I/O threads, so that the request is still queued when it is cancelled
+        blockers = [ ArrayRequest(array, self.slicing).submit() for _ in range(10) ]
+        req = ArrayRequest(array, self.slicing).submit()
+        req.cancel()
+        array.release.set()
+        for blocker in blockers:
+            blocker.wait()
+        # Cancelled requests are not read at all
+        self.assertRaises( CancelledError, req.wait )
+        self.assertEqual( len(array.threads), len(blockers) )
+        # Unless they are already read
+        req = ArrayRequest(array, self.slicing)
+        req.wait()
+        req.cancel()
+        self.assertTrue( np.all(req.wait() == self.raw[self.slicing]) )
+
+    def testWaitReadsQueuedRequest( self ):
+        array = _SlowArray(self.raw)
+        blockers = [ ArrayRequest(array, self.slicing).submit() for _ in range(10) ]
+        req = ArrayRequest(array, self.slicing).submit()
+        # The waiting thread doesn't wait for a free I/O thread
+        threading.Timer(0.2, array.release.set).start()
+        self.assertTrue( np.all(req.wait() == self.raw[self.slicing]) )
+        self.assertTrue( req._future.cancelled() )
+        self.assertIn( threading.current_thread(), array.threads )
+        for blocker in blockers:
+            blocker.wait()
+
+    def testFailure( self ):
+        class BrokenArray( object ):
+            def __getitem__( self, slicing ):
+                raise IOError("broken")
+        req = ArrayRequest(BrokenArray(), self.slicing)
+        failed = []
+        req.notify_failed( failed.append )
+        req.submit()
+        self.assertRaises( IOError, req.wait )
+        self.assertTrue( isinstance(failed[0], IOError) )
+
+    def testInMemory( self ):
+        # Regions of in-memory arrays are views, which are not read in the background.
+        req = ArrayRequest(self.raw, self.slicing).submit()
+        self.assertTrue( req._future is None )
+        self.assertTrue( np.all(req.wait() == self.raw[self.slicing]) )
+
 class ArraySourceTest( ut.TestCase, GenericArraySourceTest ):
     def setUp( self ):
         GenericArraySourceTest.setUp(self)
@@ -119,5 +211,272 @@ class RelabelingArraySourceTest( ut.TestCase, GenericArraySourceTest ):
         del self.signal_emitted
         del self.slicing
 
+    def testSetRelabelingEntryDirtiesLabel( self ):
+        for start in range(0, 5, 2):
+            self.source.request((slice(start, start+2),) + 4*(slice(None),)).wait()
+        dirty = []
+        self.source.isDirty.connect(dirty.append)
+        self.source.setRelabelingEntry(2, 7, setDirty=False)
+        self.source.setRelabelingEntry(3, 7)
+        # Only the fetched region that contains the labels
+        self.assertEqual( dirty, [(slice(2,4),) + 4*(slice(None),)] )
+        self.assertTrue(np.all(self.source.request(5*(slice(None),)).wait().flatten() == [1,2,7,7,5]))
+
+        # Unchanged entries are not dirty
+        self.source.setRelabelingEntry(3, 7)
+        self.assertEqual( len(dirty), 1 )
+
+class SparseRelabelingArraySourceTest( ut.TestCase ):
+    def setUp( self ):
+        # 64-bit supervoxel ids
+        self.a = np.zeros((1,4,4,1,1), dtype=np.uint64)
+        self.a[0,:,:,0,0] = [[10**9, 10**9, 5, 5], [5, 2**40, 0, 0], [0, 0, 0, 0], [0, 0, 7, 0]]
+        self.source = RelabelingArraySource(self.a)
+        self.source.setRelabeling({10**9: 1, 5: 2})
+        self.slicing = 5*(slice(None),)
+
+    def testRequestWait( self ):
+        req = self.source.request(self.slicing)
+        # The relabeling is applied when waiting for the request
+        self.assertTrue( req.getResult() is None )
+        result = req.wait()
+        self.assertEqual( result.dtype, np.uint64 )
+        self.assertEqual( result[0,:,:,0,0].tolist(), [[1, 1, 2, 2], [2, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0]] )
+
+    def _fetchTiles( self ):
+        for x in (0, 2):
+            for y in (0, 2):
+                self.source.request((slice(0,1), slice(x,x+2), slice(y,y+2), slice(0,1), slice(0,1))).wait()
+
+    def testSetRelabelingEntry( self ):
+        self._fetchTiles()
+        dirty = []
+        self.source.isDirty.connect(dirty.append)
+        self.source.setRelabelingEntry(2**40, 3)
+        # The tile that contains the label (on all slices)
+        self.assertEqual( dirty, [(slice(None), slice(0,2), slice(0,2), slice(None), slice(None))] )
+
+        # Labels that do not occur in the data are never dirty
+        self.source.setRelabelingEntry(123, 3)
+        self.assertEqual( len(dirty), 1 )
+
+        # Label 5 occurs in two tiles (the dirty tile is refetched first)
+        self._fetchTiles()
+        del dirty[:]
+        self.source.setRelabelingEntry(5, 3)
+        self.assertEqual( sorted(sl[1:3] for sl in dirty), [(slice(0,2), slice(0,2)), (slice(0,2), slice(2,4))] )
+        self.assertEqual( self.source.request(self.slicing).wait()[0,:2,:,0,0].tolist(), [[1, 1, 3, 3], [3, 3, 0, 0]] )
+
+        self.source.clearRelabeling()
+        self.assertEqual( dirty[-1], self.slicing )
+        self.assertTrue( (self.source.request(self.slicing).wait() == 0).all() )
+
+    def testLabelIndexIsBounded( self ):
+        self.source._MAX_INDEXED_LABELS = 4
+        self._fetchTiles()
+        self.assertTrue( self.source._indexedLabels <= 4 )
+        dirty = []
+        self.source.isDirty.connect(dirty.append)
+        # The evicted tiles are dirty on any change
+        self.source.setRelabelingEntry(123, 3)
+        self.assertTrue( (slice(None), slice(0,2), slice(0,2), slice(None), slice(None)) in dirty )
+        self.assertFalse( (slice(None), slice(2,4), slice(2,4), slice(None), slice(None)) in dirty )
+
+        # Too many evicted tiles: everything is dirty
+        self.source._MAX_UNINDEXED_REGIONS = 1
+        self._fetchTiles()
+        del dirty[:]
+        self.source.setRelabelingEntry(123, 4)
+        self.assertEqual( dirty, [self.slicing] )
+        self.assertEqual( len(self.source._regionLabels), 0 )
+
+    def testTableIsUpdatedInWait( self ):
+        self.source.request(self.slicing).wait()
+        table = self.source._sparseRelabeling
+        self.source.setRelabelingEntry(7, 3)
+        self.source.setRelabelingEntry(5, 4)
+        # Changing entries doesn't rebuild the table
+        req = self.source.request(self.slicing)
+        self.assertTrue( self.source._sparseRelabeling is table )
+        self.assertEqual( req.wait()[0,:,:,0,0].tolist(), [[1, 1, 4, 4], [4, 0, 0, 0], [0, 0, 0, 0], [0, 0, 3, 0]] )
+        self.assertEqual( self.source._sparseChanges, {} )
+
+    def testPendingRequestsAreDirty( self ):
+        self._fetchTiles()
+        req = self.source.request((slice(0,1), slice(2,4), slice(0,4), slice(0,1), slice(0,1)))
+        dirty = []
+        self.source.isDirty.connect(dirty.append)
+        # The label is not known to occur in the region that is being fetched
+        self.source.setRelabelingEntry(10**9, 4)
+        self.assertIn( (slice(None), slice(2,4), slice(0,4), slice(None), slice(None)), dirty )
+        req.wait()
+
+class BlockCachedDataSourceTest( ut.TestCase ):
+    def setUp( self ):
+        self.raw = np.random.randint(0, 255, (1,20,15,6,1)).astype(np.uint8)
+        self.rawSource = ArraySource(self.raw)
+        self.requested = []
+        request = self.rawSource.request
+        def countingRequest( slicing ):
+            self.requested.append(slicing)
+            return request(slicing)
+        self.rawSource.request = countingRequest
+        self.source = BlockCachedDataSource( self.rawSource, self.raw.shape, blockShape=(1,8,8,2,1) )
+
+    def testRequest( self ):
+        for slicing in [ sl[0:1, 0:20, 0:15, 3:4, 0:1],
+                         sl[0:1, 5:13, 7:9, 0:6, 0:1],
+                         sl[0:1, 1:20:3, 0:15:2, 1:6:2, 0:1] ]:
+            result = self.source.request(slicing).wait()
+            self.assertTrue( np.all(result == self.raw[slicing]) )
+
+    def testCacheHit( self ):
+        self.source.request( sl[0:1, 0:8, 0:8, 2:3, 0:1] ).wait()
+        self.assertEqual( len(self.requested), 1 )
+        # The next slice is in the same block
+        result = self.source.request( sl[0:1, 0:8, 0:8, 3:4, 0:1] ).wait()
+        self.assertEqual( len(self.requested), 1 )
+        self.assertTrue( np.all(result == self.raw[0:1, 0:8, 0:8, 3:4, 0:1]) )
+
+    def testReadAhead( self ):
+        self.source.setCourse(3, 1)
+        self.source.request( sl[0:1, 0:8, 0:8, 2:3, 0:1] ).wait()
+        # Wait for the background reads to finish
+        BlockCachedDataSource._executor().submit( lambda: None, float('inf') ).result()
+        self.assertTrue( (0,0,0,2,0) in self.source.cache )
+        self.assertFalse( (0,0,0,0,0) in self.source.cache )
+
+        self.source.setCourse(3, -1)
+        self.source.request( sl[0:1, 8:16, 0:8, 2:3, 0:1] ).wait()
+        BlockCachedDataSource._executor().submit( lambda: None, float('inf') ).result()
+        self.assertTrue( (0,1,0,0,0) in self.source.cache )
+        self.assertFalse( (0,1,0,2,0) in self.source.cache )
+
+    def testReadAheadOnce( self ):
+        # Keep the read-ahead thread busy, while the same region is requested repeatedly
+        blocker = threading.Event()
+        BlockCachedDataSource._executor().submit( blocker.wait, 0 )
+        self.source.setCourse(3, 1)
+        for _ in range(5):
+            self.source.request( sl[0:1, 0:8, 0:8, 2:3, 0:1] ).wait()
+        self.assertEqual( self.source._readAheadPending, set([(0,0,0,2,0)]) )
+        blocker.set()
+        BlockCachedDataSource._executor().submit( lambda: None, float('inf') ).result()
+        self.assertEqual( len(self.requested), 2 )
+        self.assertEqual( self.source._readAheadPending, set() )
+
+    def testSetDirty( self ):
+        dirty = []
+        self.source.isDirty.connect( dirty.append )
+        self.source.request( sl[0:1, 0:16, 0:8, 0:1, 0:1] ).wait()
+        self.assertEqual( len(self.source.cache), 2 )
+        self.raw[0, 9, 0, 0, 0] += 1
+        self.rawSource.setDirty( sl[0:1, 9:10, 0:1, 0:1, 0:1] )
+        self.assertEqual( len(dirty), 1 )
+        self.assertTrue( (0,0,0,0,0) in self.source.cache )
+        self.assertFalse( (0,1,0,0,0) in self.source.cache )
+        result = self.source.request( sl[0:1, 0:16, 0:8, 0:1, 0:1] ).wait()
+        self.assertTrue( np.all(result == self.raw[0:1, 0:16, 0:8, 0:1, 0:1]) )
+
+class HistogramSketchTest( ut.TestCase ):
+    def testPercentiles( self ):
+        sketch = HistogramSketch()
+        self.assertEqual( sketch.percentile(50), None )
+        data = np.random.uniform(-1000, 1000, 100000)
+        # The range grows in both directions
+        for chunk in np.array_split(np.sort(data)[::-1], 10) + np.array_split(np.sort(data), 10):
+            sketch.add(chunk)
+        self.assertEqual( sketch.count, 2*data.size )
+        for q in (0, 1, 50, 99, 100):
+            self.assertAlmostEqual( sketch.percentile(q), np.percentile(data, q), delta=2.0 )
+
+    def testConstant( self ):
+        sketch = HistogramSketch()
+        sketch.add( np.ones(10, dtype=np.uint8) )
+        self.assertEqual( sketch.percentile(0.1), 1 )
+        self.assertEqual( sketch.percentile(99.9), 1 )
+        sketch.add( np.array([np.nan, 3.0]) )
+        self.assertEqual( sketch.percentile(100), 3 )
+
+class MinMaxSourceTest( ut.TestCase ):
+    def setUp( self ):
+        self.raw = np.random.randint(100, 200, (1,100,100,40,1)).astype(np.uint16)
+        # A few outliers
+        self.raw[0,50,50,20,0] = 60000
+        self.raw[0,10,10,10,0] = 0
+        self.slicing = sl[0:1, 0:100, 0:100, 5:6, 0:1]
+
+    def _waitForEstimate( self ):
+        MinMaxSource._executor().submit( lambda: None, float('inf') ).result()
+
+    def testExact( self ):
+        source = MinMaxSource( ArraySource(self.raw), sampled=False )
+        source.request( self.slicing ).wait()
+        self.assertEqual( source._bounds, [self.raw[self.slicing].min(), self.raw[self.slicing].max()] )
+        source.request( sl[0:1, 0:100, 0:100, 20:21, 0:1] ).wait()
+        self.assertEqual( source._bounds[1], 60000 )
+
+    def testSampled( self ):
+        source = MinMaxSource( ArraySource(self.raw), sampled=True )
+        self._waitForEstimate()
+        # Robust bounds, from the sample of the volume
+        self.assertAlmostEqual( source._bounds[0], 100, delta=5 )
+        self.assertAlmostEqual( source._bounds[1], 200, delta=5 )
+
+        # Requested data doesn't change the bounds noticeably, and
+        # the volume isn't marked dirty immediately.
+        bounds, dirty = [], []
+        source.boundsChanged.connect( bounds.append )
+        source.isDirty.connect( dirty.append )
+        for z in range(40):
+            source.request( sl[0:1, 0:100, 0:100, z:z+1, 0:1] ).wait()
+        self.assertEqual( bounds, [] )
+        self.assertEqual( dirty, [] )
+
+    def testResetBounds( self ):
+        source = MinMaxSource( ArraySource(self.raw), sampled=True )
+        self._waitForEstimate()
+        self.raw[:] = 1000 + self.raw
+        source.resetBounds()
+        self._waitForEstimate()
+        self.assertAlmostEqual( source._bounds[0], 1100, delta=5 )
+        self.assertAlmostEqual( source._bounds[1], 1200, delta=5 )
+
+class DownsampledDataSourceTest( ut.TestCase ):
+    def setUp( self ):
+        self.raw = np.arange(10*9, dtype=np.uint8).reshape((1,10,9,1,1))
+        self.factors = (1,4,4,1,1)
+
+    def testNativeDownsampling( self ):
+        source = DownsampledDataSource( ArraySource(self.raw), self.factors )
+        result = source.request( (slice(0,1), slice(0,3), slice(1,3), slice(0,1), slice(0,1)) ).wait()
+        self.assertEqual( result.shape, (1,3,2,1,1) )
+        self.assertTrue( np.all(result == self.raw[:, 0:10:4, 4:9:4]) )
+
+    def testFallbackDownsampling( self ):
+        # HaloAdjustedDataSource can't downsample by itself
+        plain_source = HaloAdjustedDataSource( ArraySource(self.raw), 5*(0,), 5*(0,) )
+        for method in ('stride', 'average'):
+            source = DownsampledDataSource( plain_source, self.factors, method )
+            result = source.request( (slice(0,1), slice(0,3), slice(0,3), slice(0,1), slice(0,1)) ).wait()
+            self.assertEqual( result.shape, (1,3,3,1,1) )
+            self.assertEqual( result.dtype, self.raw.dtype )
+        self.assertEqual( result[0,0,0,0,0], np.round(self.raw[0,0:4,0:4].mean()) )
+        # Incomplete blocks at the border average only the elements they contain
+        self.assertEqual( result[0,2,2,0,0], np.round(self.raw[0,8:10,8:9].mean()) )
+
+        source = DownsampledDataSource( ConstantSource(7), self.factors, 'average' )
+        result = source.request( (slice(0,1), slice(0,3), slice(0,3), slice(0,1), slice(0,1)) ).wait()
+        self.assertEqual( result.shape, (1,3,3,1,1) )
+        self.assertTrue( np.all(result == 7) )
+
+    def testSetDirty( self ):
+        raw_source = ArraySource(self.raw)
+        source = DownsampledDataSource( raw_source, self.factors )
+        dirty = []
+        source.isDirty.connect( dirty.append )
+        raw_source.setDirty( (slice(0,1), slice(3,9), slice(None), slice(0,1), slice(0,1)) )
+        self.assertEqual( dirty, [(slice(0,1), slice(0,3), slice(None), slice(0,1), slice(0,1))] )
+
 if __name__ == '__main__':
     ut.main()
@@ -0,0 +1,193 @@
+###############################################################################
+#   volumina: volume slicing and editing library
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+#		   http://ilastik.org/license/
+###############################################################################
+import unittest as ut
+import os
+import gc
+import shutil
+import numpy as np
+from PyQt4.QtCore import QRectF
+from PyQt4.QtGui import QImage
+from qimage2ndarray import byte_view
+
+from volumina.config import cfg
+from volumina.diskTileCache import DiskTileCache
+from volumina.tiling import TileProvider, Tiling
+from volumina.layerstack import LayerStackModel
+from volumina.layer import GrayscaleLayer
+from volumina.pixelpipeline.datasources import ArraySource
+from volumina.pixelpipeline.imagepump import ImagePump
+from volumina.slicingtools import SliceProjection
+
+
+def _image(value):
+    img = QImage(100, 50, QImage.Format_ARGB32)
+    byte_view(img)[...] = value
+    return img
+
+class _Layer( object ):
+    pass
+
+class DiskTileCacheTest( ut.TestCase ):
+    def setUp( self ):
+        self.cache = DiskTileCache()
+        self.stack_id = (None, ((0, 0),))
+        self.ims = _Layer()
+        self.other = _Layer()
+
+    def tearDown( self ):
+        shutil.rmtree(self.cache.directory, True)
+
+    def testRoundTrip( self ):
+        self.assertEqual( self.cache.get(self.ims, self.stack_id, 0), None )
+        self.cache.put(self.ims, self.stack_id, 0, _image(7)).result()
+        img = self.cache.get(self.ims, self.stack_id, 0)
+        self.assertEqual( (img.width(), img.height()), (100, 50) )
+        self.assertTrue( np.all(byte_view(img) == 7) )
+        self.assertEqual( (self.cache.hits, self.cache.misses), (1, 1) )
+        # Compressed
+        self.assertLess( self.cache.usedBytes, img.byteCount() )
+
+    def testInvalidate( self ):
+        for tile_no in range(3):
+            self.cache.put(self.ims, self.stack_id, tile_no, _image(tile_no)).result()
+        self.cache.put(self.other, self.stack_id, 0, _image(3)).result()
+
+        self.cache.invalidate(self.ims, [1])
+        self.assertEqual( self.cache.get(self.ims, self.stack_id, 1), None )
+        self.assertNotEqual( self.cache.get(self.ims, self.stack_id, 2), None )
+
+        self.cache.invalidate(self.ims)
+        self.assertEqual( self.cache.get(self.ims, self.stack_id, 0), None )
+        self.assertEqual( self.cache.get(self.ims, self.stack_id, 2), None )
+        self.assertNotEqual( self.cache.get(self.other, self.stack_id, 0), None )
+        self.assertEqual( len(self.cache), 1 )
+
+    def testInvalidateWhileWriting( self ):
+        # A tile that becomes dirty while it is written is never found.
+        f = self.cache.put(self.ims, self.stack_id, 0, _image(1))
+        self.cache.invalidate(self.ims, [0])
+        f.result()
+        self.assertEqual( self.cache.get(self.ims, self.stack_id, 0), None )
+
+    def testLayersAreWeak( self ):
+        self.cache.put(self.ims, self.stack_id, 0, _image(1)).result()
+        self.cache.invalidate(self.ims, [1])
+        self.assertEqual( len(self.cache._layerGeneration) + len(self.cache._tileGeneration), 1 )
+        del self.ims
+        gc.collect()
+        self.assertEqual( len(self.cache._layerIds), 0 )
+        self.assertEqual( len(self.cache._tileGeneration), 0 )
+        # A new layer never finds the tiles of the old one
+        self.assertEqual( self.cache.get(_Layer(), self.stack_id, 0), None )
+
+    def testClose( self ):
+        self.cache.put(self.ims, self.stack_id, 0, _image(1))
+        self.cache.close()
+        self.assertFalse( os.path.exists(self.cache.directory) )
+        self.assertEqual( len(self.cache), 0 )
+        self.assertEqual( self.cache.put(self.ims, self.stack_id, 0, _image(1)), None )
+        self.assertEqual( self.cache.get(self.ims, self.stack_id, 0), None )
+
+    def testMaxBytes( self ):
+        cache = DiskTileCache(maxbytes=1)
+        try:
+            cache.put(self.ims, self.stack_id, 0, _image(1)).result()
+            self.assertEqual( len(cache), 0 )
+            self.assertEqual( cache.usedBytes, 0 )
+        finally:
+            shutil.rmtree(cache.directory, True)
+
+
+class TileProviderDiskCacheTest( ut.TestCase ):
+    def setUp( self ):
+        dataShape = (1, 900, 400, 10, 1) # t,x,y,z,c
+        self.data = np.indices(dataShape)[3].astype(np.uint8) # Data is labeled according to z-index
+        self.ds = ArraySource( self.data )
+        layer = GrayscaleLayer( self.ds, normalize=False )
+        layer.opacity = 1.0
+        self.lsm = LayerStackModel()
+        self.pump = ImagePump( self.lsm, SliceProjection(), sync_along=(0,1,2) )
+        self.lsm.append(layer)
+        self.diskCache = DiskTileCache()
+
+    def tearDown( self ):
+        shutil.rmtree(self.diskCache.directory, True)
+
+    def _showSlice( self, tp, z, rect, value=None ):
+        self.pump.syncedSliceSources.through = [0,z,0]
+        tp.requestRefresh(rect)
+        tp.waitForTiles(rect)
+        for tile in tp.getTiles(rect):
+            self.assertTrue( np.all(byte_view(tile.qimg)[:,:,0:3] == (z if value is None else value)) )
+
+    def testRevisitSlice( self ):
+        # Only a single slice fits into memory.
+        tp = TileProvider( Tiling((900,400), blockSize=100), self.pump.stackedImageSources,
+                           cache_size=1, disk_cache=self.diskCache )
+        rect = QRectF(0,0,200,200)
+        # Once the data range is known, the layer is no longer marked dirty by new slices.
+        self._showSlice(tp, 9, rect)
+        self._showSlice(tp, 0, rect)
+
+        self._showSlice(tp, 1, rect)
+        self._showSlice(tp, 2, rect)
+        self.diskCache.flush()
+        hits = self.diskCache.hits
+
+        # The tiles of the first slice are read back from disk.
+        self._showSlice(tp, 1, rect)
+        self.assertEqual( self.diskCache.hits, hits + 4 )
+
+        # Changed data is never read from disk.
+        self.diskCache.flush()
+        self.assertTrue( len(self.diskCache) > 0 )
+        self.data[:] = 5
+        self.ds.setDirty((slice(None),)*5)
+        self.assertEqual( len(self.diskCache), 0 )
+        self._showSlice(tp, 2, rect, value=5)
+        self.assertEqual( self.diskCache.hits, hits + 4 )
+
+    def testClose( self ):
+        # A disk cache that is passed in belongs to the caller
+        tp = TileProvider( Tiling((900,400), blockSize=100), self.pump.stackedImageSources,
+                           disk_cache=self.diskCache )
+        tp.close()
+        self.assertTrue( os.path.exists(self.diskCache.directory) )
+
+        limit = cfg.get('pixelpipeline', 'tile_disk_cache_mb')
+        try:
+            cfg.set('pixelpipeline', 'tile_disk_cache_mb', '1')
+            tp = TileProvider( Tiling((900,400), blockSize=100), self.pump.stackedImageSources )
+        finally:
+            cfg.set('pixelpipeline', 'tile_disk_cache_mb', limit)
+        directory = tp.disk_cache.directory
+        self._showSlice(tp, 1, QRectF(0,0,200,200))
+        tp.close()
+        self.assertFalse( os.path.exists(directory) )
+        # No longer notified by the layers
+        self.ds.setDirty((slice(None),)*5)
+        with tp._cache:
+            self.assertFalse( tp._cache.layerDirty(tp._current_stack_id, self.pump.stackedImageSources.getImageSource(0), 0) )
+
+
+if __name__=='__main__':
+    ut.main()
@@ -0,0 +1,156 @@
+###############################################################################
+#   volumina: volume slicing and editing library
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+#		   http://ilastik.org/license/
+###############################################################################
+import unittest as ut
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from volumina.pixelpipeline.datasourcefactories import createDataSource
+from volumina.pixelpipeline.datasources import ArraySource
+from volumina.pixelpipeline.diskdatasources import MemmapArraySource, ChunkCache
+
+try:
+    import h5py
+    from volumina.pixelpipeline.diskdatasources import ChunkedH5pyDset5DWrapper, H5pyArraySource
+    _has_h5py = True
+except ImportError:
+    _has_h5py = False
+
+class DiskDatasourcesTestBase( ut.TestCase ):
+    def setUp( self ):
+        self.tmpdir = tempfile.mkdtemp()
+        self.data = np.random.randint(0, 1000, (30, 40, 7)).astype(np.uint16) # xyz
+
+    def tearDown( self ):
+        shutil.rmtree(self.tmpdir, True)
+
+class MemmapArraySourceTest( DiskDatasourcesTestBase ):
+    def testNpy( self ):
+        path = os.path.join(self.tmpdir, 'data.npy')
+        np.save(path, self.data)
+        src, shape = createDataSource(path, True)
+        self.assertTrue( isinstance(src, MemmapArraySource) )
+        self.assertEqual( shape, (1, 30, 40, 7, 1) )
+        slicing = (slice(0,1), slice(5,25), slice(3,30), slice(2,3), slice(0,1))
+        result = src.request(slicing).wait()
+        # The data is read into memory
+        self.assertEqual( type(result), np.ndarray )
+        self.assertTrue( (result[0,:,:,0,0] == self.data[5:25, 3:30, 2]).all() )
+
+    def testRaw( self ):
+        path = os.path.join(self.tmpdir, 'data.raw')
+        self.data.tofile(path)
+        src = MemmapArraySource.open(path, dtype=np.uint16, shape=self.data.shape)
+        strided = src.requestDownsampled( 5*(slice(None),), (1, 4, 4, 1, 1) ).wait()
+        self.assertTrue( (strided[0,:,:,:,0] == self.data[::4, ::4]).all() )
+        self.assertTrue( isinstance(createDataSource(np.memmap(path, dtype=np.uint16, mode='r', shape=self.data.shape)), MemmapArraySource) )
+
+class ChunkCacheTest( ut.TestCase ):
+    def testEviction( self ):
+        cache = ChunkCache( maxbytes=250 )
+        for i in range(3):
+            cache.get( i, lambda: np.zeros(100, dtype=np.uint8) )
+        self.assertEqual( len(cache), 2 )
+        self.assertEqual( cache.usedBytes, 200 )
+        # The least recently used chunk was evicted
+        reads = []
+        cache.get( 0, lambda: reads.append(0) or np.ones(100, dtype=np.uint8) )
+        cache.get( 2, lambda: reads.append(2) or np.ones(100, dtype=np.uint8) )
+        self.assertEqual( reads, [0] )
+        self.assertFalse( cache.get(2, None).flags.writeable )
+
+@ut.skipIf(not _has_h5py, "h5py is not available")
+class ChunkedH5pyDset5DWrapperTest( DiskDatasourcesTestBase ):
+    def setUp( self ):
+        super( ChunkedH5pyDset5DWrapperTest, self ).setUp()
+        self.filename = os.path.join(self.tmpdir, 'data.h5')
+        with h5py.File(self.filename, 'w') as f:
+            f.create_dataset('volume', data=self.data, chunks=(8, 16, 4), compression='gzip')
+            f.create_dataset('contiguous', data=self.data)
+        self.f = h5py.File(self.filename, 'r')
+
+    def tearDown( self ):
+        self.f.close()
+        super( ChunkedH5pyDset5DWrapperTest, self ).tearDown()
+
+    def testRead( self ):
+        for name in ('volume', 'contiguous'):
+            wrapper = ChunkedH5pyDset5DWrapper(self.f[name], ChunkCache(2**20))
+            self.assertEqual( wrapper.shape, (1, 30, 40, 7, 1) )
+            for xyz in [ (slice(0,30), slice(0,40), slice(0,7)),
+                         (slice(5,23), slice(15,17), slice(3,4)),
+                         (slice(7,30,4), slice(1,40,3), slice(0,7,2)) ]:
+                result = wrapper[ (slice(0,1),) + xyz + (slice(0,1),) ]
+                self.assertTrue( (result[0,:,:,:,0] == self.data[xyz]).all(), (name, xyz) )
+
+    def testSharedChunks( self ):
+        cache = ChunkCache(2**20)
+        a = ChunkedH5pyDset5DWrapper(self.f['volume'], cache)
+        b = ChunkedH5pyDset5DWrapper(self.f['volume'], cache)
+        slicing = (slice(0,1), slice(0,8), slice(0,16), slice(0,1), slice(0,1))
+        a[slicing]
+        self.assertEqual( len(cache), 1 )
+        # Another layer of the same dataset reads the cached chunk
+        cached = cache.get( b._key + ((0,0,0),), None )
+        self.assertTrue( (b[slicing][0,:,:,0,0] == cached[:,:,0]).all() )
+        self.assertEqual( len(cache), 1 )
+
+    def testCreateDataSource( self ):
+        for path in (self.filename + '/volume', unicode(self.filename + '/volume')):
+            src = createDataSource(path)
+            self.assertTrue( isinstance(src, H5pyArraySource) )
+            self.assertTrue( isinstance(src._array, ChunkedH5pyDset5DWrapper) )
+            result = src.request( (slice(0,1), slice(0,30), slice(0,40), slice(4,5), slice(0,1)) ).wait()
+            self.assertTrue( (result[0,:,:,0,0] == self.data[:,:,4]).all() )
+            # The source owns the file
+            f = src._array.dset.file
+            src.clean_up()
+            self.assertFalse( f.id.valid )
+
+        # ... but not the file of a dataset that was passed in
+        src = createDataSource(self.f['volume'])
+        src.clean_up()
+        self.assertTrue( self.f.id.valid )
+
+    def testFactoriesExportWrappers( self ):
+        from volumina.pixelpipeline import datasourcefactories, diskdatasources
+        for name in ('H5pyDset5DWrapper', 'ChunkedH5pyDset5DWrapper', 'H5pyArraySource'):
+            self.assertTrue( getattr(datasourcefactories, name) is getattr(diskdatasources, name) )
+
+    def testSetDirtyDiscardsChunks( self ):
+        cache = ChunkCache(2**20)
+        src = H5pyArraySource(self.f['volume'], cache)
+        whole = (slice(0,1), slice(0,30), slice(0,40), slice(0,7), slice(0,1))
+        src.request(whole).wait()
+        n_chunks = len(cache)
+        self.assertEqual( n_chunks, 4*3*2 )
+
+        # Only the chunks that intersect with the dirty region
+        src.setDirty( (slice(0,1), slice(0,8), slice(10,20), slice(None), slice(0,1)) )
+        self.assertEqual( len(cache), n_chunks - 2*2 )
+        src.setDirty( 5*(slice(None),) )
+        self.assertEqual( len(cache), 0 )
+
+
+if __name__=='__main__':
+    ut.main()
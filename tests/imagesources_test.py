@@ -23,6 +23,7 @@
 import unittest as ut
 import os
 import sys
+import warnings
 sys.path.append("../.")
 
 #SciPy
@@ -133,6 +134,32 @@ class GrayscaleImageSourceTest( ImageSourcesTestBase ):
         self.ims.setDirty((slice(34,37), slice(12,34)))
         self.ims.isDirty.disconnect( checkDirtyRect )
 
+class GrayscaleImageSourceLookupTableTest( ImageSourcesTestBase ):
+    def setUp( self ):
+        super( GrayscaleImageSourceLookupTableTest, self ).setUp()
+        self.raw = numpy.arange(64*64, dtype=numpy.uint16).reshape(64, 64)
+        self.ars = _ArraySource2d(self.raw)
+        self.layer = GrayscaleLayer( self.ars, normalize=(0, 4095) )
+        self.ims = GrayscaleImageSource( self.ars, self.layer )
+
+    def testLookupTable( self ):
+        first = qimage2ndarray.byte_view(self.ims.request(QRect(0,0,64,64)).wait())
+        expected = numpy.floor(self.raw * (255.0/4095) + 0.5).astype(numpy.uint8)
+        self.assertTrue( (first[:,:,0] == expected).all() )
+        self.assertEqual( len(self.ims._lookupTables), 1 )
+
+        # The table is reused by other requests
+        table = self.ims._lookupTables.values()[0]
+        self.ims.request(QRect(0,0,32,32)).wait()
+        self.assertTrue( self.ims._lookupTables.values()[0] is table )
+
+        # ... until the normalization changes
+        self.layer.set_normalize(0, (0, 2047))
+        self.assertEqual( len(self.ims._lookupTables), 0 )
+        second = qimage2ndarray.byte_view(self.ims.request(QRect(0,0,64,64)).wait())
+        expected = numpy.floor(numpy.minimum(self.raw, 2047) * (255.0/2047) + 0.5).astype(numpy.uint8)
+        self.assertTrue( (second[:,:,0] == expected).all() )
+
 class GrayscaleImageSourceTest2( ImageSourcesTestBase ):
     def setUp( self ):
         super( GrayscaleImageSourceTest2, self ).setUp()
@@ -306,6 +333,15 @@ class ColortableImageSourceTest( ImageSourcesTestBase ):
         assert img.size() == result.size()
         assert img == result
 
+    def testFloatData( self ):
+        expected = self.ims.request(QRect(0,0,512,512)).wait()
+        ars = _ArraySource2d(self.seg.astype(numpy.float32) + 0.25)
+        ims = ColortableImageSource( ars, ColortableLayer(ars, self.ctable) )
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            result = ims.request(QRect(0,0,512,512)).wait()
+        self.assertTrue( numpy.all(qimage2ndarray.byte_view(result) == qimage2ndarray.byte_view(expected)) )
+
     def testSetDirty( self ):
         def checkAllDirty( rect ):
             self.assertTrue( rect.isEmpty() )
@@ -431,6 +467,18 @@ class RGBAImageSourceTest( ImageSourcesTestBase ):
     def testNone( self ):
         img = self.ims_none.request(QRect(0,0,104,129)).wait()
         #img.save('none.tif')
+        self.assertEqual( (img.width(), img.height()), (129, 104) )
+        self.assertTrue( (qimage2ndarray.byte_view(img) == 0).all() )
+
+    def testConstantChannels( self ):
+        # Constant channels are not requested and not normalized
+        ims = RGBAImageSource( ConstantSource(7), self.green, ConstantSource(), ConstantSource(255), RGBALayer(green=self.green, normalizeG=(0, 255)) )
+        req = ims.request(QRect(0,0,104,129))
+        self.assertEqual( len(req._requests), 1 )
+        v = qimage2ndarray.byte_view(req.wait())
+        self.assertTrue( (v[:,:,2] == 7).all() )
+        self.assertTrue( (v[:,:,0] == 0).all() )
+        self.assertTrue( (v[:,:,3] == 255).all() )
 
     def testOpaqueness( self ):
         ims_opaque = RGBAImageSource( self.red, self.green, self.blue, ConstantSource(), RGBALayer(self.red, self.green, self.blue, alpha_missing_value = 255), guarantees_opaqueness = True )
@@ -0,0 +1,173 @@
+###############################################################################
+#   volumina: volume slicing and editing library
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+#		   http://ilastik.org/license/
+###############################################################################
+import unittest as ut
+import time
+import numpy
+
+from PyQt4.QtGui import QImage
+from qimage2ndarray import byte_view
+
+from volumina.pixelpipeline import numpyKernels
+
+try:
+    import vigra
+    _has_vigra = hasattr(vigra, 'colors') and hasattr(vigra.colors, 'gray2qimage_ARGB32Premultiplied')
+except ImportError:
+    _has_vigra = False
+
+def _newImage(a):
+    return QImage(a.shape[1], a.shape[0], QImage.Format_ARGB32_Premultiplied)
+
+def _reference(a, normalize):
+    t = (numpy.asarray(a, dtype=numpy.float64) - normalize[0]) * 255.0 / (normalize[1] - normalize[0])
+    return numpy.floor(numpy.clip(t, 0, 255) + 0.5).astype(numpy.uint8)
+
+class NumpyKernelsTest( ut.TestCase ):
+    def setUp( self ):
+        self.rng = numpy.random.RandomState(0)
+
+    def _checkGray( self, a, normalize ):
+        img = _newImage(a)
+        numpyKernels.gray2qimage_ARGB32Premultiplied(a, byte_view(img), numpy.asarray(normalize, numpy.float32))
+        v = byte_view(img)
+        expected = _reference(a, normalize)
+        for channel in range(3):
+            self.assertTrue( (v[:,:,channel] == expected).all(), a.dtype )
+        self.assertTrue( (v[:,:,3] == 255).all() )
+
+    def testGray( self ):
+        self._checkGray( self.rng.randint(0, 256, (30, 40)).astype(numpy.uint8), (0, 255) )
+        self._checkGray( self.rng.randint(0, 256, (30, 40)).astype(numpy.uint8), (10, 100) )
+        self._checkGray( self.rng.randint(0, 5000, (30, 40)).astype(numpy.uint16), (0, 4000) )
+        self._checkGray( self.rng.randint(-300, 300, (30, 40)).astype(numpy.int16), (-100, 200) )
+        self._checkGray( self.rng.randint(0, 10**6, (30, 40)).astype(numpy.uint32), (0, 10**6) )
+        self._checkGray( self.rng.rand(30, 40).astype(numpy.float32), (0.25, 0.75) )
+
+        # non-contiguous data
+        self._checkGray( self.rng.randint(0, 5000, (40, 30)).astype(numpy.uint16).T, (0, 4000) )
+        self._checkGray( self.rng.rand(40, 30).T, (0, 1) )
+
+    def testAlphaModulated( self ):
+        a = numpy.array([[0, 50, 100]], dtype=numpy.uint8)
+        img = _newImage(a)
+        numpyKernels.alphamodulated2qimage_ARGB32Premultiplied(a, byte_view(img), (1.0, 0.5, 0.0), (0, 100))
+        v = byte_view(img)
+        # BGRA, premultiplied with alpha
+        self.assertEqual( v[0].tolist(), [[0, 0, 0, 0], [0, 64, 128, 128], [0, 128, 255, 255]] )
+
+    def testColortable( self ):
+        colortable = numpy.array([[1, 2, 3, 255], [4, 5, 6, 0], [7, 8, 9, 128]], dtype=numpy.uint8)
+        a = numpy.array([[0, 1, 2], [3, 4, 5]], dtype=numpy.uint32)
+        img = QImage(3, 2, QImage.Format_ARGB32)
+        numpyKernels.applyColortable(a, colortable, byte_view(img))
+        # Values are taken modulo the length of the table
+        self.assertTrue( (byte_view(img) == colortable[a % 3]).all() )
+
+    def testRgba( self ):
+        r = self.rng.randint(0, 4000, (30, 40)).astype(numpy.uint16)
+        g = self.rng.rand(30, 40).astype(numpy.float32)
+        a = self.rng.randint(0, 256, (30, 40)).astype(numpy.uint8)
+        img = _newImage(r)
+        numpyKernels.rgba2qimage_ARGB32Premultiplied([r, g, 100, a], byte_view(img), [(0, 4000), (0, 1), None, None])
+        v = byte_view(img)
+        alpha = a.astype(numpy.float64)
+        for channel, expected in zip((2, 1, 0), (_reference(r, (0, 4000)), _reference(g, (0, 1)), 100)):
+            premultiplied = numpy.floor(expected * alpha / 255 + 0.5)
+            self.assertTrue( (v[:,:,channel] == premultiplied).all() )
+        self.assertTrue( (v[:,:,3] == a).all() )
+
+    def testRgbaConstantAlpha( self ):
+        r = self.rng.randint(0, 256, (30, 40)).astype(numpy.uint8)
+        img = _newImage(r)
+        numpyKernels.rgba2qimage_ARGB32Premultiplied([r, 0, 300, 255], byte_view(img), [None]*4)
+        v = byte_view(img)
+        self.assertTrue( (v[:,:,2] == r).all() )
+        self.assertTrue( (v[:,:,1] == 0).all() )
+        # Constants are clipped, but not normalized
+        self.assertTrue( (v[:,:,0] == 255).all() )
+        self.assertTrue( (v[:,:,3] == 255).all() )
+
+        numpyKernels.rgba2qimage_ARGB32Premultiplied([r, 0, 255, 51], byte_view(img), [None]*4)
+        self.assertTrue( (v[:,:,2] == numpy.floor(r * 0.2 + 0.5)).all() )
+        self.assertTrue( (v[:,:,0] == 51).all() )
+        self.assertTrue( (v[:,:,3] == 51).all() )
+
+
+class NumpyKernelsBenchmark( ut.TestCase ):
+    """
+    Compare the kernels with the vigra implementations (if available).
+    """
+    N = 10
+    
+    def _time( self, f, *args ):
+        start = time.time()
+        for i in range(self.N):
+            f(*args)
+        return (time.time() - start) / self.N
+
+    def _benchmark( self, a, normalize ):
+        normalize = numpy.asarray(normalize, dtype=numpy.float32)
+        img = _newImage(a)
+        t_numpy = self._time( numpyKernels.gray2qimage_ARGB32Premultiplied, a, byte_view(img), normalize )
+        # 512x512 pixels should take a few msec
+        self.assertLess( t_numpy, 0.2 )
+        if _has_vigra:
+            vigra_img = _newImage(a)
+            t_vigra = self._time( vigra.colors.gray2qimage_ARGB32Premultiplied, a, byte_view(vigra_img), normalize )
+            print "\n%s: numpy %.2f msec, vigra %.2f msec" % (a.dtype, 1000*t_numpy, 1000*t_vigra)
+            diff = byte_view(img).astype(int) - byte_view(vigra_img)
+            self.assertTrue( (abs(diff) <= 1).all() )
+
+    def testUint8( self ):
+        self._benchmark( numpy.random.randint(0, 256, (512, 512)).astype(numpy.uint8), (0, 255) )
+
+    def testUint16( self ):
+        self._benchmark( numpy.random.randint(0, 2**16, (512, 512)).astype(numpy.uint16), (100, 40000) )
+
+    def testFloat32( self ):
+        self._benchmark( numpy.random.rand(512, 512).astype(numpy.float32), (0, 1) )
+
+    def testLookupTablePerTile( self ):
+        # Per tile conversion of 16-bit data, with the lookup table cached
+        # (as by GrayscaleImageSource) or built for every tile.
+        a = numpy.random.randint(0, 2**16, (256, 256)).astype(numpy.uint16)
+        normalize = numpy.asarray((100, 40000), dtype=numpy.float32)
+        img = _newImage(a)
+        table = numpyKernels.grayLookupTable(a.dtype, normalize)
+        t_cached = self._time( numpyKernels.applyLookupTable, a, table, byte_view(img) )
+        t_uncached = self._time( numpyKernels.gray2qimage_ARGB32Premultiplied, a, byte_view(img), normalize )
+        print "\n256x256 uint16 tile: cached table %.2f msec, new table %.2f msec" % (1000*t_cached, 1000*t_uncached)
+        self.assertTrue( (byte_view(img)[:,:,0] == _reference(a, normalize)).all() )
+        self.assertLess( t_cached, t_uncached )
+
+    def testRgba( self ):
+        # Four 16-bit fluorescence channels
+        channels = [ numpy.random.randint(0, 2**16, (512, 512)).astype(numpy.uint16) for i in range(4) ]
+        normalize = [(100, 40000)]*4
+        img = _newImage(channels[0])
+        t = self._time( numpyKernels.rgba2qimage_ARGB32Premultiplied, channels, byte_view(img), normalize )
+        print "\n512x512 RGBA uint16: %.2f msec" % (1000*t)
+        self.assertLess( t, 0.2 )
+
+
+if __name__=='__main__':
+    ut.main()
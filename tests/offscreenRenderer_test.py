@@ -0,0 +1,94 @@
+###############################################################################
+#   volumina: volume slicing and editing library
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+#		   http://ilastik.org/license/
+###############################################################################
+import os
+import shutil
+import tempfile
+import unittest as ut
+import numpy as np
+from PyQt4.QtCore import QRect
+from PyQt4.QtGui import QImage
+from qimage2ndarray import byte_view
+
+from volumina.offscreenRenderer import OffscreenRenderer
+from volumina.layerstack import LayerStackModel
+from volumina.layer import GrayscaleLayer
+from volumina.pixelpipeline.datasources import ArraySource
+from volumina.slicingtools import SliceProjection
+
+
+class OffscreenRendererTest( ut.TestCase ):
+    def setUp( self ):
+        dataShape = (1, 60, 40, 10, 1) # t,x,y,z,c
+        self.data = np.indices(dataShape)[3].astype(np.uint8) # Data is labeled according to z-index
+        self.lsm = LayerStackModel()
+        layer = GrayscaleLayer( ArraySource(self.data), normalize=False )
+        layer.opacity = 1.0
+        self.lsm.append(layer)
+        self.renderer = OffscreenRenderer( self.lsm, SliceProjection(abscissa=1, ordinate=2, along=[0,3,4]) )
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown( self ):
+        self.renderer.shutdown()
+        shutil.rmtree(self.directory, True)
+
+    def testRender( self ):
+        futures = [ self.renderer.render((0,0,0,z,0), QRect(10,5,30,20)) for z in range(10) ]
+        for z, future in enumerate(futures):
+            img = future.result()
+            self.assertEqual( (img.width(), img.height()), (30, 20) )
+            self.assertTrue( np.all(byte_view(img)[:,:,0:3] == z) )
+
+    def testOpacity( self ):
+        self.lsm[0].opacity = 0.5
+        img = self.renderer.render((0,0,0,0,0), QRect(0,0,60,40)).result()
+        # Blended over white
+        self.assertTrue( np.all(np.abs(byte_view(img)[:,:,0:3].astype(int) - 128) <= 1) )
+
+    def testExport( self ):
+        frames = [ ((0,0,0,z,0), QRect(0,0,60,40), os.path.join(self.directory, "z{}.png".format(z)))
+                   for z in range(10) ]
+        progress = []
+        self.renderer.export( frames, progress.append )
+        self.assertEqual( progress, range(1, 11) )
+        for z in range(10):
+            img = QImage(frames[z][2])
+            self.assertEqual( (img.width(), img.height()), (60, 40) )
+            self.assertTrue( np.all(byte_view(img)[:,:,0:3] == z) )
+
+    def testShutdownReleasesLayers( self ):
+        self.renderer.shutdown()
+        self.assertEqual( len(self.renderer.stackedImageSources), 0 )
+        self.lsm.append( GrayscaleLayer(ArraySource(self.data)) )
+        self.assertEqual( len(self.renderer.stackedImageSources), 0 )
+        self.assertFalse( self.renderer.hasItemLayers() )
+
+    def testCancel( self ):
+        frames = [ ((0,0,0,z,0), QRect(0,0,60,40), os.path.join(self.directory, "z{}.png".format(z)))
+                   for z in range(10) ]
+        for written in self.renderer.exportSteps( frames ):
+            if written == 2:
+                self.renderer.cancel()
+        self.assertTrue( len(os.listdir(self.directory)) < 10 )
+
+
+if __name__=='__main__':
+    ut.main()
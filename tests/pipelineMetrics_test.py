@@ -0,0 +1,71 @@
+###############################################################################
+#   volumina: volume slicing and editing library
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+#		   http://ilastik.org/license/
+###############################################################################
+import os
+import json
+import tempfile
+import unittest as ut
+
+from volumina.utility.pipelineMetrics import PipelineMetrics, COUNT_BOUNDS
+
+class PipelineMetricsTest( ut.TestCase ):
+    def setUp( self ):
+        self.metrics = PipelineMetrics()
+
+    def testCounters( self ):
+        self.assertEqual( self.metrics.counter('hits'), 0 )
+        self.metrics.increment('hits')
+        self.metrics.increment('hits', 2)
+        self.assertEqual( self.metrics.counter('hits'), 3 )
+
+    def testHistogram( self ):
+        self.assertEqual( self.metrics.histogram('tiles'), None )
+        for n in (1, 3, 3, 600):
+            self.metrics.observe('tiles', n, COUNT_BOUNDS)
+        h = self.metrics.histogram('tiles')
+        self.assertEqual( (h['count'], h['min'], h['max'], h['mean']), (4, 1, 600, 151.75) )
+        # buckets: <=1, <=2, <=4, ..., <=512, >512
+        self.assertEqual( h['buckets'], [1, 0, 2, 0, 0, 0, 0, 0, 0, 0, 1] )
+
+    def testTimer( self ):
+        with self.metrics.timer('blend'):
+            pass
+        self.assertEqual( self.metrics.histogram('blend')['count'], 1 )
+
+    def testDump( self ):
+        self.metrics.increment('hits')
+        self.metrics.observe('wait', 2.5)
+        fd, path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        try:
+            self.metrics.dump(path)
+            with open(path) as f:
+                d = json.load(f)
+        finally:
+            os.remove(path)
+        self.assertEqual( d['counters'], {'hits' : 1} )
+        self.assertEqual( d['histograms']['wait']['total'], 2.5 )
+
+        self.metrics.reset()
+        self.assertEqual( self.metrics.snapshot(), {'counters' : {}, 'histograms' : {}} )
+
+if __name__=='__main__':
+    ut.main()
@@ -0,0 +1,122 @@
+###############################################################################
+#   volumina: volume slicing and editing library
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+#		   http://ilastik.org/license/
+###############################################################################
+import unittest as ut
+import threading
+
+from volumina.utility.prioritizedThreadPool import PrioritizedThreadPoolExecutor, WorkerLimitTuner
+
+
+class PrioritizedThreadPoolExecutorTest( ut.TestCase ):
+    def setUp( self ):
+        self.lock = threading.Lock()
+        self.running = {}
+        self.maxRunning = {}
+        self.order = []
+        self.gate = threading.Event()
+
+    def task( self, group, name=None ):
+        def fn():
+            with self.lock:
+                self.running[group] = self.running.get(group, 0) + 1
+                self.maxRunning[group] = max(self.maxRunning.get(group, 0), self.running[group])
+                self.order.append(name)
+            self.gate.wait()
+            with self.lock:
+                self.running[group] -= 1
+        return fn
+
+    def testPriorities( self ):
+        pool = PrioritizedThreadPoolExecutor(1)
+        self.gate.set()
+        blocker = threading.Event()
+        pool.submit(blocker.wait, 0)
+        futures = [ pool.submit(self.task('a', p), p) for p in (3, 1, 2) ]
+        blocker.set()
+        for f in futures:
+            f.result()
+        self.assertEqual( self.order, [1, 2, 3] )
+        pool.shutdown()
+
+    def testGroupLimit( self ):
+        pool = PrioritizedThreadPoolExecutor(4, max_per_group=-1)
+        slow = [ pool.submit(self.task('slow'), 0, group='slow') for _ in range(8) ]
+        # The fast layer gets a worker, although its requests have a lower priority
+        fast = pool.submit(lambda: 'fast', 1, group='fast')
+        self.assertEqual( fast.result(timeout=5), 'fast' )
+        self.gate.set()
+        for f in slow:
+            f.result()
+        self.assertEqual( self.maxRunning['slow'], 3 )
+        pool.shutdown()
+
+    def testExplicitLimit( self ):
+        pool = PrioritizedThreadPoolExecutor(4)
+        self.gate.set()
+        futures = [ pool.submit(self.task('a'), 0, group='a', limit=1) for _ in range(6) ]
+        for f in futures:
+            f.result()
+        self.assertEqual( self.maxRunning['a'], 1 )
+        pool.shutdown()
+
+    def testWorkerLimit( self ):
+        pool = PrioritizedThreadPoolExecutor(4)
+        pool.setWorkerLimit(2)
+        self.assertEqual( pool.workerLimit, 2 )
+        self.gate.set()
+        futures = [ pool.submit(self.task(None), 0) for _ in range(8) ]
+        for f in futures:
+            f.result()
+        self.assertTrue( self.maxRunning[None] <= 2 )
+        pool.shutdown()
+
+
+class WorkerLimitTunerTest( ut.TestCase ):
+    def setUp( self ):
+        self.now = 0.0
+        self.cpu = 0.0
+        self.tuner = WorkerLimitTuner( 2, 8, clock=lambda: self.now, cpu_time=lambda: self.cpu, n_cpus=4 )
+
+    def step( self, limit, utilization, latency ):
+        self.tuner.observe(latency)
+        self.now += 1.0
+        self.cpu += utilization * 4
+        return self.tuner.update(limit)
+
+    def testGrowWhileWaitingForIO( self ):
+        self.assertEqual( self.step(4, 0.2, 0.5), 5 )
+        # Tasks don't wait: keep the workers
+        self.assertEqual( self.step(5, 0.2, 0.001), 5 )
+        self.assertEqual( self.step(8, 0.2, 0.5), 8 )
+
+    def testShrinkWhenSaturated( self ):
+        self.assertEqual( self.step(6, 1.0, 0.5), 5 )
+        # Not below the number of CPUs
+        self.assertEqual( self.step(4, 1.0, 0.5), 4 )
+
+    def testInterval( self ):
+        self.tuner.observe(0.5)
+        self.now += 0.5
+        self.assertEqual( self.tuner.update(4), 4 )
+
+
+if __name__=='__main__':
+    ut.main()
@@ -21,15 +21,20 @@
 ###############################################################################
 # time to wait (in seconds) for rendering to finish
 import unittest as ut
+import time
+import shutil
+import threading
 import numpy as np
-from PyQt4.QtCore import QRectF, QPoint, QRect
-from PyQt4.QtGui import QTransform
+from PyQt4.QtCore import QRectF, QPointF, QPoint, QRect, QSize
+from PyQt4.QtGui import QTransform, QGraphicsRectItem, QImage
 from qimage2ndarray import byte_view
 
-from volumina.tiling import TileProvider, Tiling
+import volumina.tiling
+from volumina.tiling import TileProvider, Tiling, _TilesCache
+from volumina.diskTileCache import DiskTileCache
 from volumina.layerstack import LayerStackModel
 from volumina.layer import GrayscaleLayer
-from volumina.pixelpipeline.datasources import ConstantSource, ArraySource
+from volumina.pixelpipeline.datasources import ConstantSource, ConstantRequest, ArraySource, RelabelingArraySource
 from volumina.pixelpipeline.imagesources import GrayscaleImageSource
 from volumina.pixelpipeline.imagepump import StackedImageSources, ImagePump
 from volumina.slicingtools import SliceProjection
@@ -53,6 +58,16 @@ class TilingTest ( ut.TestCase ):
             t = Tiling((100*i, 100), blockSize = 50)
             self.assertEqual(len(t), (100*i*2)//50)
 
+    def testDownsampled( self ):
+        t = Tiling((900, 400), blockSize=100)
+        t2 = t.downsampled(4)
+        self.assertEqual( t2.sliceShape, (225, 100) )
+        self.assertEqual( t2.downsample, 4 )
+        self.assertEqual( t2.imageRects[0], QRect(0,0,400,400) )
+        self.assertEqual( t2.imageSize(0), QSize(100,100) )
+        self.assertEqual( t2.boundingRectF().width(), t.boundingRectF().width() )
+        self.assertEqual( t2.intersected(QRectF(0,0,800,400)), [0,1] )
+
     def testData2Scene(self):
         t = Tiling((0, 0))
         trans = QTransform()
@@ -65,6 +80,29 @@ class TilingTest ( ut.TestCase ):
             t.data2scene = trans
 
 
+class TilingBenchmark( ut.TestCase ):
+    """
+    Tilings with ~100k tiles (e.g. a large 2D image at a small block size)
+    must be cheap to create and to query.
+    """
+    def testLargeTiling( self ):
+        start = time.time()
+        t = Tiling((16000, 16000), blockSize=50)
+        t.data2scene = QTransform(0,1,0,1,0,0,0,0,1) # swap axes
+        self.assertEqual( len(t), 320*320 )
+        self.assertLess( time.time() - start, 5.0 )
+
+        start = time.time()
+        for i in range(1000):
+            self.assertEqual( t.containsF(QPoint(75, 10025)), 1*320 + 200 )
+        self.assertEqual( t.containsF(QPoint(16001, 0)), None )
+        self.assertEqual( t.intersected(QRectF(0, 0, 60, 100)), [0, 1, 320, 321] )
+        self.assertLess( time.time() - start, 1.0 )
+
+        self.assertEqual( t.imageRects[320], QRect(50, 0, 50, 50) )
+        self.assertEqual( t.tileRects[-1], QRect(15950, 15950, 50, 50) )
+
+
 class TileProviderTest( ut.TestCase ):
     def setUp( self ):
         self.GRAY1 = 60
@@ -135,6 +173,136 @@ class TileProviderTest( ut.TestCase ):
             self.assertTrue(np.all(aimg[:,:,3] == 255))
 
 
+    def testIncrementalBlending( self ):
+        rect = QRectF(100,100,200,200)
+        for layer in (self.layer1, self.layer2, self.layer3):
+            layer.visible = True
+            layer.opacity = 0.5
+        tiling = Tiling((900,400), blockSize=100)
+        tp = TileProvider(tiling, self.sims)
+        tp.requestRefresh(rect)
+        tp.waitForTiles(rect)
+
+        # Only the top layer changes, so the layers below it are not blended again.
+        for constant in (250, 20):
+            self.ds3.constant = constant
+            tp.requestRefresh(rect)
+            tp.waitForTiles(rect)
+        self.assertGreater(tp.reused_blend_layers, 0)
+
+        fresh_tp = TileProvider(tiling, self.sims)
+        fresh_tp.requestRefresh(rect)
+        fresh_tp.waitForTiles(rect)
+        for tile, fresh_tile in zip(tp.getTiles(rect), fresh_tp.getTiles(rect)):
+            self.assertTrue(np.all(byte_view(tile.qimg) == byte_view(fresh_tile.qimg)))
+
+    def testCacheMemoryLimit( self ):
+        rect = QRectF(100,100,200,200)
+        tiling = Tiling((900,400), blockSize=100)
+        tp = TileProvider(tiling, self.sims, cache_memory_limit=2**20)
+        self.assertEqual(tp.cache_memory_limit, 2**20)
+
+        tp.requestRefresh(rect)
+        tp.waitForTiles(rect)
+        used = tp.cache_memory_usage
+        self.assertTrue(0 < used <= 2**20)
+
+        hits = tp.cache_hits
+        list(tp.getTiles(rect))
+        self.assertTrue(tp.cache_hits > hits)
+
+        # Shrinking the budget evicts the least recently used tiles
+        tp.set_cache_memory_limit(used // 2)
+        self.assertTrue(0 < tp.cache_memory_usage <= used // 2)
+
+        # Evicted tiles are re-rendered when they are needed again
+        tp.waitForTiles(QRectF(100,100,100,100))
+        for tile in tp.getTiles(QRectF(100,100,100,100)):
+            aimg = byte_view(tile.qimg)
+            self.assertTrue(np.all(aimg[:,:,0:3] == self.GRAY3))
+
+    def testMetrics( self ):
+        rect = QRectF(100,100,200,200)
+        tp = TileProvider(Tiling((900,400), blockSize=100), self.sims)
+        tp.metrics.reset()
+        tp.requestRefresh(rect)
+        tp.waitForTiles(rect)
+
+        self.assertTrue(tp.metrics.counter('tilecache.hits') > 0)
+        for name in ('imagesource.wait', 'imagesource.to_qimage',
+                     'renderpool.queue_wait', 'tileprovider.blend'):
+            self.assertTrue(tp.metrics.histogram(name)['count'] > 0, name)
+
+
+class TilesCacheTest( ut.TestCase ):
+    def testGraphicsItemsDontDirtyRaster( self ):
+        stack_id = (None, ())
+        cache = _TilesCache(stack_id, None)
+        with cache:
+            cache.setTileDirty(stack_id, 0, False)
+            cache.setTileRasterDirty(stack_id, 0, False)
+
+            cache.updateTileIfNecessary(stack_id, 'items', 0, 1.0, QGraphicsRectItem())
+            self.assertTrue(cache.tileDirty(stack_id, 0))
+            self.assertFalse(cache.tileRasterDirty(stack_id, 0))
+
+            cache.updateTileIfNecessary(stack_id, 'raster', 0, 1.0, object())
+            self.assertTrue(cache.tileRasterDirty(stack_id, 0))
+
+    def testEvictedLayerIsRefetched( self ):
+        stack_id = (None, ())
+        img = QImage(10, 10, QImage.Format_ARGB32_Premultiplied)
+        cache = _TilesCache(stack_id, None, maxbytes=4*img.byteCount())
+        with cache:
+            for tile_id in (0, 1):
+                cache.updateTileIfNecessary(stack_id, 'raster', tile_id, 1.0, img)
+                cache.setTile(stack_id, tile_id, img, [], [])
+                cache.setTileDirty(stack_id, tile_id, False)
+                cache.setTileRasterDirty(stack_id, tile_id, False)
+
+            # Showing tile 0 keeps its layer; the layer of tile 1 is evicted
+            cache.tile(stack_id, 0)
+            cache.updateTileIfNecessary(stack_id, 'raster', 2, 1.0, img)
+            self.assertTrue(cache.layer(stack_id, 'raster', 0) is img)
+            self.assertTrue(cache.layer(stack_id, 'raster', 1) is None)
+            self.assertTrue(cache.layerDirty(stack_id, 'raster', 1))
+            self.assertFalse(cache.tileDirty(stack_id, 0))
+            self.assertTrue(cache.tileDirty(stack_id, 1))
+            # The old composite is shown until the layer arrives again
+            self.assertFalse(cache.tileRasterDirty(stack_id, 1))
+            self.assertTrue(cache.tile(stack_id, 1)[0] is img)
+
+class TilesCacheBenchmark( ut.TestCase ):
+    """
+    Per-tile and per-layer lookups in the _TilesCache must not
+    get slower when more layers are added to the stack.
+    """
+    N_TILES = 100
+
+    def _timeLookups( self, n_layers ):
+        stack_id = (None, ())
+        cache = _TilesCache(stack_id, None)
+        with cache:
+            for tile_id in range(self.N_TILES):
+                for ims in range(n_layers):
+                    cache.updateTileIfNecessary(stack_id, ims, tile_id, 1.0, object())
+                cache.updateTileIfNecessary(stack_id, 'items', tile_id, 1.0, QGraphicsRectItem())
+
+        start = time.time()
+        with cache:
+            for i in range(10):
+                for tile_id in range(self.N_TILES):
+                    self.assertEqual(len(cache.graphicsitem_layers(stack_id, tile_id)), 1)
+                cache.setLayerDirtyAllTiles(i)
+        return time.time() - start
+
+    def testScalingWithLayerCount( self ):
+        t_few = min(self._timeLookups(5) for _ in range(3))
+        t_many = min(self._timeLookups(100) for _ in range(3))
+        # Scanning all (layer, tile) entries would make this ~20x slower.
+        self.assertLess(t_many, 5*t_few + 1e-3)
+
+
 class DirtyPropagationTest( ut.TestCase ):
 
     def setUp( self ):
@@ -246,6 +414,277 @@ class DirtyPropagationTest( ut.TestCase ):
             # perfectly aligned with the data we changed.
             self.assertTrue(np.any(aimg[:,:,0:3] == 99))
 
+    def testRelabelingDirtiesLabelTiles( self ):
+        data = np.zeros((1, 900, 400, 10, 1), dtype=np.uint8)
+        data[0, 120:140, 120:140, :, 0] = 7
+        data[0, 800, 350, :, 0] = 99 # data range
+        source = RelabelingArraySource( data )
+        source.setRelabeling( np.arange(256, dtype=np.uint8) )
+        layer = GrayscaleLayer( source, normalize=False )
+        self.lsm.append(layer)
+        tp = TileProvider(Tiling((900,400), blockSize=100), self.pump.stackedImageSources)
+        rect = QRectF(0,0,400,400)
+        tp.requestRefresh(rect)
+        tp.waitForTiles(rect)
+
+        ims = self.pump.stackedImageSources.getImageSource(0)
+        tile_nos = tp.tiling.intersected(rect)
+        labelTile = tp.tiling.containsF(QPoint(130,130))
+        source.setRelabelingEntry(7, 50)
+        with tp._cache:
+            dirty = [tile_no for tile_no in tile_nos
+                     if tp._cache.layerDirty(tp._current_stack_id, ims, tile_no)]
+        # Only the tile that contains the label (and its overlapping neighbours)
+        self.assertIn( labelTile, dirty )
+        self.assertLessEqual( len(dirty), 4 )
+
+        tp.requestRefresh(rect)
+        tp.waitForTiles(rect)
+        for tile in tp.getTiles(QRectF(125,125,10,10)):
+            self.assertTrue( np.any(byte_view(tile.qimg)[:,:,0] == 50) )
+
+
+class PyramidTest( ut.TestCase ):
+    def setUp( self ):
+        self.data = np.zeros((1, 800, 400, 1, 1), dtype=np.uint8)
+        self.data[:, ::4, ::4] = 200 # only visible at levels 0 and 2
+        layer = GrayscaleLayer( ArraySource(self.data), normalize=False )
+        layer.opacity = 1.0
+        self.lsm = LayerStackModel()
+        self.pump = ImagePump( self.lsm, SliceProjection(), sync_along=(0,1,2) )
+        self.lsm.append(layer)
+
+    def testLevelForScale( self ):
+        tp = TileProvider( Tiling((800,400), blockSize=100), self.pump.stackedImageSources )
+        self.assertEqual( tp.levelForScale(0.1), 0 )
+        tp.setPyramid( lambda level: self.pump.pyramidLevel(level).stackedImageSources, 2 )
+        self.assertEqual( tp.levelForScale(1.0), 0 )
+        self.assertEqual( tp.levelForScale(0.5), 1 )
+        self.assertEqual( tp.levelForScale(0.3), 1 )
+        self.assertEqual( tp.levelForScale(0.1), 2 )
+
+    def testCoarseTiles( self ):
+        tiling = Tiling((800,400), blockSize=100)
+        tp = TileProvider( tiling, self.pump.stackedImageSources )
+        tp.setPyramid( lambda level: self.pump.pyramidLevel(level).stackedImageSources, 2 )
+
+        rect = QRectF(0,0,800,400)
+        level_tp = tp._levelProvider(2)
+        list(tp.getTiles(rect, scale=0.25))
+        level_tp.waitForTiles(rect)
+        tiles = list(tp.getTiles(rect, scale=0.25))
+
+        # 2x1 tiles of 100x100 pixels instead of 8x4 tiles of 400x400 pixels
+        self.assertEqual( len(tiles), 2 )
+        for tile in tiles:
+            self.assertEqual( tile.rectF.width(), 400 )
+            self.assertEqual( (tile.qimg.width(), tile.qimg.height()), (100, 100) )
+            aimg = byte_view(tile.qimg)
+            self.assertTrue( np.all(aimg[:,:,0:3] == 200) )
+
+        # The levels are cached separately
+        self.assertEqual( tp._cache.usedBytes, 0 )
+        self.assertTrue( level_tp.cache_memory_usage > 0 )
+        self.assertEqual( tp.cache_memory_usage, level_tp.cache_memory_usage )
+
+        # Navigating in the full-resolution pump also moves the coarser levels.
+        self.pump.syncedSliceSources.through = [0,0,0]
+        self.assertEqual( self.pump.pyramidLevel(2).syncedSliceSources.through, [0,0,0] )
+
+    def testLevelsShareBudget( self ):
+        diskCache = DiskTileCache()
+        tp = TileProvider( Tiling((800,400), blockSize=100), self.pump.stackedImageSources,
+                           cache_memory_limit=3*2**20, disk_cache=diskCache )
+        tp.setPyramid( lambda level: self.pump.pyramidLevel(level).stackedImageSources, 2 )
+        self.assertEqual( tp._cache.maxbytes, 3*2**20 )
+
+        level_tps = [ tp._levelProvider(1), tp._levelProvider(2) ]
+        self.assertEqual( tp.cache_memory_limit, 3*2**20 )
+        self.assertEqual( tp._cache.maxbytes, 2**20 )
+        for level_tp in level_tps:
+            self.assertEqual( level_tp.cache_memory_limit, 2**20 )
+            self.assertTrue( level_tp.disk_cache is diskCache )
+
+        tp.set_cache_memory_limit(None)
+        for level_tp in level_tps:
+            self.assertEqual( level_tp.cache_memory_limit, None )
+
+        # Without a disk cache, the levels don't create their own
+        tp = TileProvider( Tiling((800,400), blockSize=100), self.pump.stackedImageSources, disk_cache=False )
+        tp.setPyramid( lambda level: self.pump.pyramidLevel(level).stackedImageSources, 2 )
+        self.assertTrue( tp.disk_cache is None )
+        self.assertTrue( tp._levelProvider(1).disk_cache is None )
+        shutil.rmtree(diskCache.directory, True)
+
+class BlockingConstantSource( ConstantSource ):
+    """
+    A ConstantSource whose requests don't finish before release() is called.
+    """
+    def __init__( self, *args, **kwargs ):
+        super(BlockingConstantSource, self).__init__(*args, **kwargs)
+        self._released = threading.Event()
+        self.submitted = []
+
+    def release( self ):
+        self._released.set()
+
+    def request( self, slicing, through=None ):
+        released = self._released
+        submitted = self.submitted
+        class BlockingRequest( ConstantRequest ):
+            def wait( self ):
+                released.wait(10.0)
+                return self._result
+            def submit( self ):
+                submitted.append(self)
+        return BlockingRequest( super(BlockingConstantSource, self).request(slicing, through).wait() )
+
+class PendingFetchesTest( ut.TestCase ):
+    def setUp( self ):
+        self.ds = BlockingConstantSource( 42 )
+        layer = GrayscaleLayer( self.ds, normalize=False )
+        lsm = LayerStackModel()
+        self.pump = ImagePump( lsm, SliceProjection(), sync_along=(0,1,2) )
+        lsm.append(layer)
+        self.tiling = Tiling((900,400), blockSize=100)
+
+    def tearDown( self ):
+        self.ds.release()
+
+    def testCoalesceIdenticalRequests( self ):
+        tp = TileProvider(self.tiling, self.pump.stackedImageSources)
+        rect = QRectF(100,100,200,200)
+        n_tiles = len(self.tiling.intersected(rect))
+
+        # Prefetching the next plane, then showing it
+        tp.prefetch(rect, (0,1,0))
+        self.pump.syncedSliceSources.through = [0,1,0]
+        tp.requestRefresh(rect)
+        self.assertEqual(tp.coalesced_requests, n_tiles)
+
+        # Dirty tiles are refreshed again, while their layers are still being fetched
+        tp.requestRefresh(rect)
+        self.assertEqual(tp.coalesced_requests, n_tiles)
+        with tp._cache:
+            for tile_no in self.tiling.intersected(rect):
+                tp._cache.setTileDirty(tp._current_stack_id, tile_no, True)
+        tp.requestRefresh(rect)
+        self.assertEqual(tp.coalesced_requests, 2*n_tiles)
+
+        self.ds.release()
+        tp.waitForTiles(rect)
+        for tile in tp.getTiles(rect):
+            aimg = byte_view(tile.qimg)
+            self.assertTrue(np.all(aimg[:,:,0:3] == 42))
+
+    def testSizeChangedCancelsPendingFetches( self ):
+        tp = TileProvider(self.tiling, self.pump.stackedImageSources)
+        rect = QRectF(100,100,200,200)
+        n_tiles = len(self.tiling.intersected(rect))
+        tp.requestRefresh(rect)
+        self.pump.stackedImageSources.sizeChanged.emit()
+        self.assertEqual(tp.cancelled_requests, n_tiles)
+
+        # The tiles of the new cache are requested anew
+        tp.requestRefresh(rect)
+        self.assertEqual(tp.coalesced_requests, 0)
+        self.ds.release()
+        self.assertTrue( tp.waitForTiles(rect, timeout=5.0) )
+        for tile in tp.getTiles(rect):
+            aimg = byte_view(tile.qimg)
+            self.assertTrue(np.all(aimg[:,:,0:3] == 42))
+
+    def testDiskCacheHitIsNotRequested( self ):
+        class HitDiskCache( object ):
+            def get( self, ims, stack_id, tile_no ):
+                img = QImage(100, 100, QImage.Format_ARGB32_Premultiplied)
+                img.fill(0xff070707)
+                return img
+            def put( self, *args ): pass
+            def invalidate( self, *args ): pass
+            def clear( self ): pass
+            def close( self ): pass
+
+        tp = TileProvider(self.tiling, self.pump.stackedImageSources, disk_cache=HitDiskCache())
+        rect = QRectF(100,100,200,200)
+        tp.requestRefresh(rect)
+        # The requests are not started (the data is neither read nor computed)
+        self.assertTrue( tp.waitForTiles(rect, timeout=5.0) )
+        self.assertEqual( len(self.ds.submitted), 0 )
+
+    def testWaitForTilesSleeps( self ):
+        tp = TileProvider(self.tiling, self.pump.stackedImageSources)
+        rect = QRectF(100,100,200,200)
+        n_tiles = len(self.tiling.intersected(rect))
+        refreshes = []
+        getTiles = tp._getTiles
+        def countingGetTiles( rectF ):
+            refreshes.append(rectF)
+            return getTiles(rectF)
+        tp._getTiles = countingGetTiles
+
+        self.assertFalse( tp.waitForTiles(rect, timeout=0.2) )
+        self.assertTrue( len(refreshes) <= 3 )
+
+        # The tiles are only refreshed when a layer tile arrived
+        del refreshes[:]
+        threading.Timer(0.2, self.ds.release).start()
+        self.assertTrue( tp.waitForTiles(rect) )
+        self.assertTrue( len(refreshes) <= n_tiles + 2 )
+        for tile in tp.getTiles(rect):
+            self.assertEqual( tile.progress, 1.0 )
+
+    def testCenterOutPriorities( self ):
+        submitted = []
+        class Task( object ):
+            def cancel( self ):
+                return True
+        def submit( fn, priority, ims=None ):
+            submitted.append( (priority, fn.args[3]) ) # tile_no
+            return Task()
+
+        tp = TileProvider(self.tiling, self.pump.stackedImageSources)
+        rect = QRectF(0,0,300,300)
+        center = self.tiling.intersected(QRectF(140,140,20,20))[0]
+        corner = self.tiling.intersected(QRectF(240,240,20,20))[0]
+        submit_to_threadpool = volumina.tiling.submit_to_threadpool
+        volumina.tiling.submit_to_threadpool = submit
+        try:
+            tp.setViewport(rect)
+            tp.requestRefresh(rect)
+            self.assertEqual( len(submitted), 9 )
+            self.assertEqual( min(submitted)[1], center )
+
+            # Looking elsewhere re-prioritizes the pending fetches
+            del submitted[:]
+            tp.setViewport(rect, QPointF(250,250))
+            self.assertEqual( len(submitted), 9 )
+            self.assertEqual( min(submitted)[1], corner )
+        finally:
+            volumina.tiling.submit_to_threadpool = submit_to_threadpool
+
+    def testCancelOnStackChange( self ):
+        ds, pump, tiling = self.ds, self.pump, self.tiling
+        tp = TileProvider(tiling, pump.stackedImageSources)
+        rect = QRectF(100,100,200,200)
+        n_tiles = len(tiling.intersected(rect))
+
+        tp.requestRefresh(rect)
+        self.assertEqual(tp.cancelled_requests, 0)
+
+        # Moving to another plane cancels the requests of the old plane.
+        pump.syncedSliceSources.through = [0,1,0]
+        self.assertEqual(tp.cancelled_requests, n_tiles)
+        ds.release()
+
+        # The tiles of the old plane are requested again when we come back.
+        pump.syncedSliceSources.through = [0,0,0]
+        tp.requestRefresh(rect)
+        tp.waitForTiles(rect)
+        for tile in tp.getTiles(rect):
+            aimg = byte_view(tile.qimg)
+            self.assertTrue(np.all(aimg[:,:,0:3] == 42))
+
 
 if __name__=='__main__':
     ut.main()
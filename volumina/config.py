@@ -25,6 +25,22 @@ import io, os
 default_config = """
 [pixelpipeline]
 verbose: false
+tile_cache_memory_mb: 1024
+max_pyramid_level: 0
+tile_disk_cache_mb: 0
+tile_disk_cache_dir:
+hdf5_chunk_cache_mb: 256
+datasource_block_cache_mb: 256
+array_io_threads: 4
+minmax_sampled: false
+minmax_dirty_interval_ms: 500
+render_threads: 6
+render_threads_autotune: false
+render_threads_max: 16
+render_threads_per_layer: -1
+conversion_processes: 0
+conversion_layers: grayscale, alphamodulated, colortable, rgba
+conversion_slot_mb: 4
 """
 
 cfg = ConfigParser.SafeConfigParser()
@@ -0,0 +1,280 @@
+###############################################################################
+#   volumina: volume slicing and editing library
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+#		   http://ilastik.org/license/
+###############################################################################
+import os
+import sys
+import time
+import zlib
+import atexit
+import shutil
+import tempfile
+import weakref
+import itertools
+import threading
+import cPickle as pickle
+from collections import defaultdict, OrderedDict
+
+import numpy
+from PyQt4.QtGui import QImage
+from qimage2ndarray import byte_view
+
+from volumina.utility import PrioritizedThreadPoolExecutor
+
+import logging
+logger = logging.getLogger(__name__)
+
+class DiskTileCache( object ):
+    """
+    A second-tier cache for layer tiles, which is used by the TileProvider:
+    layer tiles (QImages) that are evicted from the in-memory tile cache are
+    compressed and written to a local directory, from where they can be read back
+    much faster than recomputing them.
+
+    Entries are keyed by (layer id, stack_id, tile_no, generation).
+    The generation of a layer (or of a single tile of a layer) is increased by
+    invalidate(), so that outdated entries can never be found again,
+    even if they are still being written.  The layers themselves are only
+    referenced weakly: the entries of a deleted layer are never found again,
+    and are evicted eventually.
+
+    Any object with the methods put(), get(), invalidate(), clear() and close()
+    can be used as disk cache of a TileProvider.
+    """
+    def __init__(self, directory=None, maxbytes=None, compression=1):
+        """
+        directory   -- the directory in which a (temporary) cache directory is created
+                       (default: the system's temp directory)
+        maxbytes    -- maximal number of bytes occupied by the files of the cache
+                       (default: unlimited)
+        compression -- zlib compression level (default: 1, i.e. fast)
+        """
+        self._dir = tempfile.mkdtemp(prefix='volumina-tiles-', dir=directory or None)
+        atexit.register(shutil.rmtree, self._dir, True)
+        self._maxbytes = maxbytes
+        self._compression = compression
+
+        self._lock = threading.Lock()
+        # [(ims, stack_id, tile_no, generation)] -> (filename, nbytes), in least-recently-used order
+        self._entries = OrderedDict()
+        self._usedBytes = 0
+        # ims -> layer id (never reused)
+        self._layerIds = weakref.WeakKeyDictionary()
+        self._nextLayerIds = itertools.count()
+        # layer id -> set of keys, to invalidate all entries of a layer
+        self._layerKeys = defaultdict(set)
+        # clear() increases the generation of all tiles,
+        # invalidate() the generation of a layer, or of single tiles of a layer:
+        # int, ims -> int and ims -> {tile_no: int}
+        self._generation = 0
+        self._layerGeneration = weakref.WeakKeyDictionary()
+        self._tileGeneration = weakref.WeakKeyDictionary()
+        self._fileIds = itertools.count()
+        self._closed = False
+
+        # Tiles are written by a single background thread, in FIFO order.
+        self._writer = PrioritizedThreadPoolExecutor(1)
+
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def directory(self):
+        return self._dir
+
+    @property
+    def maxbytes(self):
+        return self._maxbytes
+
+    @property
+    def usedBytes(self):
+        return self._usedBytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _key(self, ims, stack_id, tile_no):
+        layerId = self._layerIds.get(ims)
+        if layerId is None:
+            layerId = self._layerIds[ims] = next(self._nextLayerIds)
+        generation = ( self._generation,
+                       self._layerGeneration.get(ims, 0),
+                       self._tileGeneration.get(ims, {}).get(tile_no, 0) )
+        return (layerId, stack_id, tile_no, generation)
+
+    def put(self, ims, stack_id, tile_no, img):
+        """
+        Write the given layer tile (a QImage) to the cache.
+        Returns immediately; the tile is compressed and written in the background.
+        """
+        with self._lock:
+            if self._closed:
+                return None
+            key = self._key(ims, stack_id, tile_no)
+            if key in self._entries:
+                self._touch(key)
+                return None
+            layer = weakref.ref(ims)
+            return self._writer.submit( lambda: self._write(layer, key, img), time.time() )
+
+    def get(self, ims, stack_id, tile_no):
+        """
+        Read the given layer tile from the cache.
+        Returns a QImage, or None if the tile is not (or no longer) cached.
+        """
+        with self._lock:
+            if self._closed:
+                return None
+            key = self._key(ims, stack_id, tile_no)
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._touch(key)
+
+        try:
+            with open(entry[0], 'rb') as f:
+                img = _loads(f.read())
+        except (IOError, EOFError):
+            # The file was removed in the meantime
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return img
+
+    def flush(self):
+        """
+        Block until all tiles that were passed to put() are written.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            f = self._writer.submit( lambda: None, time.time() )
+        f.result()
+
+    def invalidate(self, ims, tile_nos=None):
+        """
+        Drop the cached tiles of the given layer (all tiles, if tile_nos is None)
+        in all stacks, because its data has changed.
+        """
+        with self._lock:
+            layerId = self._layerIds.get(ims)
+            if layerId is None:
+                # Nothing was cached for this layer.
+                return
+            if tile_nos is None:
+                self._layerGeneration[ims] = self._layerGeneration.get(ims, 0) + 1
+                self._tileGeneration.pop(ims, None)
+                keys = self._layerKeys.pop(layerId, ())
+            else:
+                tile_nos = set(tile_nos)
+                tiles = self._tileGeneration.setdefault(ims, {})
+                for tile_no in tile_nos:
+                    tiles[tile_no] = tiles.get(tile_no, 0) + 1
+                keys = [key for key in self._layerKeys.get(layerId, ()) if key[2] in tile_nos]
+            for key in list(keys):
+                self._remove(key)
+
+    def clear(self):
+        """
+        Drop all cached tiles, e.g. because the tiling has changed.
+        """
+        with self._lock:
+            self._generation += 1
+            self._layerGeneration.clear()
+            self._tileGeneration.clear()
+            for key in list(self._entries):
+                self._remove(key)
+
+    def close(self):
+        """
+        Wait for the pending writes, stop the writer thread and remove the
+        cache directory.  The cache is empty (and stays empty) afterwards.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._writer.shutdown(wait=True)
+        with self._lock:
+            for key in list(self._entries):
+                self._remove(key)
+        shutil.rmtree(self._dir, True)
+
+    def _write(self, layer, key, img):
+        try:
+            data = _dumps(img, self._compression)
+            filename = os.path.join(self._dir, '%08d.tile' % next(self._fileIds))
+            with open(filename, 'wb') as f:
+                f.write(data)
+        except BaseException:
+            sys.excepthook( *sys.exc_info() )
+            return
+
+        with self._lock:
+            ims = layer()
+            if self._closed or ims is None or key != self._key(ims, *key[1:3]) or key in self._entries:
+                # The layer became dirty (or was deleted) while the tile was written.
+                _unlink(filename)
+                return
+            self._entries[key] = (filename, len(data))
+            self._layerKeys[key[0]].add(key)
+            self._usedBytes += len(data)
+            self._evictIfNecessary()
+
+    def _touch(self, key):
+        self._entries[key] = self._entries.pop(key)
+
+    def _remove(self, key):
+        filename, nbytes = self._entries.pop(key)
+        self._usedBytes -= nbytes
+        keys = self._layerKeys.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._layerKeys[key[0]]
+        _unlink(filename)
+
+    def _evictIfNecessary(self):
+        if self._maxbytes is None:
+            return
+        while self._usedBytes > self._maxbytes and self._entries:
+            self._remove( next(iter(self._entries)) ) # least recently used first
+
+def _dumps(img, compression):
+    view = byte_view(img)
+    header = (img.width(), img.height(), int(img.format()), list(img.colorTable()), view.shape)
+    return pickle.dumps( (header, zlib.compress(view.tostring(), compression)), pickle.HIGHEST_PROTOCOL )
+
+def _loads(data):
+    (width, height, fmt, colorTable, shape), compressed = pickle.loads(data)
+    img = QImage(width, height, QImage.Format(fmt))
+    if colorTable:
+        img.setColorTable(colorTable)
+    byte_view(img)[...] = numpy.frombuffer(zlib.decompress(compressed), dtype=numpy.uint8).reshape(shape)
+    return img
+
+def _unlink(filename):
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
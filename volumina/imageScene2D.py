@@ -29,6 +29,9 @@ from PyQt4.QtGui import QGraphicsScene, QTransform, QPen, QColor, QBrush, QPolyg
 from volumina.tiling import Tiling, TileProvider
 from volumina.layerstack import LayerStackModel
 from volumina.pixelpipeline.imagepump import StackedImageSources
+from volumina.config import cfg
+from volumina.utility import metrics
+from volumina.utility.pipelineMetrics import COUNT_BOUNDS
 
 import datetime
 import threading
@@ -283,6 +286,33 @@ class ImageScene2D(QGraphicsScene):
     def cacheSize(self):
         return self._tileProvider.cache_size
 
+    def setCacheMemoryLimit(self, nbytes):
+        self._tileProvider.set_cache_memory_limit(nbytes)
+
+    def cacheMemoryLimit(self):
+        return self._tileProvider.cache_memory_limit
+
+    def pipelineMetrics(self):
+        """
+        Timings and counters of the pixel pipeline (shared by all views),
+        e.g. pipelineMetrics().dump('metrics.json')
+        """
+        return self._tileProvider.metrics
+
+    def setPyramid(self, pyramid, maxLevel=None):
+        """
+        Render zoomed-out views from coarser levels of an image pyramid.
+
+        pyramid  -- callable: level -> StackedImageSources of the data downsampled
+                    by 2**level, e.g. lambda level: pump.pyramidLevel(level).stackedImageSources
+        maxLevel -- coarsest level to use (default: 'max_pyramid_level' from volumina.config)
+        """
+        if maxLevel is None:
+            maxLevel = cfg.getint('pixelpipeline', 'max_pyramid_level')
+        self._pyramid = pyramid
+        self._maxPyramidLevel = maxLevel
+        self._tileProvider.setPyramid(pyramid, maxLevel)
+
     def setPrefetchingEnabled(self, enable):
         self._prefetching_enabled = enable
 
@@ -315,7 +345,11 @@ class ImageScene2D(QGraphicsScene):
 
         self._tiling = Tiling(self._dataShape, self.data2scene, name=self.name, blockSize=tileWidth)
 
+        if self._tileProvider is not None:
+            self._tileProvider.sceneRectChanged.disconnect(self.invalidateViewports)
+            self._tileProvider.close()
         self._tileProvider = TileProvider(self._tiling, self._stackedImageSources)
+        self._tileProvider.setPyramid(self._pyramid, self._maxPyramidLevel)
         self._tileProvider.sceneRectChanged.connect(self.invalidateViewports)
 
         if self._dirtyIndicator:
@@ -400,6 +434,8 @@ class ImageScene2D(QGraphicsScene):
         self._tileProvider = None
         self._dirtyIndicator = None
         self._prefetching_enabled = False
+        self._pyramid = None
+        self._maxPyramidLevel = 0
         
         self._swappedDefault = swapped_default
         self.reset()
@@ -467,10 +503,23 @@ class ImageScene2D(QGraphicsScene):
 
         if not sceneRectF.isValid():
             return
+
+        # When zoomed out, the tiles may come from a coarser level of the image pyramid.
+        scale = 1.0
+        if self.views():
+            t = self.views()[0].transform()
+            scale = math.sqrt(t.m11()**2 + t.m12()**2)
+        level = self._tileProvider.levelForScale(scale)
+
+        # Fetch the tiles in the center of the view first
+        if self.views():
+            self._tileProvider.setViewport(self.views()[0].viewportRect())
             
-        tiles = self._tileProvider.getTiles(sceneRectF)
+        tiles = self._tileProvider.getTiles(sceneRectF, scale)
         allComplete = True
+        tileCount = 0
         for tile in tiles:
+            tileCount += 1
             #We always draw the tile, even though it might not be up-to-date
             #In ilastik's live mode, the user sees the old result while adding
             #new brush strokes on top
@@ -478,6 +527,14 @@ class ImageScene2D(QGraphicsScene):
             if tile.qimg is not None:
                 painter.drawImage(tile.rectF, tile.qimg)
 
+            if tile.progress < 1.0:
+                allComplete = False
+
+            if level > 0:
+                # The tile ids of coarser levels don't refer to our tiling,
+                # and QGraphicsItem layers are only shown at full resolution.
+                continue
+
             # The tile also contains a list of any QGraphicsItems that were produced by the layers.
             # If there are any new ones, add them to the scene.
             new_items = set(tile.qgraphicsitems) - self.tile_graphicsitems[tile.id]
@@ -489,11 +546,11 @@ class ImageScene2D(QGraphicsScene):
                 self.tile_graphicsitems[tile.id].add(g_item)
                 self.addItem(g_item)
 
-            if tile.progress < 1.0:
-                allComplete = False
             if self._showTileProgress:
                 self._dirtyIndicator.setTileProgress(tile.id, tile.progress)
 
+        metrics.observe('scene.tiles_per_frame', tileCount, COUNT_BOUNDS)
+
         if allComplete:
             if self.dirty:
                 self.dirty = False
@@ -509,7 +566,7 @@ class ImageScene2D(QGraphicsScene):
         if self._prefetching_enabled:
             upcoming_through_slices = self._bowWave(self._n_preemptive)
             for through in upcoming_through_slices:
-                self._tileProvider.prefetch(sceneRectF, through, layer_indexes=None)
+                self._tileProvider.prefetch(sceneRectF, through, layer_indexes=None, scale=scale)
 
     def triggerPrefetch(self, layer_indexes, time_range='current', spatial_axis_range='current', sceneRectF=None ):
         """
@@ -599,20 +656,37 @@ class ImageScene2D(QGraphicsScene):
 
     def _onSlicingPositionChanged(self, new, old):
         if (new[self._along[1] - 1] - old[self._along[1] - 1]) < 0:
-            self._course = (1, -1)
+            self._setCourse((1, -1))
         else:
-            self._course = (1, 1)
+            self._setCourse((1, 1))
 
     def _onChannelChanged(self, new):
         if (new - self._channel) < 0:
-            self._course = (2, -1)
+            self._setCourse((2, -1))
         else:
-            self._course = (2, 1)
+            self._setCourse((2, 1))
         self._channel = new
 
     def _onTimeChanged(self, new):
         if (new - self._time) < 0:
-            self._course = (0, -1)
+            self._setCourse((0, -1))
         else:
-            self._course = (0, 1)
+            self._setCourse((0, 1))
         self._time = new
+
+    def _setCourse(self, course):
+        """
+        Set the direction of travel, and tell it to the datasources of all
+        layers that read ahead (i.e. have a setCourse() method), including
+        those wrapped by other datasources.
+        """
+        self._course = course
+        if self._stackedImageSources is None:
+            return
+        axis = self._along[course[0]]
+        for layer in self._stackedImageSources._layerStackModel:
+            for datasource in layer.datasources:
+                while datasource is not None:
+                    if hasattr(datasource, 'setCourse'):
+                        datasource.setCourse(axis, course[1])
+                    datasource = getattr(datasource, '_rawSource', None)
@@ -0,0 +1,176 @@
+###############################################################################
+#   volumina: volume slicing and editing library
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+#		   http://ilastik.org/license/
+###############################################################################
+import sys
+import threading
+from collections import deque
+
+from concurrent.futures import ThreadPoolExecutor, wait
+from PyQt4.QtCore import QRect
+from PyQt4.QtGui import QImage, QGraphicsItem
+
+from volumina.tiling import paint_patches, LAYER_IMAGE_TRANSFORM
+from volumina.pixelpipeline.imagepump import ImagePump
+from volumina.pixelpipeline.asyncabcs import IndeterminateRequestError
+from volumina.utility import metrics
+
+import logging
+logger = logging.getLogger(__name__)
+
+class OffscreenRenderer( object ):
+    """
+    Renders slices of the layers of a LayerStackModel into images, the same
+    way as they are shown in a view, but without a view: e.g. for exporting
+    movies, or from scripts.
+
+    The renderer has its own ImagePump over the layer stack, from which the
+    layer images of arbitrary frames (slicing positions) are requested
+    without changing the position of any view.  The layer images are
+    waited for and blended in a pool of worker threads, so that several
+    frames are in flight at the same time, and files are written by the
+    same workers.
+
+    Layers that produce QGraphicsItems (e.g. segmentation edges) are not rendered.
+    """
+    def __init__( self, layerStackModel, sliceProjection, n_frames=4 ):
+        """
+        sliceProjection -- the slicing of the data: its abscissa and ordinate
+                           become the x and y axes of the rendered images
+        n_frames        -- the number of frames that are rendered at the same time
+        """
+        self._projection = sliceProjection
+        self._pump = ImagePump( layerStackModel, sliceProjection, sync_along=range(len(sliceProjection.along)) )
+        self._n_frames = n_frames
+        self._executor = ThreadPoolExecutor(n_frames)
+        self._cancelled = threading.Event()
+        self._closed = False
+
+    @property
+    def stackedImageSources( self ):
+        return self._pump.stackedImageSources
+
+    def render( self, pos5D, rect ):
+        """
+        Render the given rect (a QRect in the coordinates of the abscissa and
+        ordinate) of the slice through the 5D position pos5D.
+        Returns a future of the image (QImage).
+        """
+        return self._executor.submit( self._composite, QRect(rect).size(), self._requests(pos5D, rect) )
+
+    def export( self, frames, progress=None, format=QImage.Format_RGB32 ):
+        """
+        Render the given frames (pos5D, rect, filename) and save them as
+        image files (in the format given by the file extension), with up to
+        n_frames frames in flight.  Blocks until all files are written, or
+        until the export is cancelled.
+        progress -- optional callable, called with the number of files written so far
+        format   -- the QImage format the frames are converted to before saving
+        """
+        for written in self.exportSteps(frames, format=format):
+            if progress is not None:
+                progress(written)
+
+    def exportSteps( self, frames, timeout=None, format=QImage.Format_RGB32 ):
+        """
+        A generator that exports the given frames (see export()) step by step:
+        it yields the number of files written so far, whenever a file is
+        written, or when nothing was written for timeout seconds (if given).
+        This allows to drive an export from the GUI thread, e.g. by a timer.
+        """
+        self._cancelled.clear()
+        frames = iter(frames)
+        pending = deque()
+        written = 0
+        try:
+            while not self._cancelled.is_set():
+                while len(pending) < self._n_frames:
+                    try:
+                        pos5D, rect, filename = next(frames)
+                    except StopIteration:
+                        break
+                    pending.append( self._executor.submit( self._save, QRect(rect).size(),
+                                                           self._requests(pos5D, rect), filename, format ) )
+                if not pending:
+                    return
+                done, _ = wait( [pending[0]], timeout )
+                if done:
+                    pending.popleft().result()
+                    written += 1
+                yield written
+        finally:
+            # Cancelled, or the generator was closed
+            for future in pending:
+                future.cancel()
+
+    def cancel( self ):
+        """
+        Stop a running export (after the frames in flight).
+        """
+        self._cancelled.set()
+
+    def shutdown( self ):
+        self.cancel()
+        self._executor.shutdown(wait=True)
+        if not self._closed:
+            # Stop following the layer stack
+            self._pump.close()
+            self._closed = True
+
+    def hasItemLayers( self ):
+        """
+        Whether a visible layer produces QGraphicsItems, which are not rendered.
+        """
+        return any( visible and issubclass(ims.image_type(), QGraphicsItem)
+                    for visible, opacity, ims in self._pump.stackedImageSources )
+
+    def _requests( self, pos5D, rect ):
+        """
+        The requests of the visible layer images of a frame, with their
+        opacities, from bottom to top.
+        """
+        along_through = [ (i, pos5D[axis]) for i, axis in enumerate(self._projection.along) ]
+        # The layer requests are created right now, so that later changes
+        # to the layers don't affect the frame.
+        requests = []
+        for visible, opacity, ims in reversed(self._pump.stackedImageSources):
+            if not visible or opacity == 0.0 or issubclass(ims.image_type(), QGraphicsItem):
+                continue
+            try:
+                requests.append( (ims.request(QRect(rect), along_through), opacity) )
+            except IndeterminateRequestError:
+                # The layer is not ready (see TileProvider._refreshTile())
+                sys.excepthook( *sys.exc_info() )
+        return requests
+
+    def _save( self, size, requests, filename, format ):
+        img = self._composite(size, requests).convertToFormat(format)
+        with metrics.timer('offscreenrenderer.save'):
+            if not img.save(filename):
+                raise IOError("Could not write image file: {}".format(filename))
+        return filename
+
+    def _composite( self, size, requests ):
+        with metrics.timer('offscreenrenderer.frame'):
+            patches = []
+            for req, opacity in requests:
+                img = req.wait()
+                patches.append( (img.transformed(LAYER_IMAGE_TRANSFORM), opacity) )
+            return paint_patches( size, None, patches )
@@ -31,6 +31,10 @@ import numpy
 class PatchAccessor():
     """
     Cut a given 2D shape into patches of given rectangular size
+
+    The patch bounds are kept in NumPy arrays (one entry per patch column 
+    and row), so that the geometry of all patches can be computed at once
+    (see patchBounds()) and a patch can be looked up by position in O(1).
     """
 
     def __init__(self, size_x, size_y, blockSize = 128):
@@ -46,7 +50,7 @@ class PatchAccessor():
         self.size_x = size_x
         self.size_y = size_y
 
-        self._cX = int(numpy.ceil(1.0 * size_x / self._blockSize))
+        self._cX = -(-size_x // self._blockSize)
 
         #last blocks can be very small -> merge them with the secondlast one
         self._cXend = size_x % self._blockSize
@@ -55,7 +59,7 @@ class PatchAccessor():
         else:
             self._cXend = 0
 
-        self._cY = int(numpy.ceil(1.0 * size_y / self._blockSize))
+        self._cY = -(-size_y // self._blockSize)
 
         #last blocks can be very small -> merge them with the secondlast one
         self._cYend = size_y % self._blockSize
@@ -64,16 +68,24 @@ class PatchAccessor():
         else:
             self._cYend = 0
 
-
         self.patchCount = self._cX * self._cY
 
+        # Bounds of the patch columns and rows (without overlap)
+        self._xStarts = numpy.arange(self._cX) * self._blockSize
+        self._xStops = numpy.minimum(self._xStarts + self._blockSize, self.size_x)
+        self._yStarts = numpy.arange(self._cY) * self._blockSize
+        self._yStops = numpy.minimum(self._yStarts + self._blockSize, self.size_y)
+        if self._cX > 0:
+            self._xStops[-1] = self.size_x
+        if self._cY > 0:
+            self._yStops[-1] = self.size_y
+
     def __len__(self):
         return self.patchCount
 
     def getPatchBounds(self, blockNum, overlap = 0):
         rest = blockNum % (self._cX*self._cY)
-        y = int(numpy.floor(rest / self._cX))
-        x = rest % self._cX
+        y, x = divmod(rest, self._cX)
 
         startx = max(0, x*self._blockSize - overlap)
         endx = min(self.size_x, (x+1)*self._blockSize + overlap)
@@ -87,6 +99,24 @@ class PatchAccessor():
 
         return [startx,endx,starty,endy]
 
+    def patchBounds(self, overlap = 0):
+        """
+        Like getPatchBounds(), but for all patches at once.
+        Returns four arrays (startx, endx, starty, endy), indexed by patch number.
+        """
+        startx = numpy.maximum(0, self._xStarts - overlap)
+        endx = numpy.minimum(self.size_x, self._xStops + overlap)
+        starty = numpy.maximum(0, self._yStarts - overlap)
+        endy = numpy.minimum(self.size_y, self._yStops + overlap)
+        if self._cX > 0:
+            endx[-1] = self.size_x
+        if self._cY > 0:
+            endy[-1] = self.size_y
+
+        # patch number = y*cX + x
+        return ( numpy.tile(startx, self._cY), numpy.tile(endx, self._cY),
+                 numpy.repeat(starty, self._cX), numpy.repeat(endy, self._cX) )
+
     def patchRectF(self, blockNum, overlap = 0):
         startx,endx,starty,endy = self.getPatchBounds(blockNum, overlap)
         return QRectF(QPointF(startx, starty), QPointF(endx,endy))
@@ -103,10 +133,21 @@ class PatchAccessor():
         ex = min(ex, self._cX)
         ey = min(ey, self._cY)
 
-        nums = []
-        for y in range(sy,ey):
-            nums += range(y*self._cX+sx, y*self._cX+ex)
-        return nums
+        if sx >= ex or sy >= ey:
+            return []
+        nums = numpy.arange(sy, ey)[:, numpy.newaxis] * self._cX + numpy.arange(sx, ex)
+        return nums.ravel().tolist()
+
+    def getPatchAt(self, x, y):
+        """
+        Return the number of the patch that contains the point (x, y), 
+        or None if the point is outside of the shape.
+        """
+        if not (0 <= x < self.size_x and 0 <= y < self.size_y) or self.patchCount == 0:
+            return None
+        col = min(int(x // self._blockSize), self._cX - 1)
+        row = min(int(y // self._blockSize), self._cY - 1)
+        return row * self._cX + col
 
 if __name__ == "__main__":
     pa = PatchAccessor(1000,1000, 100)
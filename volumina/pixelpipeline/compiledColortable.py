@@ -0,0 +1,143 @@
+###############################################################################
+#   volumina: volume slicing and editing library
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+#		   http://ilastik.org/license/
+###############################################################################
+"""
+Colortables in the form that is applied to image data, shared by all
+image sources with the same colors.
+"""
+import threading
+import weakref
+import numpy as np
+from PyQt4.QtGui import QColor
+
+import numpyKernels
+
+class CompiledColortable( object ):
+    """
+    An immutable colortable: an Nx4 uint8 array of BGRA colors (the memory
+    layout of a QImage with Format_ARGB32), together with the lookup tables
+    of the 8-bit and 16-bit integer dtypes.
+
+    Use compileColortable() to get the shared instance for a list of colors.
+    """
+    def __init__( self, colors ):
+        colors = np.array(colors, dtype=np.uint8).reshape(-1, 4)
+        colors.flags.writeable = False
+        self._colors = colors
+        self._key = colors.tostring()
+        self._hash = hash(self._key)
+        self._lock = threading.Lock()
+        self._lookupTables = {}
+        self._variants = {}
+
+    @property
+    def colors( self ):
+        return self._colors
+
+    def __len__( self ):
+        return len(self._colors)
+
+    def __hash__( self ):
+        return self._hash
+
+    def __eq__( self, other ):
+        return isinstance(other, CompiledColortable) and self._key == other._key
+
+    def __ne__( self, other ):
+        return not ( self == other )
+
+    def lookupTable( self, dtype ):
+        """
+        The color (BGRA uint32) of every possible value of the given 8-bit or
+        16-bit integer dtype, indexed by its bit pattern (as unsigned).
+        Values are taken modulo the length of the table.
+        """
+        dtype = np.dtype(dtype)
+        assert numpyKernels.hasLookupTable(dtype)
+        with self._lock:
+            table = self._lookupTables.get(dtype.str)
+            if table is None:
+                bits = np.arange( 2**(8*dtype.itemsize), dtype=np.dtype('u%d' % dtype.itemsize) )
+                values = bits.view(dtype)
+                table = np.take( self._colors.view(np.uint32).reshape(-1), values, mode='wrap' )
+                table.flags.writeable = False
+                self._lookupTables[dtype.str] = table
+            return table
+
+    def apply( self, a, out ):
+        """
+        Write the colors of the 2D integer array a into out (the byte_view
+        of a QImage with Format_ARGB32), without converting a to another dtype.
+        """
+        if numpyKernels.hasLookupTable(a.dtype):
+            numpyKernels.applyLookupTable(a, self.lookupTable(a.dtype), out)
+        else:
+            numpyKernels.applyColortable(a, self._colors, out)
+
+    def withTransparentZero( self ):
+        """
+        This colortable, with the first color replaced by transparent.
+        """
+        def create():
+            colors = self._colors.copy()
+            colors[0] = 0
+            return colors
+        return self._variant('transparentZero', create)
+
+    def withTransparentInserted( self ):
+        """
+        This colortable, with a transparent color inserted at the beginning.
+        """
+        return self._variant('transparentInserted', lambda: np.insert(self._colors, 0, 0, axis=0))
+
+    def _variant( self, name, create ):
+        with self._lock:
+            variant = self._variants.get(name)
+        if variant is None:
+            variant = _intern( CompiledColortable(create()) )
+            with self._lock:
+                self._variants[name] = variant
+        return variant
+
+_compiled = weakref.WeakValueDictionary()
+_compiledLock = threading.Lock()
+
+def _intern( colortable ):
+    with _compiledLock:
+        shared = _compiled.get(colortable._key)
+        if shared is None:
+            shared = _compiled[colortable._key] = colortable
+        return shared
+
+def compileColortable( colorTable ):
+    """
+    The shared CompiledColortable of a colortable given as a list (or an
+    array) of QRgb values and/or QColors.
+    """
+    if isinstance(colorTable, CompiledColortable):
+        return colorTable
+    rgba = np.asarray(colorTable)
+    if rgba.dtype == object:
+        # Only tables with QColors need a loop
+        rgba = np.array([ c.rgba() if isinstance(c, QColor) else c for c in colorTable ], dtype=np.int64)
+    rgba = (rgba.astype(np.int64) & 0xffffffff).astype('<u4')
+    # A little-endian QRgb (0xAARRGGBB) is B, G, R, A in memory
+    return _intern( CompiledColortable(rgba.view(np.uint8).reshape(-1, 4)) )
@@ -0,0 +1,290 @@
+###############################################################################
+#   volumina: volume slicing and editing library
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+#		   http://ilastik.org/license/
+###############################################################################
+"""
+An optional backend that runs the numeric part of converting layer data to
+images (normalization, colortables, RGBA packing) in worker processes, so
+that the threads of the render pool don't contend for the GIL.
+
+The data and the resulting ARGB32 pixels are exchanged through slots of
+shared memory, which is created before the workers start: only the
+parameters of a conversion are pickled.  Colortables are written to the
+shared memory once and referred to by id.  The QImage is created in the
+calling thread, with a single copy of the pixels out of the slot.
+
+The workers are forked when the pool is started.  A forked process only
+inherits the thread that forked it, so a lock held by any other thread at
+that moment (e.g. the import lock, or a lock of the logging module) stays
+locked in the workers forever.  The pool must therefore be started before
+the threads of volumina (render pool, array I/O, disk tile cache) exist:
+VolumeEditor does so when it is created.  Applications that start threads
+of their own earlier (e.g. lazyflow's worker threads) should call
+startConversionPool() before them.
+"""
+import Queue
+import itertools
+import threading
+import multiprocessing
+import weakref
+import numpy as np
+from PyQt4.QtGui import QImage
+from qimage2ndarray import byte_view
+
+import numpyKernels
+from compiledColortable import CompiledColortable
+from volumina.config import cfg
+from volumina.utility import metrics
+
+_ALIGNMENT = 64
+
+def _aligned(nbytes):
+    return -(-nbytes // _ALIGNMENT) * _ALIGNMENT
+
+def _view(buf, spec):
+    """
+    The array (offset, dtype, shape) in the uint8 array buf.
+    """
+    offset, dtype, shape = spec
+    dtype = np.dtype(dtype)
+    nbytes = dtype.itemsize * int(np.prod(shape))
+    return buf[offset:offset+nbytes].view(dtype).reshape(shape)
+
+#
+# In the worker processes
+#
+
+# The shared memory of all slots, as a uint8 array
+_buffer = None
+# Lookup tables and colortables, by key
+_cache = {}
+
+def _initWorker(arena):
+    global _buffer
+    _buffer = np.frombuffer(arena, dtype=np.uint8)
+
+def _cached(key, create):
+    value = _cache.get(key)
+    if value is None:
+        if len(_cache) >= 64:
+            _cache.clear()
+        value = _cache[key] = create()
+    return value
+
+def _gray(arrays, out, normalize):
+    a, = arrays
+    if numpyKernels.hasLookupTable(a.dtype):
+        key = ('gray', a.dtype.str, float(normalize[0]), float(normalize[1]))
+        table = _cached(key, lambda: numpyKernels.grayLookupTable(a.dtype, normalize))
+        numpyKernels.applyLookupTable(a, table, out)
+    else:
+        numpyKernels.gray2qimage_ARGB32Premultiplied(a, out, normalize)
+
+def _alphamodulated(arrays, out, tintColor, normalize):
+    numpyKernels.alphamodulated2qimage_ARGB32Premultiplied(arrays[0], out, tintColor, normalize)
+
+def _colortable(arrays, out, table):
+    """
+    table -- (id, offset, length) of a colortable registered in the shared memory
+    """
+    tableId, offset, n = table
+    colortable = _cached(('colortable', tableId), lambda: CompiledColortable(_view(_buffer, (offset, np.uint8, (n, 4)))))
+    colortable.apply(arrays[0], out)
+
+def _rgba(arrays, out, normalize):
+    numpyKernels.rgba2qimage_ARGB32Premultiplied(arrays, out, normalize)
+
+_KERNELS = { 'gray'           : _gray,
+             'alphamodulated' : _alphamodulated,
+             'colortable'     : _colortable,
+             'rgba'           : _rgba }
+
+def _convert(kernel, inputs, output, args):
+    """
+    Write the pixels (uint8 BGRA) of the given inputs ((offset, dtype, shape)
+    of the arrays in the shared memory, or scalars) into output (offset, shape).
+    """
+    arrays = [ _view(_buffer, spec) if isinstance(spec, tuple) else spec for spec in inputs ]
+    offset, shape = output
+    _KERNELS[kernel]( arrays, _view(_buffer, (offset, np.uint8, tuple(shape) + (4,))), *args )
+
+#
+# In the parent process
+#
+
+class ConversionPool( object ):
+    """
+    A pool of worker processes that convert arrays into images.
+
+    Each conversion occupies a slot of shared memory (for its input data
+    and its pixels) while it runs; conversions that don't fit into a slot
+    are left to the caller.
+    """
+    def __init__( self, n_processes, slot_bytes, n_slots=None, table_bytes=2**22 ):
+        """
+        slot_bytes  -- the size of the input data, and of the pixels, of one conversion
+        n_slots     -- the number of conversions in flight (default: twice the number of processes)
+        table_bytes -- the size of the shared memory for colortables
+        """
+        n_slots = n_slots or 2*n_processes
+        self._slotBytes = _aligned(slot_bytes)
+        self._tableOffset = 2*self._slotBytes*n_slots
+        self._tableBytes = _aligned(table_bytes)
+        self._arena = multiprocessing.RawArray('B', self._tableOffset + self._tableBytes)
+        self._buffer = np.frombuffer(self._arena, dtype=np.uint8)
+        self._freeSlots = Queue.Queue()
+        for slot in range(n_slots):
+            self._freeSlots.put(slot)
+
+        # The registered colortables: CompiledColortable -> (id, offset, length)
+        self._tables = weakref.WeakKeyDictionary()
+        self._tableIds = itertools.count()
+        self._tablesUsed = 0
+        self._tableUsers = 0
+        self._tablesCondition = threading.Condition()
+
+        self._pool = multiprocessing.Pool(n_processes, _initWorker, (self._arena,))
+
+    def fits( self, arrays, shape ):
+        """
+        Whether the arrays (or scalars) and the pixels of an image of the
+        given shape (height, width) fit into a slot.
+        """
+        nbytes = sum( _aligned(np.asarray(a).nbytes) for a in arrays if not np.isscalar(a) )
+        return nbytes <= self._slotBytes and 4*shape[0]*shape[1] <= self._slotBytes
+
+    def convert( self, kernel, arrays, shape, args=(), format=QImage.Format_ARGB32_Premultiplied ):
+        """
+        Convert the arrays (2D arrays or scalars) into a QImage of the given
+        shape (height, width) in a worker process, with the given kernel
+        ('gray', 'alphamodulated', 'colortable' or 'rgba') and its args.
+        Returns None if the data doesn't fit into a slot.
+        """
+        if not self.fits(arrays, shape):
+            metrics.increment('conversionpool.too_large')
+            return None
+        slot = self._freeSlots.get()
+        try:
+            offset = 2*slot*self._slotBytes
+            inputs = []
+            for a in arrays:
+                if np.isscalar(a):
+                    inputs.append(a)
+                    continue
+                a = np.asarray(a)
+                spec = (offset, a.dtype.str, a.shape)
+                _view(self._buffer, spec)[...] = a
+                inputs.append(spec)
+                offset += _aligned(a.nbytes)
+            output = ( (2*slot + 1)*self._slotBytes, tuple(shape) )
+
+            with metrics.timer('conversionpool.convert'):
+                self._pool.apply( _convert, (kernel, inputs, output, args) )
+
+            img = QImage(shape[1], shape[0], format)
+            byte_view(img)[...] = _view( self._buffer, (output[0], np.uint8, tuple(shape) + (4,)) )
+            return img
+        finally:
+            self._freeSlots.put(slot)
+
+    def applyColortable( self, a, colortable ):
+        """
+        Convert the 2D integer array a into a QImage (Format_ARGB32) with the
+        given CompiledColortable, in a worker process.
+        Returns None if the data or the colortable doesn't fit.
+        """
+        with self._tablesCondition:
+            table = self._registerColortable(colortable)
+            if table is None:
+                return None
+            self._tableUsers += 1
+        try:
+            return self.convert( 'colortable', [a], a.shape, (table,), QImage.Format_ARGB32 )
+        finally:
+            with self._tablesCondition:
+                self._tableUsers -= 1
+                self._tablesCondition.notify_all()
+
+    def _registerColortable( self, colortable ):
+        """
+        The (id, offset, length) of the colortable in the shared memory; it
+        is written there when first used.  When the memory is full, all
+        colortables are discarded (after the running conversions).
+        Called with _tablesCondition held.
+        """
+        table = self._tables.get(colortable)
+        if table is not None:
+            return table
+        colors = colortable.colors
+        nbytes = _aligned(colors.nbytes)
+        if nbytes > self._tableBytes:
+            return None
+        if self._tablesUsed + nbytes > self._tableBytes:
+            while self._tableUsers:
+                self._tablesCondition.wait()
+            self._tables.clear()
+            self._tablesUsed = 0
+        offset = self._tableOffset + self._tablesUsed
+        _view( self._buffer, (offset, np.uint8, colors.shape) )[...] = colors
+        self._tablesUsed += nbytes
+        # Ids are never reused, so the workers can cache by id.
+        table = self._tables[colortable] = ( next(self._tableIds), offset, len(colors) )
+        return table
+
+    def shutdown( self ):
+        self._pool.terminate()
+        self._pool.join()
+
+_conversionPool = None
+_conversionPoolLock = threading.Lock()
+
+def startConversionPool():
+    """
+    Start the shared ConversionPool, if it is enabled in volumina.config,
+    and return it (or None).  This forks the worker processes, so it must be
+    called from the main thread before other threads are started (see the
+    module docstring); VolumeEditor calls it when it is created.  Calling it
+    again returns the pool that was already started.
+
+    Configured in volumina.config:
+    conversion_processes -- the number of worker processes (0 disables the pool)
+    conversion_layers    -- the comma-separated layer types that use the pool
+    conversion_slot_mb   -- the maximal size of the data of one conversion
+    """
+    global _conversionPool
+    with _conversionPoolLock:
+        n_processes = cfg.getint('pixelpipeline', 'conversion_processes')
+        if _conversionPool is None and n_processes > 0:
+            _conversionPool = ConversionPool( n_processes, cfg.getint('pixelpipeline', 'conversion_slot_mb') * 2**20 )
+        return _conversionPool
+
+def conversionPool( layerType ):
+    """
+    The shared ConversionPool for the data of the given layer type
+    ('grayscale', 'alphamodulated', 'colortable' or 'rgba'), or None if the
+    data of these layers is converted in the calling thread (also if the
+    pool was not started).
+    """
+    pool = _conversionPool
+    if pool is None:
+        return None
+    if layerType not in [ t.strip() for t in cfg.get('pixelpipeline', 'conversion_layers').split(',') ]:
+        return None
+    return pool
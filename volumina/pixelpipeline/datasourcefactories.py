@@ -21,6 +21,7 @@
 ###############################################################################
 from volumina.multimethods import multimethod
 from datasources import ArraySource
+from diskdatasources import MemmapArraySource
 import numpy
 
 hasLazyflow = True
@@ -74,51 +75,66 @@ def createDataSource(source,withShape = False):
     return _createArrayDataSource(source, withShape)
 
 if hasH5py:
-    
-    class H5pyDset5DWrapper(object):
-        
-        def __init__(self, dset):
-            if len(dset.shape) == 2:
-                shape_5d = (1,) + dset.shape + (1,1)
-                real_axes = (1,2)
-            elif len(dset.shape) == 3 and dset.shape[2] <= 4:
-                shape_5d = (1,) + dset.shape[0:2] + (1,) + (dset.shape[2],)
-                real_axes = (1,2,4)
-            elif len(dset.shape) == 3:
-                shape_5d = (1,) + dset.shape + (1,)
-                real_axes = (1,2,3)
-            elif len(dset.shape) == 4:
-                shape_5d = (1,) + dset.shape
-                real_axes = (1,2,3,4)
-            elif len(dset.shape) == 5:
-                shape_5d = dset.shape
-                real_axes = (0,1,2,3,4)
-            else:
-                assert False, "Can't handle h5py.Datasets with {} axes".format( len(dset.shape) )
-            
-            self.dset = dset
-            self.dtype = dset.dtype
-            self.shape = shape_5d
-            self.real_axes = real_axes
-
-        def __getitem__(self, slicing_5d):
-            real_slicing = tuple(slicing_5d[i] for i in self.real_axes)
-            data = self.dset[real_slicing]
-            expanded_slicing = [None] * 5
-            for axis in self.real_axes:
-                expanded_slicing[axis] = slice(None)
-            return data[expanded_slicing]
-        
-    
-    @multimethod(h5py.Dataset,bool)
-    def createDataSource(dset,withShape = False):
-        dset_5d = H5pyDset5DWrapper(dset)
-        src = ArraySource(dset_5d)
+    from diskdatasources import H5pyDset5DWrapper, ChunkedH5pyDset5DWrapper, H5pyArraySource
+
+    def _createH5pyDataSource(src, withShape):
         if withShape:
-            return src, dset_5d.shape
+            return src, src._array.shape
         else:
             return src
 
+    @multimethod(h5py.Dataset,bool)
+    def createDataSource(dset,withShape = False):
+        return _createH5pyDataSource(H5pyArraySource(dset), withShape)
+
+    @multimethod(h5py.Dataset)
+    def createDataSource(dset):
+        return createDataSource(dset,False)
+
+@multimethod(numpy.memmap,bool)
+def createDataSource(source,withShape = False):
+    src = MemmapArraySource(source)
+    if withShape:
+        return src, src._array.shape
+    else:
+        return src
+
+@multimethod(numpy.memmap)
+def createDataSource(source):
+    return createDataSource(source,False)
+
+def _createPathDataSource(path,withShape = False):
+    """
+    Open a .npy file (memory-mapped), or an HDF5 dataset given as
+    path/to/file.h5/path/in/file, without loading it.
+    The HDF5 file is closed by the clean_up() of the datasource.
+    """
+    lower = path.lower()
+    if lower.endswith('.npy'):
+        return createDataSource(numpy.load(path, mmap_mode='r'), withShape)
+    for ext in ('.h5', '.hdf5'):
+        i = lower.find(ext + '/')
+        if i >= 0 and hasH5py:
+            filename, internalPath = path[:i+len(ext)], path[i+len(ext):]
+            return _createH5pyDataSource(H5pyArraySource.open(filename, internalPath), withShape)
+    raise ValueError("Can't create a datasource for '{}'".format(path))
+
+@multimethod(str,bool)
+def createDataSource(path,withShape = False):
+    return _createPathDataSource(path, withShape)
+
+@multimethod(str)
+def createDataSource(path):
+    return _createPathDataSource(path, False)
+
+@multimethod(unicode,bool)
+def createDataSource(path,withShape = False):
+    return _createPathDataSource(path, withShape)
+
+@multimethod(unicode)
+def createDataSource(path):
+    return _createPathDataSource(path, False)
+
 if hasVigra:
     @multimethod(vigra.VigraArray,bool)
     def createDataSource(source,withShape = False):
@@ -20,15 +20,20 @@
 #		   http://ilastik.org/license/
 ###############################################################################
 import sys
+import time
+import itertools
 import threading
 import weakref
+from collections import OrderedDict
 from functools import partial, wraps
+from concurrent.futures import CancelledError
 from PyQt4.QtCore import QObject, pyqtSignal, QTimer
 from asyncabcs import RequestABC, SourceABC, IndeterminateRequestError
 import volumina
 from volumina.slicingtools import is_pure_slicing, slicing2shape, \
     is_bounded, make_bounded, index2slice, sl
 from volumina.config import cfg
+from volumina.utility import metrics, PrioritizedThreadPoolExecutor
 import numpy as np
 
 _has_lazyflow = True
@@ -50,27 +55,230 @@ except ImportError:
 #*******************************************************************************
 
 class ArrayRequest( object ):
+    """
+    A request for a region of an array.  The data is read in the thread
+    that waits for it, or in the background (by the I/O pool) after
+    submit(), so that reading e.g. h5py datasets or memory-mapped files
+    overlaps with the computations of other requests.
+    Regions of in-memory arrays are views, which are never submitted.
+    A cancelled request is not read anymore: wait() raises a CancelledError.
+    """
+    _ioExecutor = None
+    _ioExecutorLock = threading.Lock()
+
     def __init__( self, array, slicing ):
         self._array = array
         self._slicing = slicing
         self._result = None
+        self._future = None
+        self._cancelled = False
+        self._lock = threading.Lock()
+        self._finishedCallbacks = []
+        self._failedCallbacks = []
 
     def wait( self ):
         if self._result is None:
-            self._result = self._array[self._slicing]
+            if self._cancelled:
+                raise CancelledError()
+            future = self._future
+            # A read that didn't start yet is done right here.
+            if future is not None and not future.cancel():
+                try:
+                    future.result()
+                except CancelledError:
+                    pass
+            if self._result is None:
+                if self._cancelled:
+                    raise CancelledError()
+                self._execute()
         return self._result
     
     def getResult(self):
         return self._result
 
     def cancel( self ):
-        pass
+        """
+        Cancel the request: the data is not read anymore (unless the
+        background read has already started), and wait() raises a
+        CancelledError, unless the data was already read.
+        """
+        self._cancelled = True
+        future = self._future
+        if future is not None:
+            future.cancel()
 
     def submit( self ):
-        pass
+        with self._lock:
+            if self._future is not None or self._result is not None or \
+                    self._cancelled or self._inMemory():
+                return self
+            self._future = self._executor().submit( self._execute, time.time() )
+        return self
+
+    def notify_finished( self, fn ):
+        """
+        Call fn(result) once the data is read (immediately, if it already is).
+        """
+        with self._lock:
+            if self._result is None:
+                self._finishedCallbacks.append(fn)
+                return
+        fn(self._result)
+
+    def notify_failed( self, fn ):
+        """
+        Call fn(exception) if reading the data fails.
+        """
+        with self._lock:
+            self._failedCallbacks.append(fn)
+
+    def _fetch( self ):
+        return self._array[self._slicing]
+
+    def _inMemory( self ):
+        return isinstance(self._array, np.ndarray) and not isinstance(self._array, np.memmap)
+
+    def _execute( self ):
+        try:
+            result = self._fetch()
+        except Exception as ex:
+            with self._lock:
+                callbacks = list(self._failedCallbacks)
+            for fn in callbacks:
+                fn(ex)
+            raise
+        with self._lock:
+            if self._result is not None:
+                return
+            self._result = result
+            callbacks, self._finishedCallbacks = self._finishedCallbacks, []
+        for fn in callbacks:
+            fn(result)
+
+    @classmethod
+    def _executor( cls ):
+        with cls._ioExecutorLock:
+            if cls._ioExecutor is None:
+                cls._ioExecutor = PrioritizedThreadPoolExecutor( cfg.getint('pixelpipeline', 'array_io_threads') )
+            return cls._ioExecutor
         
 assert issubclass(ArrayRequest, RequestABC)
 
+#*******************************************************************************
+# C h u n k C a c h e                                                          *
+#*******************************************************************************
+
+class ChunkCache( object ):
+    """
+    A bounded (LRU) cache of chunks (arrays) read from a slow datasource,
+    e.g. the chunks of HDF5 datasets or the blocks of a BlockCachedDataSource.
+    Chunks are read-only arrays.
+    """
+    def __init__( self, maxbytes ):
+        self._maxbytes = maxbytes
+        self._chunks = OrderedDict()
+        self._usedBytes = 0
+        self._loading = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    @property
+    def maxbytes( self ):
+        return self._maxbytes
+
+    @property
+    def usedBytes( self ):
+        return self._usedBytes
+
+    def __len__( self ):
+        return len(self._chunks)
+
+    def __contains__( self, key ):
+        with self._lock:
+            return key in self._chunks or key in self._loading
+
+    def get( self, key, read ):
+        """
+        The chunk with the given key, which is read by read() if it is not cached.
+        If another thread is already reading the chunk, wait for it instead.
+        """
+        with self._lock:
+            chunk = self._chunks.pop(key, None)
+            if chunk is not None:
+                self._chunks[key] = chunk
+            else:
+                loading = self._loading.get(key)
+                reader = loading is None
+                if reader:
+                    loading = self._loading[key] = [threading.Event(), None]
+                generation = self._generation
+        if chunk is not None:
+            metrics.increment('chunkcache.hits')
+            return chunk
+        if not reader:
+            loading[0].wait()
+            if loading[1] is not None:
+                return loading[1]
+            return self.get(key, read)
+
+        metrics.increment('chunkcache.misses')
+        try:
+            chunk = read()
+            chunk.flags.writeable = False
+            loading[1] = chunk
+        finally:
+            with self._lock:
+                del self._loading[key]
+                # Chunks that were discarded while being read are not kept
+                if chunk is not None and generation == self._generation and chunk.nbytes <= self._maxbytes:
+                    self._chunks[key] = chunk
+                    self._usedBytes += chunk.nbytes
+                    while self._usedBytes > self._maxbytes:
+                        oldKey, old = self._chunks.popitem(last=False)
+                        self._usedBytes -= old.nbytes
+            loading[0].set()
+        return chunk
+
+    def discard( self, match=None ):
+        """
+        Remove all chunks whose key matches (all chunks, if match is None).
+        Chunks that are being read are not cached.
+        """
+        with self._lock:
+            self._generation += 1
+            for key in [key for key in self._chunks if match is None or match(key)]:
+                self._usedBytes -= self._chunks.pop(key).nbytes
+
+    def clear( self ):
+        self.discard()
+
+def assemble_blocks( bounds, blockShape, getBlock, dtype ):
+    """
+    Assemble a region from the aligned blocks that contain it.
+    bounds     -- (start, stop, step) of the region along each axis
+    blockShape -- the shape of the blocks; block i along an axis with block
+                  size b starts at i*b (blocks at the upper border may be smaller)
+    getBlock   -- returns the block with the given block index (a tuple)
+    """
+    result = np.empty( [ len(xrange(*b)) for b in bounds ], dtype=dtype )
+    if result.size == 0:
+        return result
+    blockRanges = [ xrange(start // b, (stop - 1) // b + 1)
+                    for (start, stop, step), b in zip(bounds, blockShape) ]
+    for block_index in itertools.product(*blockRanges):
+        src, dst = [], []
+        for (start, stop, step), i, b in zip(bounds, block_index, blockShape):
+            # The requested indices start + k*step within this block
+            k0 = max(0, -((start - i*b) // step))
+            k1 = min(len(xrange(start, stop, step)), -((start - (i+1)*b) // step))
+            if k0 >= k1:
+                break
+            src.append( slice(start + k0*step - i*b, start + (k1-1)*step - i*b + 1, step) )
+            dst.append( slice(k0, k1) )
+        else:
+            result[tuple(dst)] = getBlock(block_index)[tuple(src)]
+    return result
+
 #*******************************************************************************
 # A r r a y S o u r c e                                                        *
 #*******************************************************************************
@@ -103,6 +311,16 @@ class ArraySource( QObject ):
             % (slicing, self._array.shape)  
         return ArrayRequest(self._array, slicing)
 
+    def requestDownsampled( self, slicing, factors ):
+        """
+        Request every factors[i]-th element along each axis of the given slicing.
+        (See DownsampledDataSource.)  The array is simply strided, without a copy.
+        """
+        if not is_pure_slicing(slicing):
+            raise Exception('ArraySource: slicing is not pure')
+        strided = tuple( slice(s.start, s.stop, f) for s, f in zip(slicing, factors) )
+        return ArrayRequest(self._array, strided)
+
     def setDirty( self, slicing):
         if not is_pure_slicing(slicing):
             raise Exception('dirty region: slicing is not pure')
@@ -143,33 +361,204 @@ class ArraySinkSource( ArraySource ):
 
 class RelabelingArraySource( ArraySource ):
     """Applies a relabeling to each request before passing it on
-       Currently, it casts everything to uint8, so be careful."""
+       Currently, it casts everything to uint8, so be careful.
+
+       The relabeling is either dense (a vector with an entry for each
+       possible data value) or sparse (a dict, for large label spaces such as
+       64-bit supervoxel ids; labels that are not in the dict map to 0).
+       It is applied when the request is waited for, i.e. in the worker thread."""
     isDirty = pyqtSignal( object )
     def __init__( self, array ):
         super(RelabelingArraySource, self).__init__(array)
         self.originalData = array
         self._relabeling = None
+        self._sparse = None
+        # The sorted table of the sparse relabeling (built when first needed,
+        # in a worker thread) and the entries changed since it was built
+        self._sparseRelabeling = None
+        self._sparseChanges = {}
+        self._sparseLock = threading.Lock()
+        self._changedLabels = set()
+        # The data values (sorted) of the most recently fetched regions, the
+        # regions that were fetched but are no longer in that index (None if
+        # there are too many to track), and the regions that are being fetched
+        self._regionLabels = OrderedDict()
+        self._indexedLabels = 0
+        self._unindexedRegions = set()
+        self._pendingRegions = weakref.WeakKeyDictionary()
+        self._labelRegionsLock = threading.Lock()
+
+    # Limits of the index of fetched regions
+    _MAX_INDEXED_LABELS = 2**22
+    _MAX_UNINDEXED_REGIONS = 4096
     
     def setRelabeling( self, relabeling ):
         """Sets new relabeling vector. It should have a len(relabling) == max(your data)+1
-           and give, for each possible data value x, the relabling as relabeling[x]."""   
-        assert relabeling.dtype == self._array.dtype, "relabeling.dtype=%r != self._array.dtype=%r" % (relabeling.dtype, self._array.dtype)
-        self._relabeling = relabeling
+           and give, for each possible data value x, the relabling as relabeling[x].
+
+           Alternatively, relabeling may be a dict {x: relabeling of x}."""   
+        if isinstance(relabeling, dict):
+            self._relabeling = None
+            with self._sparseLock:
+                self._sparse = dict(relabeling)
+                self._sparseRelabeling = None
+                self._sparseChanges = {}
+        else:
+            assert relabeling.dtype == self._array.dtype, "relabeling.dtype=%r != self._array.dtype=%r" % (relabeling.dtype, self._array.dtype)
+            self._relabeling = relabeling
+            self._sparse = None
+        self._changedLabels.clear()
+        self._clearLabelIndex()
         self.setDirty(5*(slice(None),))
 
     def clearRelabeling( self ):
-        self._relabeling[:] = 0
+        if self._sparse is not None:
+            with self._sparseLock:
+                self._sparse.clear()
+                self._sparseRelabeling = None
+                self._sparseChanges = {}
+        else:
+            self._relabeling[:] = 0
+        self._changedLabels.clear()
+        self._clearLabelIndex()
         self.setDirty(5*(slice(None),))
 
+    def setDirty( self, slicing ):
+        """
+        Dirty regions are refetched before they are shown again, so they
+        are removed from the index until then.
+        """
+        if not is_pure_slicing(slicing):
+            raise Exception('dirty region: slicing is not pure')
+        if all( sl.start is None and sl.stop is None for sl in slicing ):
+            self._clearLabelIndex()
+        else:
+            bounds = [ sl.indices(n)[:2] for sl, n in zip(slicing, self._array.shape) ]
+            def overlaps( region ):
+                return all( start is None or (start < b_stop and b_start < stop)
+                            for (start, stop), (b_start, b_stop) in zip(region, bounds) )
+            with self._labelRegionsLock:
+                for region in [ r for r in self._regionLabels if overlaps(r) ]:
+                    self._indexedLabels -= len( self._regionLabels.pop(region) )
+                if self._unindexedRegions is not None:
+                    self._unindexedRegions = set( r for r in self._unindexedRegions if not overlaps(r) )
+        super(RelabelingArraySource, self).setDirty(slicing)
+
+    def _clearLabelIndex( self ):
+        with self._labelRegionsLock:
+            self._regionLabels.clear()
+            self._indexedLabels = 0
+            self._unindexedRegions = set()
+
     def setRelabelingEntry( self, index, value, setDirty=True ):
         """Sets the entry for data value index to value, such that afterwards
            relabeling[index] =  value.
            
-           If setDirty is true, the source will signal dirtyness. If you plan to issue many calls to this function
-           in a loop, setDirty to true only on the last call."""
-        self._relabeling[index] = value
-        if setDirty:
+           If setDirty is true, the source will signal dirtyness (of the fetched regions
+           that contain the labels changed since the last signal). If you plan to
+           issue many calls to this function in a loop, setDirty to true only on the last call."""
+        if self._sparse is not None:
+            if self._sparse.get(index, 0) != value:
+                with self._sparseLock:
+                    self._sparse[index] = value
+                    self._sparseChanges[index] = value
+                self._changedLabels.add(index)
+        elif self._relabeling[index] != value:
+            self._relabeling[index] = value
+            self._changedLabels.add(index)
+        if setDirty and self._changedLabels:
+            labels, self._changedLabels = self._changedLabels, set()
+            self._setLabelsDirty(labels)
+
+    def _setLabelsDirty( self, labels ):
+        """
+        Signal the regions that contain any of the given data values as dirty,
+        i.e. all fetched regions in which they occur, and all regions that
+        are being fetched.
+        """
+        labels = np.array( sorted(labels), dtype=self._array.dtype )
+        with self._labelRegionsLock:
+            regions = set( self._pendingRegions.values() )
+            for region, regionLabels in self._regionLabels.iteritems():
+                idx = np.searchsorted(regionLabels, labels)
+                np.minimum(idx, len(regionLabels)-1, out=idx)
+                if (regionLabels[idx] == labels).any():
+                    regions.add(region)
+            # The data values of these regions are unknown
+            unindexed = self._unindexedRegions
+        if unindexed is None:
             self.setDirty(5*(slice(None),))
+            return
+        regions.update(unindexed)
+        for region in regions:
+            self.setDirty( tuple(slice(start, stop) for start, stop in region) )
+
+    def _region( self, slicing ):
+        """
+        The region of a requested slicing, as hashable tuple of (start, stop).
+        Axes of extent 1 (i.e. the axes along which a slice is requested)
+        are extended to the whole axis, because the tiles of the other slices
+        may be cached as well.
+        """
+        region = []
+        for sl, n in zip(slicing, self._array.shape):
+            start, stop, step = sl.indices(n)
+            region.append( (None, None) if stop - start <= 1 else (start, stop) )
+        return tuple(region)
+
+    def _onFetching( self, request, slicing ):
+        with self._labelRegionsLock:
+            self._pendingRegions[request] = self._region(slicing)
+
+    def _onFetched( self, request, data ):
+        """
+        Index the values in data by the region of the fetched request,
+        replacing the values of an earlier fetch of the region.
+        The oldest regions are dropped from the index when it is full.
+        """
+        labels = np.unique(data)
+        with self._labelRegionsLock:
+            region = self._pendingRegions.pop(request, None)
+            if region is None:
+                return
+            old = self._regionLabels.pop(region, None)
+            if old is not None:
+                self._indexedLabels -= len(old)
+            if self._unindexedRegions is not None:
+                self._unindexedRegions.discard(region)
+            self._regionLabels[region] = labels
+            self._indexedLabels += len(labels)
+            while self._indexedLabels > self._MAX_INDEXED_LABELS and len(self._regionLabels) > 1:
+                evicted, evictedLabels = self._regionLabels.popitem(last=False)
+                self._indexedLabels -= len(evictedLabels)
+                if self._unindexedRegions is not None:
+                    self._unindexedRegions.add(evicted)
+                    if len(self._unindexedRegions) > self._MAX_UNINDEXED_REGIONS:
+                        self._unindexedRegions = None
+
+    def _relabel( self ):
+        """
+        The function that applies the current relabeling to an array (or None).
+        """
+        if self._sparse is not None:
+            return self._relabelSparse
+        if self._relabeling is not None:
+            return self._relabeling.__getitem__
+        return None
+
+    def _relabelSparse( self, a ):
+        """
+        Apply the current sparse relabeling to a (in the worker thread):
+        the sorted table is built, or updated with the changed entries, first.
+        """
+        with self._sparseLock:
+            if self._sparseRelabeling is None:
+                self._sparseRelabeling = SparseRelabeling(self._sparse, self._array.dtype)
+            elif self._sparseChanges:
+                self._sparseRelabeling = self._sparseRelabeling.updated(self._sparseChanges)
+            self._sparseChanges = {}
+            relabeling = self._sparseRelabeling
+        return relabeling(a)
 
     def request( self, slicing ):
         if not is_pure_slicing(slicing):
@@ -177,15 +566,89 @@ class RelabelingArraySource( ArraySource ):
         assert(len(slicing) == len(self._array.shape)), \
             "slicing into an array of shape=%r requested, but slicing is %r" \
             % (self._array.shape, slicing)
-        a = ArrayRequest(self._array, slicing)
-        a = a.wait()
-        
-        #oldDtype = a.dtype
-        if self._relabeling is not None:
-            a = self._relabeling[a]
-        #assert a.dtype == oldDtype 
-        return ArrayRequest(a, 5*(slice(None),))
-        
+        return self._relabelingRequest(ArrayRequest(self._array, slicing), slicing)
+
+    def requestDownsampled( self, slicing, factors ):
+        req = super(RelabelingArraySource, self).requestDownsampled(slicing, factors)
+        return self._relabelingRequest(req, slicing)
+
+    def _relabelingRequest( self, req, slicing ):
+        req = RelabelingArrayRequest(req, self._relabel(), self._onFetched)
+        self._onFetching(req, slicing)
+        return req
+
+class RelabelingArrayRequest( object ):
+    """
+    Applies relabel() to the result of another request, when waited for.
+    onFetched(request, data) is called with the data before the relabeling.
+    """
+    def __init__( self, request, relabel, onFetched=None ):
+        self._request = request
+        self._relabel = relabel
+        self._onFetched = onFetched
+        self._result = None
+
+    def wait( self ):
+        if self._result is None:
+            a = self._request.wait()
+            if self._onFetched is not None:
+                self._onFetched(self, a)
+            self._result = self._relabel(a) if self._relabel is not None else a
+        return self._result
+
+    def getResult(self):
+        return self._result
+
+    def cancel( self ):
+        self._request.cancel()
+
+    def submit( self ):
+        self._request.submit()
+
+assert issubclass(RelabelingArrayRequest, RequestABC)
+
+class SparseRelabeling( object ):
+    """
+    An immutable relabeling {label: new label} of arbitrarily large labels,
+    applied by a vectorized lookup in the sorted labels.
+    Labels that are not in the relabeling map to 0.
+    """
+    def __init__( self, relabeling, dtype ):
+        self._keys, self._values = self._sorted(relabeling, dtype)
+
+    @staticmethod
+    def _sorted( relabeling, dtype ):
+        keys = np.fromiter(relabeling.iterkeys(), dtype=dtype, count=len(relabeling))
+        values = np.fromiter(relabeling.itervalues(), dtype=dtype, count=len(relabeling))
+        order = np.argsort(keys)
+        return keys[order], values[order]
+
+    def updated( self, changes ):
+        """
+        A new SparseRelabeling with the given entries {label: new label}
+        changed or added, merged into the sorted table without sorting it again.
+        """
+        keys, values = self._sorted(changes, self._keys.dtype)
+        idx = np.searchsorted(self._keys, keys)
+        found = idx < len(self._keys)
+        found[found] = self._keys[idx[found]] == keys[found]
+        result = SparseRelabeling({}, self._keys.dtype)
+        result._values = self._values.copy()
+        result._values[idx[found]] = values[found]
+        new = ~found
+        result._keys = np.insert(self._keys, idx[new], keys[new])
+        result._values = np.insert(result._values, idx[new], values[new])
+        return result
+
+    def __call__( self, a ):
+        if len(self._keys) == 0:
+            return np.zeros(a.shape, dtype=self._values.dtype)
+        idx = np.searchsorted(self._keys, a)
+        np.minimum(idx, len(self._keys)-1, out=idx)
+        result = self._values[idx]
+        result[self._keys[idx] != a] = 0
+        return result
+
 
 if _has_lazyflow:
     from lazyflow.graph import Slot
@@ -236,6 +699,10 @@ if _has_lazyflow:
     
         def cancel( self ):
             self._req.cancel()
+
+        def submit( self ):
+            self._req.submit()
+            return self
     
     assert issubclass(LazyflowRequest, RequestABC)
 
@@ -469,23 +936,145 @@ class MinMaxUpdateRequest( object ):
     def getResult(self):
         return self._result
 
+    def cancel( self ):
+        self._rawRequest.cancel()
+
+    def submit( self ):
+        self._rawRequest.submit()
+
 assert issubclass(MinMaxUpdateRequest, RequestABC)
 
 
+class HistogramSketch( object ):
+    """
+    An approximate histogram of streamed data, for estimating percentiles.
+    It has a fixed number of bins, whose range grows (by merging pairs of
+    bins) to cover all data that was added.
+    """
+    def __init__( self, bins=16384 ):
+        self._counts = np.zeros(bins, dtype=np.int64)
+        self._lo = None
+        self._width = None
+        self.min = None
+        self.max = None
+        self._lock = threading.Lock()
+
+    @property
+    def count( self ):
+        return int(self._counts.sum())
+
+    def add( self, data ):
+        data = np.asarray(data).reshape(-1)
+        if data.dtype.kind == 'f':
+            data = data[np.isfinite(data)]
+        if data.size == 0:
+            return
+        dmin, dmax = float(data.min()), float(data.max())
+        n = len(self._counts)
+        with self._lock:
+            if self._lo is None:
+                self._lo = dmin
+                self._width = max((dmax - dmin) / n, 1e-6 * max(abs(dmin), 1.0))
+                self.min, self.max = dmin, dmax
+            self.min, self.max = min(self.min, dmin), max(self.max, dmax)
+            while dmin < self._lo:
+                self._grow(downward=True)
+            while dmax >= self._lo + n * self._width:
+                self._grow(downward=False)
+            bins = np.subtract(data, self._lo, dtype=np.float64)
+            bins /= self._width
+            bins = np.clip(bins.astype(np.intp), 0, n - 1)
+            self._counts += np.bincount(bins, minlength=n)
+
+    def percentile( self, q ):
+        """
+        The approximate q-th percentile (0..100) of the data, or None if
+        no data was added.
+        """
+        with self._lock:
+            total = self._counts.sum()
+            if total == 0:
+                return None
+            cumulative = np.cumsum(self._counts)
+            i = int(np.searchsorted(cumulative, q / 100.0 * total))
+            i = min(i, len(self._counts) - 1)
+            # Interpolate within the bin
+            before = cumulative[i] - self._counts[i]
+            fraction = (q / 100.0 * total - before) / max(self._counts[i], 1)
+            value = self._lo + self._width * (i + min(max(fraction, 0.0), 1.0))
+            return min(max(value, self.min), self.max)
+
+    def _grow( self, downward ):
+        """
+        Double the width of the bins, and extend the range downwards or upwards.
+        """
+        n = len(self._counts)
+        merged = self._counts.reshape(-1, 2).sum(axis=1)
+        self._counts[:] = 0
+        if downward:
+            self._counts[n//2:] = merged
+            self._lo -= n * self._width
+        else:
+            self._counts[:n//2] = merged
+        self._width *= 2
+
+def sample_slicings( shape, blocks=3, blockSize=32 ):
+    """
+    Slicings of a grid of small blocks (at most blocks x blocks x blocks
+    per time step, with all channels), that sample a 5D volume evenly.
+    """
+    axes = []
+    for axis, n in enumerate(shape):
+        if axis == 4:
+            axes.append( [slice(0, n)] )
+            continue
+        size = min(n, blockSize if axis in (1,2,3) else 1)
+        starts = np.unique( np.linspace(0, n - size, min(blocks, n // size)).round().astype(int) )
+        axes.append( [ slice(start, start + size) for start in starts ] )
+    return list(itertools.product(*axes))
+
+def _sourceShape( source ):
+    """
+    The 5D shape of the data of source (or of the source it wraps), or None if unknown.
+    """
+    while source is not None:
+        for shape in ( getattr(source, '_shape', None),
+                       getattr(getattr(source, '_array', None), 'shape', None) ):
+            if shape is not None and len(shape) == 5:
+                return tuple(shape)
+        source = getattr(source, '_rawSource', None)
+    return None
+
 class MinMaxSource( QObject ):
     """
     A datasource that serves as a normalizing decorator for other datasources.
+
+    By default, the bounds are the exact min/max of all data requested so far.
+    In sampled mode, they are robust estimates (percentiles) from a sample of
+    the whole volume, which is read in the background, and from the requested
+    data.  The bounds are only changed when they move noticeably, and the
+    volume is marked dirty at most once per dirty interval.
     """
     isDirty = pyqtSignal( object )
     boundsChanged = pyqtSignal(object) # When a new min/max is discovered in the result of a request, this signal is fired with the new (dmin, dmax)
     numberOfChannelsChanged = pyqtSignal(int)
     
     _delayedBoundsChange = pyqtSignal() # Internal use only.  Allows non-main threads to start the delayedDirtySignal timer.
+
+    # Sampled mode: elements of each requested array that are added to the histogram
+    _SAMPLE_SIZE = 2**16
+    # Sampled mode: relative change of the bounds that is ignored
+    _TOLERANCE = 0.02
+
+    _estimateExecutor = None
+    _estimateExecutorLock = threading.Lock()
     
-    
-    def __init__( self, rawSource, parent=None ):
+    def __init__( self, rawSource, parent=None, sampled=None, shape=None, percentiles=(0.1, 99.9) ):
         """
         rawSource: The original datasource whose data will be normalized
+        sampled: Estimate robust bounds (default: minmax_sampled of the config)
+        shape: The 5D shape of the data, for sampling (default: the shape of rawSource, if known)
+        percentiles: The percentiles of the data that are used as bounds in sampled mode
         """
         super(MinMaxSource, self).__init__(parent)
         
@@ -493,12 +1082,25 @@ class MinMaxSource( QObject ):
         self._rawSource.isDirty.connect( self.isDirty )
         self._rawSource.numberOfChannelsChanged.connect( self.numberOfChannelsChanged )
         self._bounds = [1e9,-1e9]
+
+        if sampled is None:
+            sampled = cfg.getboolean('pixelpipeline', 'minmax_sampled')
+        self._sampled = sampled
+        self._percentiles = percentiles
+        self._shape = tuple(shape) if shape is not None else _sourceShape(rawSource)
+        self._sketch = HistogramSketch()
+        self._boundsLock = threading.Lock()
         
         self._delayedDirtySignal = QTimer()
         self._delayedDirtySignal.setSingleShot(True)
-        self._delayedDirtySignal.setInterval(10)
         self._delayedDirtySignal.timeout.connect( partial(self.setDirty, sl[:,:,:,:,:]) )
-        self._delayedBoundsChange.connect(self._delayedDirtySignal.start)
+        if sampled:
+            self._delayedDirtySignal.setInterval( cfg.getint('pixelpipeline', 'minmax_dirty_interval_ms') )
+            self._delayedBoundsChange.connect(self._startDelayedDirtySignal)
+            self._estimateBounds()
+        else:
+            self._delayedDirtySignal.setInterval(10)
+            self._delayedBoundsChange.connect(self._delayedDirtySignal.start)
 
     @property
     def numberOfChannels(self):
@@ -524,6 +1126,17 @@ class MinMaxSource( QObject ):
     def setDirty( self, slicing ):
         self.isDirty.emit(slicing)
 
+    def resetBounds( self ):
+        """
+        Forget the bounds, and determine them again.
+        """
+        with self._boundsLock:
+            self._bounds[:] = [1e9,-1e9]
+            self._sketch = HistogramSketch()
+        if self._sampled:
+            self._estimateBounds()
+        self.setDirty( sl[:,:,:,:,:] )
+
     def __eq__( self, other ):
         equal = True
         if other is None:
@@ -536,6 +1149,11 @@ class MinMaxSource( QObject ):
         return not ( self == other )
 
     def _getMinMax(self, data):
+        if self._sampled:
+            self._sketch.add( self._sample(data) )
+            self._updateEstimate()
+            return
+
         dmin = np.min(data)
         dmax = np.max(data)
         dmin = min(self._bounds[0], dmin)
@@ -572,6 +1190,65 @@ class MinMaxSource( QObject ):
             # if we immediately tell the TileProvider we are dirty.  This duplicates some requests, but that shouldn't be a big deal.
             self.setDirty( sl[:,:,:,:,:] )
 
+    def _sample( self, data ):
+        """
+        A strided sample of at most about _SAMPLE_SIZE elements of data.
+        """
+        data = np.asarray(data)
+        axes = [ n for n in data.shape if n > 1 ]
+        if data.size <= self._SAMPLE_SIZE or not axes:
+            return data
+        step = int(np.ceil( (float(data.size) / self._SAMPLE_SIZE) ** (1.0 / len(axes)) ))
+        return data[ tuple( slice(None, None, step) for n in data.shape ) ]
+
+    def _estimateBounds( self ):
+        """
+        Estimate the bounds from a sample of the whole volume, in the background.
+        """
+        if self._shape is None:
+            return
+        sketch = self._sketch
+        def estimate():
+            for slicing in sample_slicings(self._shape):
+                if sketch is not self._sketch:
+                    # The bounds were reset in the meantime
+                    return
+                sketch.add( self._sample(self._rawSource.request(slicing).wait()) )
+            self._updateEstimate()
+        self._executor().submit( estimate, time.time() )
+
+    def _updateEstimate( self ):
+        """
+        Update the bounds from the histogram, if they changed noticeably.
+        """
+        lo = self._sketch.percentile(self._percentiles[0])
+        hi = self._sketch.percentile(self._percentiles[1])
+        if lo is None:
+            return
+        with self._boundsLock:
+            if self._bounds[0] <= self._bounds[1]:
+                tolerance = self._TOLERANCE * max(self._bounds[1] - self._bounds[0], 1e-2)
+                if abs(lo - self._bounds[0]) <= tolerance and abs(hi - self._bounds[1]) <= tolerance:
+                    return
+            self._bounds[0] = lo
+            self._bounds[1] = hi
+        self.boundsChanged.emit(self._bounds)
+        # See _getMinMax(): the tile that is being rendered must be marked dirty
+        # after it was stored, so everything is marked dirty with a timer.
+        self._delayedBoundsChange.emit()
+
+    def _startDelayedDirtySignal( self ):
+        # Mark everything dirty at most once per interval
+        if not self._delayedDirtySignal.isActive():
+            self._delayedDirtySignal.start()
+
+    @classmethod
+    def _executor( cls ):
+        with cls._estimateExecutorLock:
+            if cls._estimateExecutor is None:
+                cls._estimateExecutor = PrioritizedThreadPoolExecutor(1)
+            return cls._estimateExecutor
+
 
 assert issubclass(MinMaxSource, SourceABC)
 
@@ -645,4 +1322,297 @@ class HaloAdjustedDataSource( QObject ):
                       for (s, halo_start, halo_stop) in zip( slicing,
                                     self.halo_start_delta,
                                     self.halo_stop_delta ) )
-    
\ No newline at end of file
+    
+
+
+#*******************************************************************************
+# B l o c k C a c h e d D a t a S o u r c e                                    *
+#*******************************************************************************
+
+class BlockCachedRequest( object ):
+    def __init__( self, source, slicing ):
+        self._source = source
+        self._slicing = slicing
+        self._result = None
+
+    def wait( self ):
+        if self._result is None:
+            self._result = self._source._read(self._slicing)
+        return self._result
+
+    def getResult( self ):
+        return self._result
+
+    def cancel( self ):
+        pass
+
+    def submit( self ):
+        pass
+
+assert issubclass(BlockCachedRequest, RequestABC)
+
+class BlockCachedDataSource( QObject ):
+    """
+    A caching wrapper for slow datasources (e.g. on disk or remote).
+    Requests are served from aligned blocks of the underlying datasource
+    (by default 3D blocks of 128x128x32 voxels), which are kept in a
+    ChunkCache, so that neighbouring tiles and the next slices don't read
+    the same data again.
+
+    The blocks after the requested ones along the direction of travel
+    (see setCourse()) are read in advance, in the background.
+    """
+    isDirty = pyqtSignal( object )
+    numberOfChannelsChanged = pyqtSignal(int)
+
+    _readAheadExecutor = None
+    _readAheadExecutorLock = threading.Lock()
+
+    def __init__( self, rawSource, shape, blockShape=(1,128,128,32,1), maxbytes=None, parent=None ):
+        """
+        rawSource: The original datasource that we'll be requesting data from.
+        shape: The (5D) shape of the data of rawSource.
+        blockShape: The shape of the blocks that are requested from rawSource.
+        maxbytes: The size of the cache (default: datasource_block_cache_mb of the config).
+        """
+        super(BlockCachedDataSource, self).__init__(parent)
+        self._rawSource = rawSource
+        self._rawSource.isDirty.connect( self.setDirty )
+        self._rawSource.numberOfChannelsChanged.connect( self.numberOfChannelsChanged )
+        self._shape = tuple(shape)
+        self.blockShape = tuple( max(1, min(b, n)) for b, n in zip(blockShape, self._shape) )
+        if maxbytes is None:
+            maxbytes = cfg.getint('pixelpipeline', 'datasource_block_cache_mb') * 2**20
+        self._cache = ChunkCache(maxbytes)
+        self._course = None
+        # The blocks that are queued for reading ahead (or being read)
+        self._readAheadPending = set()
+        self._readAheadLock = threading.Lock()
+
+    @property
+    def cache(self):
+        return self._cache
+
+    @property
+    def numberOfChannels(self):
+        return self._rawSource.numberOfChannels
+
+    def clean_up(self):
+        self._rawSource.clean_up()
+
+    @property
+    def dataSlot(self):
+        if hasattr(self._rawSource, "_orig_outslot"):
+            return self._rawSource._orig_outslot
+        else:
+            return None
+
+    def dtype(self):
+        return self._rawSource.dtype()
+
+    def setCourse( self, axis, direction ):
+        """
+        The direction of travel through the data (e.g. the user scrolling
+        through the slices): along the given axis, towards increasing
+        (direction > 0) or decreasing (direction < 0) coordinates.
+        """
+        self._course = (axis, direction)
+
+    def request( self, slicing ):
+        if not is_pure_slicing(slicing):
+            raise Exception('BlockCachedDataSource: slicing is not pure')
+        return BlockCachedRequest( self, slicing )
+
+    def setDirty( self, slicing ):
+        bounds = [ s.indices(n) for s, n in zip(index2slice(slicing), self._shape) ]
+        def intersects( block_index ):
+            return all( i*b < stop and start < (i+1)*b
+                        for i, b, (start, stop, step) in zip(block_index, self.blockShape, bounds) )
+        self._cache.discard( intersects )
+        self.isDirty.emit(slicing)
+
+    def __eq__( self, other ):
+        if other is None or not isinstance( other, type(self) ):
+            return False
+        return self._rawSource == other._rawSource and self.blockShape == other.blockShape
+
+    def __ne__( self, other ):
+        return not ( self == other )
+
+    def _read( self, slicing ):
+        bounds = [ s.indices(n) for s, n in zip(slicing, self._shape) ]
+        result = assemble_blocks( bounds, self.blockShape, self._block, self.dtype() )
+        if result.size > 0:
+            self._readAhead( bounds )
+        return result
+
+    def _block( self, block_index ):
+        slicing = tuple( slice(i*b, min((i+1)*b, n))
+                         for i, b, n in zip(block_index, self.blockShape, self._shape) )
+        return self._cache.get( block_index, lambda: np.asarray(self._rawSource.request(slicing).wait()) )
+
+    def _readAhead( self, bounds ):
+        """
+        Read the blocks next to the given region along the course in the background.
+        """
+        if self._course is None:
+            return
+        axis, direction = self._course
+        blockRanges = [ xrange(start // b, (stop - 1) // b + 1)
+                        for (start, stop, step), b in zip(bounds, self.blockShape) ]
+        if direction > 0:
+            next_block = blockRanges[axis][-1] + 1
+        else:
+            next_block = blockRanges[axis][0] - 1
+        if next_block < 0 or next_block * self.blockShape[axis] >= self._shape[axis]:
+            return
+        blockRanges[axis] = [next_block]
+        for block_index in itertools.product(*blockRanges):
+            with self._readAheadLock:
+                if block_index in self._readAheadPending or block_index in self._cache:
+                    continue
+                self._readAheadPending.add(block_index)
+            self._executor().submit( partial(self._readAheadBlock, block_index), time.time() )
+
+    def _readAheadBlock( self, block_index ):
+        try:
+            self._block(block_index)
+        finally:
+            with self._readAheadLock:
+                self._readAheadPending.discard(block_index)
+
+    @classmethod
+    def _executor( cls ):
+        with cls._readAheadExecutorLock:
+            if cls._readAheadExecutor is None:
+                cls._readAheadExecutor = PrioritizedThreadPoolExecutor(1)
+            return cls._readAheadExecutor
+
+assert issubclass(BlockCachedDataSource, SourceABC)
+
+
+#*******************************************************************************
+# D o w n s a m p l e d D a t a S o u r c e                                    *
+#*******************************************************************************
+
+def downsample_array( a, factors, method='stride' ):
+    """
+    Reduce the array a by the given integer factors along each axis,
+    either by taking every factors[i]-th element ('stride') or by averaging
+    blocks of factors[0] x factors[1] x ... elements ('average').
+    Incomplete blocks at the upper borders count as a whole output element.
+    """
+    if method == 'stride':
+        return a[tuple( slice(None, None, f) for f in factors )]
+
+    assert method == 'average', "Unknown downsampling method: {}".format(method)
+    padding = [ (0, -n % f) for n, f in zip(a.shape, factors) ]
+    blockshape = []
+    for n, f in zip(a.shape, factors):
+        blockshape += [-(-n // f), f]
+    block_axes = tuple(range(1, len(blockshape), 2))
+
+    # Incomplete blocks are zero-padded, and only their actual elements are counted.
+    padded = np.pad(a.astype(np.float64), padding, mode='constant')
+    sums = padded.reshape(blockshape).sum( axis=block_axes )
+    counts = np.pad(np.ones(a.shape), padding, mode='constant').reshape(blockshape).sum( axis=block_axes )
+    reduced = sums / counts
+    if np.issubdtype(a.dtype, np.integer):
+        reduced = np.round(reduced)
+    return reduced.astype(a.dtype)
+
+class DownsampledRequest( object ):
+    def __init__( self, rawRequest, factors, method ):
+        self._rawRequest = rawRequest
+        self._factors = factors
+        self._method = method
+        self._result = None
+
+    def wait( self ):
+        if self._result is None:
+            rawData = self._rawRequest.wait()
+            self._result = downsample_array(rawData, self._factors, self._method)
+        return self._result
+
+    def getResult( self ):
+        return self._result
+
+    def cancel( self ):
+        self._rawRequest.cancel()
+
+    def submit( self ):
+        self._rawRequest.submit()
+
+assert issubclass(DownsampledRequest, RequestABC)
+
+class DownsampledDataSource( QObject ):
+    """
+    A wrapper for other datasources.
+    Presents the data of the underlying datasource downsampled by the given
+    integer factor along each axis, e.g. to render a coarse level of an image pyramid.
+
+    If the underlying datasource can produce downsampled data itself (i.e. it has a
+    requestDownsampled(slicing, factors) method, like ArraySource), it is asked for it.
+    Otherwise, the full-resolution data is requested and reduced afterwards,
+    by striding (suitable for label data) or by averaging.
+    """
+    isDirty = pyqtSignal( object )
+    numberOfChannelsChanged = pyqtSignal(int)
+    
+    def __init__( self, rawSource, factors, method='stride', parent=None ):
+        """
+        rawSource: The original datasource that we'll be requesting data from.
+        factors: For example, to downsample by 4 in x and y only: (1,4,4,1,1)
+        method: 'stride' or 'average' (only used if the rawSource can't downsample by itself)
+        """
+        super(DownsampledDataSource, self).__init__(parent)
+        assert method in ('stride', 'average'), "Unknown downsampling method: {}".format(method)
+        assert all( f >= 1 for f in factors ), "Downsampling factors must be positive integers"
+        self._rawSource = rawSource
+        self._rawSource.isDirty.connect( self.setDirty )
+        self._rawSource.numberOfChannelsChanged.connect( self.numberOfChannelsChanged )
+        self.factors = tuple(factors)
+        self.method = method
+
+    @property
+    def numberOfChannels(self):
+        return self._rawSource.numberOfChannels
+
+    def clean_up(self):
+        self._rawSource.clean_up()
+
+    @property
+    def dataSlot(self):
+        if hasattr(self._rawSource, "_orig_outslot"):
+            return self._rawSource._orig_outslot
+        else:
+            return None
+
+    def dtype(self):
+        return self._rawSource.dtype()
+
+    def request( self, slicing ):
+        raw_slicing = tuple( slice( None if s.start is None else s.start*f,
+                                    None if s.stop is None else s.stop*f )
+                             for s, f in zip(slicing, self.factors) )
+        if hasattr(self._rawSource, 'requestDownsampled'):
+            return self._rawSource.requestDownsampled(raw_slicing, self.factors)
+        return DownsampledRequest(self._rawSource.request(raw_slicing), self.factors, self.method)
+
+    def setDirty( self, slicing ):
+        # Map the dirty region of the raw data into our (downsampled) coordinates,
+        # including every element that is partially covered.
+        downsampled_slicing = tuple( slice( None if s.start is None else s.start // f,
+                                            None if s.stop is None else -(-s.stop // f) )
+                                     for s, f in zip(slicing, self.factors) )
+        self.isDirty.emit(downsampled_slicing)
+
+    def __eq__( self, other ):
+        if other is None or not isinstance( other, type(self) ):
+            return False
+        return self._rawSource == other._rawSource and self.factors == other.factors
+
+    def __ne__( self, other ):
+        return not ( self == other )
+
+assert issubclass(DownsampledDataSource, SourceABC)
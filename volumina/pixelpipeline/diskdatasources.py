@@ -0,0 +1,203 @@
+###############################################################################
+#   volumina: volume slicing and editing library
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+#		   http://ilastik.org/license/
+###############################################################################
+"""
+Datasources for volumes on disk, which are opened without loading them:
+.npy and raw files are memory-mapped, HDF5 datasets are read chunk by chunk
+through a chunk cache that is shared by all layers.
+"""
+import numpy as np
+
+from datasources import ArraySource, ArrayRequest, ChunkCache, assemble_blocks
+from volumina.config import cfg
+
+try:
+    import h5py
+    _has_h5py = True
+except ImportError:
+    _has_h5py = False
+
+def embedding5D(shape):
+    """
+    The canonical embedding of data with the given shape into 5D (txyzc):
+    returns (shape_5d, real_axes), where real_axes are the axes of shape_5d
+    that correspond to the axes of shape.
+    """
+    if len(shape) == 2:
+        return (1,) + shape + (1,1), (1,2)
+    elif len(shape) == 3 and shape[2] <= 4:
+        return (1,) + shape[0:2] + (1,) + (shape[2],), (1,2,4)
+    elif len(shape) == 3:
+        return (1,) + shape + (1,), (1,2,3)
+    elif len(shape) == 4:
+        return (1,) + shape, (1,2,3,4)
+    elif len(shape) == 5:
+        return shape, (0,1,2,3,4)
+    assert False, "Can't handle data with {} axes".format( len(shape) )
+
+#*******************************************************************************
+# M e m m a p A r r a y S o u r c e                                            *
+#*******************************************************************************
+
+class DiskArrayRequest( ArrayRequest ):
+    """
+    Reads the requested data into memory (when waited for, or in the
+    background after submit()), instead of returning a view of the
+    memory-mapped file.
+    """
+    def _fetch( self ):
+        return np.array(self._array[self._slicing])
+
+class MemmapArraySource( ArraySource ):
+    """
+    An ArraySource of a memory-mapped file (numpy.memmap, e.g. from
+    numpy.load(path, mmap_mode='r')), which is never loaded completely:
+    each request reads only the pages of the requested region.
+    """
+    def __init__( self, array ):
+        assert isinstance(array, np.memmap)
+        shape_5d, real_axes = embedding5D(array.shape)
+        super(MemmapArraySource, self).__init__( array.reshape(shape_5d) )
+
+    @classmethod
+    def open( cls, path, dtype=None, shape=None, offset=0, order='C' ):
+        """
+        Open a .npy file (if dtype is None), or a raw file with the given
+        dtype and shape, read-only.
+        """
+        if dtype is None:
+            return cls( np.load(path, mmap_mode='r') )
+        return cls( np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape, order=order) )
+
+    def request( self, slicing ):
+        req = super(MemmapArraySource, self).request(slicing)
+        return DiskArrayRequest(req._array, req._slicing)
+
+    def requestDownsampled( self, slicing, factors ):
+        req = super(MemmapArraySource, self).requestDownsampled(slicing, factors)
+        return DiskArrayRequest(req._array, req._slicing)
+
+# The chunk cache of all HDF5 datasources
+chunkCache = ChunkCache( cfg.getint('pixelpipeline', 'hdf5_chunk_cache_mb') * 2**20 )
+
+#*******************************************************************************
+# H 5 p y D s e t 5 D W r a p p e r                                            *
+#*******************************************************************************
+
+if _has_h5py:
+
+    class H5pyDset5DWrapper(object):
+        
+        def __init__(self, dset):
+            self.dset = dset
+            self.dtype = dset.dtype
+            self.shape, self.real_axes = embedding5D(dset.shape)
+
+        def __getitem__(self, slicing_5d):
+            real_slicing = tuple(slicing_5d[i] for i in self.real_axes)
+            data = self._read(real_slicing)
+            expanded_slicing = [None] * 5
+            for axis in self.real_axes:
+                expanded_slicing[axis] = slice(None)
+            return data[tuple(expanded_slicing)]
+
+        def _read(self, real_slicing):
+            return self.dset[real_slicing]
+
+    class ChunkedH5pyDset5DWrapper(H5pyDset5DWrapper):
+        """
+        Reads whole chunks of the dataset through a ChunkCache, so that
+        neighbouring tiles and layers of the same dataset don't read (and
+        decompress) the same chunks again.
+        Datasets without chunks (contiguous) are read directly.
+        """
+        def __init__(self, dset, cache=None):
+            super(ChunkedH5pyDset5DWrapper, self).__init__(dset)
+            self.cache = cache if cache is not None else chunkCache
+            self.chunks = dset.chunks
+            self._key = (dset.file.filename, dset.name)
+
+        def _read(self, real_slicing):
+            if self.chunks is None:
+                return self.dset[real_slicing]
+            bounds = [ sl.indices(n) for sl, n in zip(real_slicing, self.dset.shape) ]
+            return assemble_blocks( bounds, self.chunks, self._chunk, self.dtype )
+
+        def _chunk(self, chunk_index):
+            chunk_slicing = tuple( slice(i*c, min((i+1)*c, n))
+                                   for i, c, n in zip(chunk_index, self.chunks, self.dset.shape) )
+            return self.cache.get( self._key + (chunk_index,), lambda: self.dset[chunk_slicing] )
+
+        def discard(self, slicing_5d=None):
+            """
+            Remove the cached chunks of this dataset that intersect with the
+            given 5D slicing (all of them, if slicing_5d is None).
+            """
+            if self.chunks is None:
+                return
+            key = self._key
+            if slicing_5d is None:
+                self.cache.discard( lambda k: k[:2] == key )
+                return
+            ranges = []
+            for axis, c, n in zip(self.real_axes, self.chunks, self.dset.shape):
+                start, stop, _ = slicing_5d[axis].indices(n)
+                ranges.append( (start // c, (stop - 1) // c) )
+            self.cache.discard( lambda k: k[:2] == key and
+                                          all( first <= i <= last for i, (first, last) in zip(k[2], ranges) ) )
+
+    class H5pyArraySource( ArraySource ):
+        """
+        An ArraySource of an HDF5 dataset, which is read chunk by chunk
+        through the chunk cache (see ChunkedH5pyDset5DWrapper).
+        Cached chunks are discarded when the source is marked dirty.
+        """
+        def __init__( self, dset, cache=None, ownFile=False ):
+            """
+            ownFile -- whether the source closes the file of the dataset in clean_up()
+            """
+            super(H5pyArraySource, self).__init__( ChunkedH5pyDset5DWrapper(dset, cache) )
+            self._file = dset.file if ownFile else None
+
+        @classmethod
+        def open( cls, filename, internalPath, cache=None ):
+            """
+            Open the dataset internalPath of the given file read-only.
+            The file is closed by clean_up().
+            """
+            f = h5py.File(filename, 'r')
+            try:
+                return cls( f[internalPath], cache, ownFile=True )
+            except:
+                f.close()
+                raise
+
+        def clean_up( self ):
+            if self._array is not None:
+                self._array.discard()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            super(H5pyArraySource, self).clean_up()
+
+        def setDirty( self, slicing ):
+            self._array.discard(slicing)
+            super(H5pyArraySource, self).setDirty(slicing)
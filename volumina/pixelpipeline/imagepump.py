@@ -27,6 +27,7 @@ from PyQt4.QtCore import QObject, pyqtSignal, QRect
 
 #volumina
 from volumina.pixelpipeline.slicesources import SliceSource, SyncedSliceSources
+from volumina.pixelpipeline.datasources import DownsampledDataSource
 from volumina.pixelpipeline.imagesourcefactories import createImageSource
 from volumina.pixelpipeline.imagesources import AlphaModulatedImageSource, ColortableImageSource
 
@@ -204,6 +205,12 @@ class StackedImageSources( QObject ):
     def getRegisteredLayers( self ):
         return self._layerToIms.keys()
 
+    def close( self ):
+        '''Deregister all layers and stop following the LayerStackModel.'''
+        self._layerStackModel.orderChanged.disconnect( self._onOrderChanged )
+        self._layerStackModel.layerRemoved.disconnect( self._onLayerRemoved )
+        self.clear()
+
     def isRegistered( self, layer ):
         return layer in self._layerToIms
 
@@ -325,12 +332,18 @@ class ImagePump( object ):
     def stackedImageSources( self ):
         return self._stackedImageSources
 
-    def __init__( self, layerStackModel, sliceProjection, sync_along=(0,1,2) ):
+    def __init__( self, layerStackModel, sliceProjection, sync_along=(0,1,2), downsample=1 ):
+        """
+        downsample -- if larger than 1, the image sources produce images of the slices
+                      downsampled by this factor (see DownsampledDataSource and pyramidLevel())
+        """
         super(ImagePump, self).__init__()
         self._layerStackModel = layerStackModel
         self._projection = sliceProjection
+        self._downsample = downsample
         self._layerToSliceSrcs = {} # non-injective mapping
         self._sliceSrcToImageSrc = {} # injective mapping
+        self._pyramid = {} # level -> ImagePump
     
         # setup image source stack and slice sources
         self._syncedSliceSources = SyncedSliceSources( sync_along=sync_along )
@@ -340,10 +353,45 @@ class ImagePump( object ):
             self._addLayer( layer )
 
         self._syncedSliceSources.idChanged.connect( self._onIdChanged )
+        self._syncedSliceSources.throughChanged.connect( self._onThroughChanged )
         self._layerStackModel.layerAdded.connect( self._onLayerAdded )
         self._layerStackModel.layerRemoved.connect( self._onLayerRemoved )
         self._layerStackModel.stackCleared.connect( self._onStackCleared )
 
+    def pyramidLevel( self, level ):
+        '''Return the image pump for the given level of an image pyramid.
+
+        Level 0 is this pump itself; level n renders the same slices,
+        downsampled by a factor of 2**n. The pumps of the coarser levels
+        are created on demand and always show the same slice as this one.
+
+        '''
+        if level == 0:
+            return self
+        if level not in self._pyramid:
+            pump = ImagePump( self._layerStackModel, self._projection,
+                              self._syncedSliceSources.getSyncAlong(),
+                              downsample=self._downsample * 2**level )
+            pump.syncedSliceSources.through = self._syncedSliceSources.through
+            self._pyramid[level] = pump
+        return self._pyramid[level]
+
+    def close( self ):
+        '''Disconnect from the LayerStackModel and release the sources of all
+        layers (also of the pyramid levels). The pump can't be used afterwards.
+
+        '''
+        for pump in self._pyramid.itervalues():
+            pump.close()
+        self._pyramid = {}
+        self._syncedSliceSources.idChanged.disconnect( self._onIdChanged )
+        self._syncedSliceSources.throughChanged.disconnect( self._onThroughChanged )
+        self._layerStackModel.layerAdded.disconnect( self._onLayerAdded )
+        self._layerStackModel.layerRemoved.disconnect( self._onLayerRemoved )
+        self._layerStackModel.stackCleared.disconnect( self._onStackCleared )
+        self._onStackCleared()
+        self._stackedImageSources.close()
+
     # mappings
     def layerToSliceSources( self, layer ):
         '''Map from Layer instance to SliceSource instances.
@@ -381,6 +429,10 @@ class ImagePump( object ):
     def _onIdChanged( self, old, new ):
         self._stackedImageSources.stackId = new
 
+    def _onThroughChanged( self, old, new ):
+        for pump in self._pyramid.itervalues():
+            pump.syncedSliceSources.through = new
+
     def _onSourceThroughChanged( self, src, old, new ):
         # if at least one not synced along axis has changed,
         # mark the corresponding image source as dirty
@@ -399,6 +451,11 @@ class ImagePump( object ):
     def _createSources( self, layer ):
         def sliceSrcOrNone( datasrc ):
             if datasrc:
+                if self._downsample > 1:
+                    factors = [1] * (len(self._projection.along) + 2)
+                    factors[self._projection.abscissa] = self._downsample
+                    factors[self._projection.ordinate] = self._downsample
+                    datasrc = DownsampledDataSource( datasrc, factors )
                 return SliceSource( datasrc, self._projection )
             return None
 
@@ -36,9 +36,13 @@ from PyQt4.QtCore import QObject, QRect, pyqtSignal, QMutex
 from PyQt4.QtGui import QImage, QColor
 from qimage2ndarray import gray2qimage, array2qimage, alpha_view, rgb_view, byte_view
 from asyncabcs import SourceABC, RequestABC
+from datasources import ConstantSource
+import numpyKernels
+from compiledColortable import compileColortable
+from conversionPool import conversionPool
 from volumina.slicingtools import is_bounded, slicing2rect, rect2slicing, slicing2shape, is_pure_slicing
 from volumina.config import cfg
-from volumina.utility import execute_in_main_thread
+from volumina.utility import execute_in_main_thread, metrics
 import numpy as np
 
 _has_vigra = True
@@ -62,6 +66,10 @@ class ImageSource( QObject ):
 
     isDirty = pyqtSignal( QRect )
 
+    # The maximal number of requests of this source that are processed at the
+    # same time by the render pool (None: 'render_threads_per_layer' from volumina.config)
+    max_concurrent_requests = None
+
     def __init__( self, name, guarantees_opaqueness = False, parent = None, direct=False ):
         ''' direct: whether this request will be computed synchronously in the GUI thread (direct=True)
                     or whether the request will be put on a worker queue to be computed in a worker thread
@@ -125,10 +133,30 @@ class GrayscaleImageSource( ImageSource ):
         self._arraySource2D = arraySource2D
 
         self._layer = layer
+        # Lookup tables of 8-bit and 16-bit data, by (dtype, normalize)
+        self._lookupTables = {}
         
         self._arraySource2D.isDirty.connect(self.setDirty)
         if hasattr(self._layer, "normalizeChanged"):
-            self._layer.normalizeChanged.connect(lambda: self.setDirty((slice(None,None), slice(None,None))))
+            self._layer.normalizeChanged.connect(self._onNormalizeChanged)
+
+    def _onNormalizeChanged( self ):
+        self._lookupTables = {}
+        self.setDirty((slice(None,None), slice(None,None)))
+
+    def lookupTable( self, dtype, normalize ):
+        """
+        The (cached) color of each possible value of the 8-bit or 16-bit
+        integer dtype, for the given normalization range.
+        """
+        key = (np.dtype(dtype).str, float(normalize[0]), float(normalize[1]))
+        table = self._lookupTables.get(key)
+        if table is None:
+            # Requests may race to build the same table, which is harmless.
+            metrics.increment('imagesource.lut_builds')
+            table = numpyKernels.grayLookupTable(dtype, normalize)
+            self._lookupTables[key] = table
+        return table
 
     def request( self, qrect, along_through=None ):
         if cfg.getboolean('pixelpipeline', 'verbose'):
@@ -141,21 +169,34 @@ class GrayscaleImageSource( ImageSource ):
         assert isinstance(qrect, QRect)
         s = rect2slicing(qrect)
         req = self._arraySource2D.request(s, along_through)
-        return GrayscaleImageRequest( req, self._layer.normalize[0], direct=self.direct )
+        return GrayscaleImageRequest( req, self._layer.normalize[0], direct=self.direct, lookupTable=self.lookupTable )
 assert issubclass(GrayscaleImageSource, SourceABC)
 
 class GrayscaleImageRequest( object ):
     loggingName = __name__ + ".GrayscaleImageRequest"
     logger = logging.getLogger(loggingName)
     
-    def __init__( self, arrayrequest, normalize=None, direct=False ):
+    def __init__( self, arrayrequest, normalize=None, direct=False, lookupTable=None ):
+        """
+        lookupTable -- optional callable (dtype, normalize) -> table, which
+                       provides the lookup tables of 8-bit and 16-bit data
+        """
         self._mutex = QMutex()
         self._arrayreq = arrayrequest
         self._normalize = normalize
+        self._lookupTable = lookupTable
         self.direct = direct
         
     def wait(self):
         return self.toImage()
+
+    def cancel(self):
+        self._arrayreq.cancel()
+
+    def submit(self):
+        # Start reading the data in the background
+        if hasattr(self._arrayreq, 'submit'):
+            self._arrayreq.submit()
         
     def toImage( self ):
         t = time.time()
@@ -191,7 +232,7 @@ class GrayscaleImageRequest( object ):
         # new conversion
         #
         tImg = None
-        if has_no_mask and _has_vigra and hasattr(vigra.colors, 'gray2qimage_ARGB32Premultiplied'):
+        if has_no_mask:
             if not self._normalize or \
                self._normalize[0] >= self._normalize[1] or \
                self._normalize == [0, 0]: #FIXME: fix volumina conventions
@@ -199,14 +240,20 @@ class GrayscaleImageRequest( object ):
             else:
                 n = np.asarray(self._normalize, dtype=np.float32)
             tImg = time.time()
-            img = QImage(a.shape[1], a.shape[0], QImage.Format_ARGB32_Premultiplied)
-            if not a.flags['C_CONTIGUOUS']:
-                a = a.copy()
-            vigra.colors.gray2qimage_ARGB32Premultiplied(a, byte_view(img), n)
+            pool = conversionPool('grayscale')
+            img = pool.convert('gray', [a], a.shape, (n,)) if pool is not None else None
+            if img is None:
+                img = QImage(a.shape[1], a.shape[0], QImage.Format_ARGB32_Premultiplied)
+                if self._lookupTable is not None and numpyKernels.hasLookupTable(a.dtype):
+                    numpyKernels.applyLookupTable(a, self._lookupTable(a.dtype, n), byte_view(img))
+                elif _has_vigra and hasattr(vigra.colors, 'gray2qimage_ARGB32Premultiplied'):
+                    if not a.flags['C_CONTIGUOUS']:
+                        a = a.copy()
+                    vigra.colors.gray2qimage_ARGB32Premultiplied(a, byte_view(img), n)
+                else:
+                    numpyKernels.gray2qimage_ARGB32Premultiplied(a, byte_view(img), n)
             tImg = 1000.0*(time.time()-tImg)
         else:
-            if has_no_mask:
-                self.logger.warning("using slow image creation function")
             tImg = time.time()
             if self._normalize:
                 #clipping has been implemented in this commit,
@@ -217,6 +264,8 @@ class GrayscaleImageRequest( object ):
             ret = img.convertToFormat(QImage.Format_ARGB32_Premultiplied)
             tImg = 1000.0*(time.time()-tImg)
         
+        metrics.observe('imagesource.wait', tWAIT + tAR)
+        metrics.observe('imagesource.to_qimage', tImg)
         if self.logger.isEnabledFor(logging.DEBUG):
             tTOT = 1000.0*(time.time()-t)
             self.logger.debug("toImage (%dx%d, normalize=%r) took %f msec. (array req: %f, wait: %f, img: %f)" % (img.width(), img.height(), normalize, tTOT, tAR, tWAIT, tImg))
@@ -265,6 +314,14 @@ class AlphaModulatedImageRequest( object ):
     def wait(self):
         return self.toImage()
 
+    def cancel(self):
+        self._arrayreq.cancel()
+
+    def submit(self):
+        # Start reading the data in the background
+        if hasattr(self._arrayreq, 'submit'):
+            self._arrayreq.submit()
+
     def toImage( self ):
         t = time.time()
        
@@ -279,20 +336,24 @@ class AlphaModulatedImageRequest( object ):
         has_no_mask = not np.ma.is_masked(a)
 
         tImg = None
-        if has_no_mask and _has_vigra and hasattr(vigra.colors, 'gray2qimage_ARGB32Premultiplied'):
-            if not a.flags.contiguous:
-                a = a.copy()
+        if has_no_mask:
             tImg = time.time()
-            img = QImage(a.shape[1], a.shape[0], QImage.Format_ARGB32_Premultiplied)
             tintColor = np.asarray([self._tintColor.redF(), self._tintColor.greenF(), self._tintColor.blueF()], dtype=np.float32);
             normalize = np.asarray(self._normalize, dtype=np.float32)
             if normalize[0] > normalize[1]:
                 normalize = np.array( (0.0, 255.0) ).astype( np.float32 )
-            vigra.colors.alphamodulated2qimage_ARGB32Premultiplied(a, byte_view(img), tintColor, normalize) 
+            pool = conversionPool('alphamodulated')
+            img = pool.convert('alphamodulated', [a], a.shape, (tintColor, normalize)) if pool is not None else None
+            if img is None:
+                img = QImage(a.shape[1], a.shape[0], QImage.Format_ARGB32_Premultiplied)
+                if _has_vigra and hasattr(vigra.colors, 'alphamodulated2qimage_ARGB32Premultiplied'):
+                    if not a.flags.contiguous:
+                        a = a.copy()
+                    vigra.colors.alphamodulated2qimage_ARGB32Premultiplied(a, byte_view(img), tintColor, normalize) 
+                else:
+                    numpyKernels.alphamodulated2qimage_ARGB32Premultiplied(a, byte_view(img), tintColor, normalize)
             tImg = 1000.0*(time.time()-tImg)
         else:
-            if has_no_mask:
-                self.logger.warning("using unoptimized conversion functions")
             tImg = time.time()
             d = a[..., None].repeat(4, axis=-1)
             d[:,:,0] = d[:,:,0]*self._tintColor.redF()
@@ -304,6 +365,8 @@ class AlphaModulatedImageRequest( object ):
             img = img.convertToFormat(QImage.Format_ARGB32_Premultiplied)        
             tImg = 1000.0*(time.time()-tImg)
        
+        metrics.observe('imagesource.wait', tWAIT + tAR)
+        metrics.observe('imagesource.to_qimage', tImg)
         if self.logger.isEnabledFor(logging.DEBUG):
             tTOT = 1000.0*(time.time()-t)
             self.logger.debug("toImage (%dx%d, normalize=%r) took %f msec. (array req: %f, wait: %f, img: %f)" % (img.width(), img.height(), normalize, tTOT, tAR, tWAIT, tImg))
@@ -335,21 +398,8 @@ class ColortableImageSource( ImageSource ):
             self._layer.normalizeChanged.connect(lambda: self.setDirty((slice(None,None), slice(None,None))))
 
     def updateColorTable(self):
-        layerColorTable = self._layer.colorTable
-        self._colorTable = np.zeros((len(layerColorTable), 4), dtype=np.uint8)
-
-        for i, c in enumerate(layerColorTable):
-            #note that we use qimage2ndarray.byte_view() on a QImage with Format_ARGB32 below.
-            #this means that the memory layout actually is B, G, R, A
-
-            if isinstance(c, QColor):
-                color = c
-            else: 
-                color = QColor.fromRgba(c)
-            self._colorTable[i,0] = color.blue()
-            self._colorTable[i,1] = color.green()
-            self._colorTable[i,2] = color.red()
-            self._colorTable[i,3] = color.alpha() 
+        # Sources with the same colors share the compiled table
+        self._colorTable = compileColortable(self._layer.colorTable)
         
         self.isDirty.emit(QRect()) # empty rect == everything is dirty
         
@@ -381,6 +431,14 @@ class ColortableImageRequest( object ):
 
     def wait(self):
         return self.toImage()
+
+    def cancel(self):
+        self._arrayreq.cancel()
+
+    def submit(self):
+        # Start reading the data in the background
+        if hasattr(self._arrayreq, 'submit'):
+            self._arrayreq.submit()
         
     def toImage( self ):
         t = time.time()
@@ -412,71 +470,60 @@ class ColortableImageRequest( object ):
             elif len(self._colorTable) <= 2**32:
                 a = np.asanyarray( a, dtype=np.uint32 )
 
-        # Use vigra if possible (much faster)
-        tImg = None
-        if _has_vigra and hasattr(vigra.colors, 'applyColortable'):
-            tImg = time.time()
+        tImg = time.time()
+        if not issubclass( a.dtype.type, np.integer ):
+            # Float labels (without normalization) are truncated to integers;
+            # negative labels wrap around like the other 64-bit data below.
+            warnings.warn("Data for colortable layers cannot be float, casting", RuntimeWarning)
+            a = np.asanyarray(a, dtype=np.int64)
+
+        # If we have a masked array with a non-trivial mask, ensure that mask is made transparent.
+        _colorTable = self._colorTable
+        if np.ma.is_masked(a):
+            # Add transparent color at the beginning of the colortable as needed.
+            if (_colorTable.colors[0, 3] != 0):
+                # If label 0 is unused, it can be transparent. Otherwise, the transparent color must be inserted.
+                if (a.min() == 0):
+                    # If it will overflow simply promote the type. Unless we have reached the max VIGRA type.
+                    if (a.max() == np.iinfo(a.dtype).max):
+                        a_new_dtype = np.min_scalar_type(np.iinfo(a.dtype).max + 1)
+                        if a_new_dtype <= np.dtype(np.uint32):
+                             a = np.asanyarray(a, dtype=a_new_dtype)
+                        else:
+                            assert (np.iinfo(a.dtype).max >= len(_colorTable)), \
+                                   "This is a very large colortable. If it is indeed needed, add a transparent" + \
+                                   " color at the beginning of the colortable for displaying masked arrays."
+
+                            # Try to wrap the max value to a smaller value of the same color.
+                            a[a == np.iinfo(a.dtype).max] %= len(_colorTable)
+
+                    # Insert space for transparent color and shift labels up.
+                    _colorTable = _colorTable.withTransparentInserted()
+                    a[:] = a+1
+                else:
+                    # Make sure the first color is transparent.
+                    _colorTable = _colorTable.withTransparentZero()
+
+            # Make masked values transparent.
+            a = np.ma.filled(a, 0)
+
+        if a.dtype in (np.uint64, np.int64):
+            # FIXME: applyColortable() doesn't support 64-bit, so just truncate
+            a = a.astype(np.uint32)
+
+        pool = conversionPool('colortable')
+        img = pool.applyColortable(a, _colorTable) if pool is not None else None
+        if img is None:
             img = QImage(a.shape[1], a.shape[0], QImage.Format_ARGB32)
-            if not issubclass( a.dtype.type, np.integer ):
-                raise NotImplementedError()
-                #FIXME: maybe this should be done in a better way using an operator before the colortable request which properly handles 
-                #this problem 
-                warnings.warn("Data for colortable layers cannot be float, casting",RuntimeWarning)
-                a = np.asanyarray(a, dtype=np.uint32)
-
-            # If we have a masked array with a non-trivial mask, ensure that mask is made transparent.
-            _colorTable = self._colorTable
-            if np.ma.is_masked(a):
-                # Add transparent color at the beginning of the colortable as needed.
-                if (_colorTable[0, 3] != 0):
-                    # If label 0 is unused, it can be transparent. Otherwise, the transparent color must be inserted.
-                    if (a.min() == 0):
-                        # If it will overflow simply promote the type. Unless we have reached the max VIGRA type.
-                        if (a.max() == np.iinfo(a.dtype).max):
-                            a_new_dtype = np.min_scalar_type(np.iinfo(a.dtype).max + 1)
-                            if a_new_dtype <= np.dtype(np.uint32):
-                                 a = np.asanyarray(a, dtype=a_new_dtype)
-                            else:
-                                assert (np.iinfo(a.dtype).max >= len(_colorTable)), \
-                                       "This is a very large colortable. If it is indeed needed, add a transparent" + \
-                                       " color at the beginning of the colortable for displaying masked arrays."
-
-                                # Try to wrap the max value to a smaller value of the same color.
-                                a[a == np.iinfo(a.dtype).max] %= len(_colorTable)
-
-                        # Insert space for transparent color and shift labels up.
-                        _colorTable = np.insert(_colorTable, 0, 0, axis=0)
-                        a[:] = a+1
-                    else:
-                        # Make sure the first color is transparent.
-                        _colorTable = _colorTable.copy()
-                        _colorTable[0] = 0
-
-                # Make masked values transparent.
-                a = np.ma.filled(a, 0)
-
-            if a.dtype in (np.uint64, np.int64):
-                # FIXME: applyColortable() doesn't support 64-bit, so just truncate
-                a = a.astype(np.uint32)
-
-            vigra.colors.applyColortable(a.astype(np.uint32), _colorTable, byte_view(img))
-            tImg = 1000.0*(time.time()-tImg)
+            if a.dtype == np.uint32 and a.flags['C_CONTIGUOUS'] and _has_vigra and hasattr(vigra.colors, 'applyColortable'):
+                vigra.colors.applyColortable(a, _colorTable.colors, byte_view(img))
+            else:
+                # No need to convert the data to uint32
+                _colorTable.apply(a, byte_view(img))
+        tImg = 1000.0*(time.time()-tImg)
 
-        # Without vigra, do it the slow way 
-        else:
-            raise NotImplementedError()
-            if _has_vigra:
-                # If this warning is annoying you, try this:
-                # warnings.filterwarnings("once")
-                warnings.warn("Using slow colortable images.  Upgrade to VIGRA > 1.9 to use faster implementation.")
-
-            #make sure that a has values in range [0, colortable_length)
-            a = np.remainder(a, len(self._colorTable))
-            #apply colortable
-            colortable = np.roll(np.fliplr(self._colorTable), -1, 1) # self._colorTable is BGRA, but array2qimage wants RGBA
-            img = colortable[a]
-            img = array2qimage(img)
-            
+        metrics.observe('imagesource.wait', tWAIT + tAR)
+        metrics.observe('imagesource.to_qimage', tImg)
         if self.logger.isEnabledFor(logging.DEBUG):
             tTOT = 1000.0*(time.time()-t)
             self.logger.debug("toImage (%dx%d) took %f msec. (array req: %f, wait: %f, img: %f)" % (img.width(), img.height(), tTOT, tAR, tWAIT, tImg))
@@ -519,10 +566,9 @@ class RGBAImageSource( ImageSource ):
             
         assert isinstance(qrect, QRect)
         s = rect2slicing( qrect )
-        r = self._channels[0].request(s, along_through)
-        g = self._channels[1].request(s, along_through)
-        b = self._channels[2].request(s, along_through)
-        a = self._channels[3].request(s, along_through)
+        # Constant channels are passed as scalars and need not be requested
+        r, g, b, a = [ channel.constant if isinstance(channel, ConstantSource) else channel.request(s, along_through)
+                       for channel in self._channels ]
         shape = list( slicing2shape(s) )
         assert len(shape) == 2
         assert all([x > 0 for x in shape])
@@ -532,32 +578,44 @@ assert issubclass(RGBAImageSource, SourceABC)
 class RGBAImageRequest( object ):
     def __init__( self, r, g, b, a, shape,
                   normalizeR=None, normalizeG=None, normalizeB=None, normalizeA=None ):
+        """
+        r, g, b, a -- array requests, or scalars for constant channels
+        """
         self._mutex = QMutex()
-        self._requests = r, g, b, a
+        self._channels = r, g, b, a
+        self._requests = [c for c in self._channels if not np.isscalar(c)]
         self._normalize = map(lambda n: n or None, [normalizeR, normalizeG, normalizeB, normalizeA])
-        shape.append(4)
-        self._data = np.empty(shape, dtype=np.uint8)
-        self._requestsFinished = 4 * [False,]
+        self._shape = tuple(shape)
 
     def wait(self):
+        tWAIT = time.time()
+        # Read all channels at the same time
+        for req in self._requests[1:]:
+            if hasattr(req, 'submit'):
+                req.submit()
         for req in self._requests:
             req.wait()
-        return self.toImage()
+        metrics.observe('imagesource.wait', 1000.0*(time.time()-tWAIT))
+        with metrics.timer('imagesource.to_qimage'):
+            return self.toImage()
+
+    def cancel(self):
+        for req in self._requests:
+            req.cancel()
+
+    def submit(self):
+        for req in self._requests:
+            if hasattr(req, 'submit'):
+                req.submit()
 
     def toImage( self ):
-        for i, req in enumerate(self._requests):
-            a = req.getResult()
-            normalize = self._normalize[i]
-            if normalize is not None and \
-               normalize[0] < normalize[1]:
-                a = a.astype(np.float32)
-                a = (a - normalize[0])*255.0 / (normalize[1]-normalize[0])
-                a[a > 255] = 255
-                a[a < 0]   = 0
-                a = a.astype(np.uint8)
-            self._data[:,:,i] = a
-        img = array2qimage(self._data)
-        return img.convertToFormat(QImage.Format_ARGB32_Premultiplied)        
+        channels = [ c if np.isscalar(c) else c.getResult() for c in self._channels ]
+        pool = conversionPool('rgba')
+        img = pool.convert('rgba', channels, self._shape, (self._normalize,)) if pool is not None else None
+        if img is None:
+            img = QImage(self._shape[1], self._shape[0], QImage.Format_ARGB32_Premultiplied)
+            numpyKernels.rgba2qimage_ARGB32Premultiplied(channels, byte_view(img), self._normalize)
+        return img
 
 assert issubclass(RGBAImageRequest, RequestABC)
 
@@ -0,0 +1,196 @@
+###############################################################################
+#   volumina: volume slicing and editing library
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+#		   http://ilastik.org/license/
+###############################################################################
+"""
+Pure NumPy replacements for the image conversion functions of vigra.colors,
+with the same signatures.  They write directly into the buffer of a
+QImage with Format_ARGB32(_Premultiplied), given as qimage2ndarray.byte_view().
+
+Every pixel is produced by a single lookup in a table of 32-bit (BGRA) colors:
+integer data with at most 16 bits is looked up directly, other data is first
+normalized to 0..255 in a single pass.
+"""
+import numpy as np
+
+def gray2qimage_ARGB32Premultiplied(a, out, normalize):
+    """
+    Write the 2D array a into out (the byte_view of a QImage), as opaque gray values.
+    normalize -- (min, max): the data range that is mapped to 0..255
+    """
+    _lookup(a, normalize, _GRAY_COLORS, out)
+
+def alphamodulated2qimage_ARGB32Premultiplied(a, out, tintColor, normalize):
+    """
+    Write the 2D array a into out (the byte_view of a QImage), as the alpha
+    channel of the given tint color.
+    tintColor -- (red, green, blue) in 0..1
+    normalize -- (min, max): the data range that is mapped to alpha 0..255
+    """
+    _lookup(a, normalize, _alphaColors(tintColor), out)
+
+def applyColortable(a, colortable, out):
+    """
+    Write the 2D integer array a into out (the byte_view of a QImage),
+    with the colors of the given table (an Nx4 uint8 array in BGRA order).
+    The values of a are taken modulo the length of the table.
+    """
+    colors = np.ascontiguousarray(colortable, dtype=np.uint8).view(np.uint32).reshape(-1)
+    _take(colors, a, out, mode='wrap')
+
+def rgba2qimage_ARGB32Premultiplied(channels, out, normalize):
+    """
+    Write the red, green, blue and alpha channels into out (the byte_view of
+    a QImage with Format_ARGB32_Premultiplied).
+    channels  -- four 2D arrays, or scalars for constant channels (which are
+                 not normalized)
+    normalize -- for each channel (min, max): the data range that is mapped
+                 to 0..255, or None
+    """
+    # Gathering into contiguous buffers and copying them into the (strided)
+    # channels of out is faster than gathering into the channels directly.
+    shape = out.shape[:2]
+    alpha = _channelUint8(channels[3], normalize[3], np.empty(shape, np.uint8))
+    out[:,:,3] = alpha
+    if not np.isscalar(alpha):
+        # Index into _PREMULTIPLIED (alpha << 8 | color)
+        alphaIndex = alpha.astype(np.uint16)
+        alphaIndex <<= 8
+        index = np.empty(shape, np.uint16)
+    color = np.empty(shape, np.uint8)
+    for channel, n, k in zip(channels[:3], normalize[:3], (2,1,0)): # BGRA
+        c = _channelUint8(channel, n, color)
+        if np.isscalar(alpha):
+            if np.isscalar(c):
+                out[:,:,k] = _PREMULTIPLIED[alpha, c]
+            else:
+                if alpha != 255:
+                    np.take(_PREMULTIPLIED[alpha], c, out=color, mode='clip')
+                out[:,:,k] = color
+        else:
+            if np.isscalar(c):
+                np.take(_PREMULTIPLIED[:,c], alpha, out=color, mode='clip')
+            else:
+                np.bitwise_or(alphaIndex, c, out=index)
+                np.take(_PREMULTIPLIED.reshape(-1), index, out=color, mode='clip')
+            out[:,:,k] = color
+
+def hasLookupTable(dtype):
+    """
+    Whether data of the given dtype can be converted with a lookup table
+    of all its possible values (8-bit and 16-bit integers).
+    """
+    dtype = np.dtype(dtype)
+    return dtype.kind in 'ui' and dtype.itemsize <= 2
+
+def grayLookupTable(dtype, normalize):
+    """
+    The opaque gray color (BGRA uint32) of each possible value of the given
+    8-bit or 16-bit integer dtype, for use with applyLookupTable().
+    """
+    return _GRAY_COLORS[_normalizationTable(np.dtype(dtype), normalize)]
+
+def applyLookupTable(a, table, out):
+    """
+    Write table[a] into out (the byte_view of a QImage), where table was
+    built for the dtype of the 8-bit or 16-bit integer array a.
+    """
+    _take( table, a.view(np.dtype('u%d' % a.dtype.itemsize)), out )
+
+def normalize_uint8(a, normalize):
+    """
+    Map the data range normalize=(min, max) of a to 0..255 (with rounding),
+    in a single pass over the data.
+    """
+    nmin, nmax = float(normalize[0]), float(normalize[1])
+    t = np.subtract(a, nmin, dtype=np.float32)
+    t *= 255.0 / max(nmax - nmin, 1e-35)
+    np.clip(t, 0, 255, out=t)
+    t += 0.5
+    return t.astype(np.uint8)
+
+def _lookup(a, normalize, colors, out):
+    """
+    Write colors[normalized a] into out.
+    """
+    if hasLookupTable(a.dtype):
+        # Look up the colors of all possible values directly.
+        applyLookupTable( a, colors[_normalizationTable(a.dtype, normalize)], out )
+    else:
+        _take( colors, normalize_uint8(a, normalize), out )
+
+def _normalizationTable(dtype, normalize):
+    """
+    The normalized value (uint8) of each possible value of the given
+    8-bit or 16-bit integer dtype, indexed by its bit pattern (as unsigned).
+    """
+    bits = np.arange( 2**(8*dtype.itemsize), dtype=np.dtype('u%d' % dtype.itemsize) )
+    values = bits.view( np.dtype('i%d' % dtype.itemsize) ) if dtype.kind == 'i' else bits
+    return normalize_uint8(values, normalize)
+
+def _channelUint8(a, normalize, out):
+    """
+    The values of the channel a as uint8: normalized if a valid
+    normalization range is given, otherwise just cast.
+    Arrays are written into out (and returned), scalars are returned as int.
+    """
+    if np.isscalar(a):
+        return int(min(max(round(a), 0), 255))
+    if normalize is not None and normalize[0] < normalize[1]:
+        if hasLookupTable(a.dtype):
+            np.take( _normalizationTable(a.dtype, normalize),
+                     a.view(np.dtype('u%d' % a.dtype.itemsize)), out=out, mode='clip' )
+        else:
+            out[...] = normalize_uint8(a, normalize)
+    else:
+        out[...] = a
+    return out
+
+def _take(colors, indices, out, mode='clip'):
+    out32 = out.view(np.uint32).reshape(out.shape[:2])
+    if out32.flags.c_contiguous:
+        np.take(colors, indices, out=out32, mode=mode)
+    else:
+        out32[...] = np.take(colors, indices, mode=mode)
+
+def _grayColors():
+    """
+    The 256 opaque gray values, as BGRA uint32.
+    """
+    colors = np.empty((256, 4), dtype=np.uint8)
+    colors[:,0:3] = np.arange(256, dtype=np.uint8)[:,None]
+    colors[:,3] = 255
+    return colors.view(np.uint32).reshape(-1)
+
+def _alphaColors(tintColor):
+    """
+    The tint color with each of the 256 alpha values (premultiplied), as BGRA uint32.
+    """
+    alpha = np.arange(256, dtype=np.float32)
+    colors = np.empty((256, 4), dtype=np.uint8)
+    for channel, value in zip((2,1,0), tintColor): # BGRA
+        colors[:,channel] = alpha * float(value) + 0.5
+    colors[:,3] = alpha
+    return colors.view(np.uint32).reshape(-1)
+
+_GRAY_COLORS = _grayColors()
+
+# _PREMULTIPLIED[alpha, color] = round(alpha * color / 255)
+_PREMULTIPLIED = ( (2 * np.arange(256)[:,None] * np.arange(256)[None,:] + 255) // 510 ).astype(np.uint8)
@@ -22,25 +22,27 @@
 #Python
 import sys
 import time
+import math
 import collections
 import threading
 from collections import defaultdict, OrderedDict
-from contextlib import contextmanager
 from functools import partial
-import warnings
 
 #SciPy
 import numpy
 
 #PyQt
-from PyQt4.QtCore import QRect, QRectF, QMutex, QObject, pyqtSignal
+from PyQt4.QtCore import QRect, QRectF, QPointF, QSize, QMutex, QObject, pyqtSignal
 from PyQt4.QtGui import QImage, QPainter, QTransform, QGraphicsItem
 
 #volumina
 from patchAccessor import PatchAccessor
+from diskTileCache import DiskTileCache
 import volumina
+from volumina.config import cfg
 from volumina.pixelpipeline.asyncabcs import IndeterminateRequestError
-from volumina.utility import log_exception, PrioritizedThreadPoolExecutor
+from volumina.utility import log_exception, PrioritizedThreadPoolExecutor, metrics
+from volumina.utility.prioritizedThreadPool import WorkerLimitTuner
 
 import logging
 logger = logging.getLogger(__name__)
@@ -52,38 +54,73 @@ try:
 except ImportError:
     USE_LAZYFLOW_THREADPOOL = False
 
-def submit_to_threadpool(fn, priority):
+def submit_to_threadpool(fn, priority, ims=None):
+    """
+    Submit fn to the render pool.
+    Returns a handle for the task, which can be used to cancel() it.
+    ims -- the ImageSource that fn requests from; the number of its requests
+           that run at the same time is limited (see get_render_pool())
+    """
     if USE_LAZYFLOW_THREADPOOL:
         # Tiling requests are less prioritized than most requests.
         root_priority = [1] + list(priority)
         req = Request(fn, root_priority)
         req.submit()
+        return req
     else:
-        get_render_pool().submit(fn, priority)
+        return get_render_pool().submit(fn, priority, group=ims,
+                                        limit=getattr(ims, 'max_concurrent_requests', None))
 
 renderer_pool = None
 def get_render_pool():
     """
     Return the global thread pool for requesting layer data from ImageSource objects.
     (Create it first if necessary.)
+
+    Configured in volumina.config:
+    render_threads           -- the number of worker threads (initially, if tuned)
+    render_threads_autotune  -- whether to adjust the number of workers to the
+                                queue latency and CPU utilization (see WorkerLimitTuner)
+    render_threads_max       -- the maximal number of workers when tuned
+    render_threads_per_layer -- the maximal number of concurrent requests to one
+                                ImageSource, or if <= 0, relative to the number
+                                of workers (by default all but one of them, so
+                                that a slow layer cannot starve the others);
+                                ImageSource.max_concurrent_requests overrides it
     """
     global renderer_pool
     if renderer_pool is None:
-        renderer_pool = PrioritizedThreadPoolExecutor(6)
+        n_threads = cfg.getint('pixelpipeline', 'render_threads')
+        tuner = None
+        if cfg.getboolean('pixelpipeline', 'render_threads_autotune'):
+            max_threads = max(n_threads, cfg.getint('pixelpipeline', 'render_threads_max'))
+            tuner = WorkerLimitTuner(min(2, n_threads), max_threads)
+        renderer_pool = PrioritizedThreadPoolExecutor(n_threads, cfg.getint('pixelpipeline', 'render_threads_per_layer'), tuner)
     return renderer_pool
 
-
-@contextmanager
-def TileTimer():
-    result = TileTime()
-    start = time.time()
-    try:
-        yield result
-    finally:
-        result.seconds = time.time() - start
-
-class TileTime(object):
-    seconds = 0.0
+def paint_patches(size, base_img, patches):
+    """
+    Paint the given (QImage, opacity) layer patches (from bottom to top)
+    over a copy of base_img, or over a new white image of the given size
+    (QSize), if base_img is None.
+    """
+    if base_img is None:
+        qimg = QImage(size, QImage.Format_ARGB32_Premultiplied)
+        qimg.fill(0xffffffff) # Use a hex constant instead.
+    else:
+        qimg = base_img.copy()
+    p = QPainter(qimg)
+    for patch, layerOpacity in patches:
+        p.setOpacity(layerOpacity)
+        p.drawImage(0,0, patch)
+    p.end()
+    return qimg
+
+# Transforms the layer images (which are indexed [abscissa, ordinate])
+# into the orientation of the scene
+LAYER_IMAGE_TRANSFORM = QTransform(0,1,0,
+                                   1,0,0,
+                                   1,1,1)
 
 class Tiling(object):
     """
@@ -93,7 +130,7 @@ class Tiling(object):
 
     def __init__(self, sliceShape, data2scene=QTransform(),
                  blockSize=512, overlap=0, overlap_draw=1e-3,
-                 name="Unnamed Tiling"):
+                 name="Unnamed Tiling", downsample=1):
         """
         Args:
             sliceShape -- (width, height)
@@ -102,8 +139,11 @@ class Tiling(object):
             blockSize  -- base tile size: blockSize x blockSize (default 256)
             overlap    -- overlap between tiles positive number prevents rendering
                           artifacts between tiles for certain zoom levels (default 1)
+            downsample -- the factor by which the data is downsampled with respect
+                          to the scene, i.e. the scale included in data2scene (default 1)
         """
         self.blockSize = blockSize
+        self.downsample = downsample
         self.overlap = overlap
         self._patchAccessor = PatchAccessor(sliceShape[0],
                                             sliceShape[1],
@@ -113,12 +153,7 @@ class Tiling(object):
 
         numPatches = self._patchAccessor.patchCount
 
-        self.imageRectFs = [None]*numPatches
-        self.dataRectFs  = [None]*numPatches
-        self.tileRectFs  = [None]*numPatches
-        self.imageRects  = [None]*numPatches
         self.dataRects   = [None]*numPatches
-        self.tileRects   = [None]*numPatches
         self.sliceShape  = sliceShape
         self.name = name
         self.data2scene = data2scene
@@ -133,45 +168,58 @@ class Tiling(object):
         self.scene2data, isInvertible = data2scene.inverted()
         assert isInvertible
 
-        for patchNr in range(self._patchAccessor.patchCount):
-            # the patch accessor uses the data coordinate system.
-            # because the patch is drawn on the screen, its holds coordinates
-            # corresponding to Qt's QGraphicsScene's system, which need to be
-            # converted to scene coordinates
-
-            # the image rectangle includes an overlap margin
-            imageRectF = data2scene.mapRect(self._patchAccessor.patchRectF(patchNr, self.overlap))
-
-            # the patch rectangle has per default no overlap
-            patchRectF = data2scene.mapRect(self._patchAccessor.patchRectF(patchNr, 0))
-
-            # add a little overlap when the overlap_draw setting is
-            # activated
-            if self._overlap_draw != 0:
-                patchRectF = QRectF(patchRectF.x() - self._overlap_draw,
-                                    patchRectF.y() - self._overlap_draw,
-                                    patchRectF.width() + 2 * self._overlap_draw,
-                                    patchRectF.height() + 2 * self._overlap_draw)
-
-            patchRect = QRect(round(patchRectF.x()),
-                              round(patchRectF.y()),
-                              round(patchRectF.width()),
-                              round(patchRectF.height()))
-
-            # the image rectangles of neighboring patches can overlap
-            # slightly, to account for inaccuracies in sub-pixel
-            # rendering of many ImagePatch objects
-            imageRect = QRect(round(imageRectF.x()),
-                              round(imageRectF.y()),
-                              round(imageRectF.width()),
-                              round(imageRectF.height()))
-
-            self.imageRectFs[patchNr] = imageRectF
-            self.dataRectFs[ patchNr] = imageRectF
-            self.tileRectFs[ patchNr] = patchRectF
-            self.imageRects[ patchNr] = imageRect
-            self.tileRects[  patchNr] = patchRect
-
+        # The patch accessor uses the data coordinate system.
+        # Because the patches are drawn on the screen, their rects hold coordinates
+        # corresponding to Qt's QGraphicsScene's system, which need to be
+        # converted to scene coordinates.
+        # The rects of all patches are computed at once, and the Qt rect objects
+        # are only created when they are accessed.
+
+        # the image rectangle includes an overlap margin
+        imageRectF = _mapRects(data2scene, *self._patchAccessor.patchBounds(self.overlap))
+
+        # the patch rectangle has per default no overlap
+        x, y, w, h = _mapRects(data2scene, *self._patchAccessor.patchBounds(0))
+
+        # add a little overlap when the overlap_draw setting is
+        # activated
+        if self._overlap_draw != 0:
+            x, y = x - self._overlap_draw, y - self._overlap_draw
+            w, h = w + 2 * self._overlap_draw, h + 2 * self._overlap_draw
+        patchRectF = (x, y, w, h)
+        self._tileRectCoords = patchRectF
+
+        # the image rectangles of neighboring patches can overlap
+        # slightly, to account for inaccuracies in sub-pixel
+        # rendering of many ImagePatch objects
+        self.imageRectFs = _RectList(QRectF, *imageRectF)
+        self.dataRectFs  = self.imageRectFs
+        self.tileRectFs  = _RectList(QRectF, *patchRectF)
+        self.imageRects  = _RectList(QRect, *map(_round, imageRectF))
+        self.tileRects   = _RectList(QRect, *map(_round, patchRectF))
+
+    def downsampled(self, factor):
+        """
+        Return a tiling of the same scene for data that is downsampled by the
+        given factor, e.g. for a coarser level of an image pyramid.
+        Its tiles have the same size (in data pixels), so they cover
+        factor x factor times more of the scene.
+        """
+        w, h = self.sliceShape
+        shape = ( -(-w // factor), -(-h // factor) )
+        return Tiling( shape, QTransform.fromScale(factor, factor) * self.data2scene,
+                       blockSize=self.blockSize, overlap=self.overlap,
+                       overlap_draw=self._overlap_draw, name=self.name,
+                       downsample=self.downsample*factor )
+
+    def imageSize(self, patchNr):
+        """
+        The size (in data pixels) of the image of the given patch.
+        """
+        size = self.imageRects[patchNr].size()
+        if self.downsample == 1:
+            return size
+        return QSize( size.width() // self.downsample, size.height() // self.downsample )
 
     def boundingRectF(self):
         if self.tileRectFs:
@@ -182,23 +230,102 @@ class Tiling(object):
         return br
 
     def containsF(self, point):
-        for i, p in enumerate(self.tileRectFs):
-            if p.contains(point):
-                return i
+        """
+        Return the number of the (first) tile whose tileRectF contains the given
+        scene point, or None.
+        """
+        if len(self) == 0:
+            return None
+
+        # Find the patch in data coordinates, then check its neighbors too,
+        # because the tile rects overlap slightly (see overlap_draw).
+        pa = self._patchAccessor
+        x, y = self.scene2data.map(float(point.x()), float(point.y()))
+        col = min(max(int(numpy.floor(x / pa._blockSize)), 0), pa._cX - 1)
+        row = min(max(int(numpy.floor(y / pa._blockSize)), 0), pa._cY - 1)
+
+        tx, ty, tw, th = self._tileRectCoords
+        px, py = point.x(), point.y()
+        found = None
+        for r in range(max(row-1, 0), min(row+2, pa._cY)):
+            for c in range(max(col-1, 0), min(col+2, pa._cX)):
+                i = r * pa._cX + c
+                if tx[i] <= px <= tx[i] + tw[i] and ty[i] <= py <= ty[i] + th[i]:
+                    if found is None or i < found:
+                        found = i
+        return found
 
     def intersected(self, sceneRect):
         if not sceneRect.isValid():
-            return range(len(self.tileRects))
+            return range(len(self))
 
         # Patch accessor uses data coordinates
-        rect = self.data2scene.inverted()[0].mapRect(sceneRect)
+        rect = self.scene2data.mapRect(sceneRect)
         patchNumbers = self._patchAccessor.getPatchesForRect(
                             rect.topLeft().x(), rect.topLeft().y(),
                             rect.bottomRight().x(), rect.bottomRight().y() )
         return patchNumbers
 
     def __len__(self):
-        return len(self.imageRectFs)
+        return self._patchAccessor.patchCount
+
+def _mapRects(transform, startx, endx, starty, endy):
+    """
+    Like QTransform.mapRect(), but for arrays of rects (given by their bounds).
+    Returns the arrays (x, y, width, height) of the mapped rects.
+    """
+    xs, ys = [], []
+    for cx, cy in ((startx, starty), (endx, starty), (startx, endy), (endx, endy)):
+        xs.append( transform.m11() * cx + transform.m21() * cy + transform.dx() )
+        ys.append( transform.m12() * cx + transform.m22() * cy + transform.dy() )
+    left, top = numpy.min(xs, axis=0), numpy.min(ys, axis=0)
+    right, bottom = numpy.max(xs, axis=0), numpy.max(ys, axis=0)
+    return left, top, right - left, bottom - top
+
+def _round(a):
+    """
+    Round an array like python's round() (halfway cases away from zero).
+    """
+    return numpy.sign(a) * numpy.floor(numpy.abs(a) + 0.5)
+
+class _RectList(object):
+    """
+    A read-only list of QRectFs or QRects, which are only created when they are accessed.
+    """
+    def __init__(self, rectType, x, y, w, h):
+        self._rectType = rectType
+        self._coords = (x, y, w, h)
+        self._rects = {}
+
+    def __len__(self):
+        return len(self._coords[0])
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("rect index out of range")
+        rect = self._rects.get(i)
+        if rect is None:
+            x, y, w, h = (c[i] for c in self._coords)
+            if self._rectType is QRect:
+                rect = QRect(int(x), int(y), int(w), int(h))
+            else:
+                rect = QRectF(float(x), float(y), float(w), float(h))
+            self._rects[i] = rect
+        return rect
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not ( self == other )
 
 class _MultiCache( object ):
     """
@@ -229,33 +356,73 @@ class _MultiCache( object ):
         self.caches[uid] = c
 
     def set_maxcaches(self, newmax):
+        """
+        Returns the list of uids that had to be removed to satisfy the new maximum.
+        """
         self._maxcaches = newmax
+        old_uids = []
         while len(self.caches) > self._maxcaches:
             old_uid, v = self.caches.popitem(False) # removes item in FIFO order
+            old_uids.append(old_uid)
+        return old_uids
 
 class _TilesCache( object ):
     """
     Contains the following caches, with convenience accessor functions for each.
     
         layerCache: A cache of 'layers', i.e. for every patch a QImage or QGraphicsItem
-                    for every "image source" in the stack
+                    for every "image source" in the stack (indexed tile -> layer)
+        
+        graphicsItemCache: The subset of layerCache holding QGraphicsItems (indexed tile -> layer)
         
         tileCache: A cache of 'tiles', i.e. the blended QImage objects 
                    that were created by combining all QImage layers from layerCache for a given patch.
                    (The QGraphicsItem layers do not contribute to the composite tiles in the tileCache.
                    They are merely stored.)
 
-        layerCacheDirty: A cache of dirty bits for all layers in layerCache
+        layerCacheDirty: A cache of dirty bits for all layers in layerCache (indexed layer -> tile)
         layerCacheTimestamp: A cache of timestamps to track how recently each layer was needed.
+                             (indexed layer -> tile)
 
         tileCacheDirty: A cache of dirty bits for the composite tiles
                         (i.e. for a given patch, if a single layer in the patch
                         is dirty, then the tile for that patch is dirty)
+
+        tileCacheRasterDirty: A second cache of dirty bits for the composite tiles,
+                              which is only set if the tile must be re-blended,
+                              i.e. if a QImage layer has changed or the stack
+                              properties (visibility, opacity, order) have changed.
+                              New QGraphicsItem layers don't require re-blending.
+
+        tilePrefixCache: For every composite tile, the blend of the lowest (unchanged)
+                         QImage layers, so that a change to a layer only requires
+                         the layers above it to be re-blended.
+
+    Besides the maximal number of stacks, the cache can be limited by the total
+    number of bytes occupied by its QImages (layers and composite tiles).
+    When that budget is exceeded, single entries are evicted in
+    least-recently-used order.  An evicted entry is simply considered dirty
+    (and will be re-fetched or re-blended) the next time it is needed.
+
+    If a diskCache (see DiskTileCache) is given, the (clean) QImage layers 
+    that are evicted, or dropped together with the oldest stack, are written to it.
     """
-    def __init__(self, first_stack_id, sims, maxstacks=None):
+    def __init__(self, first_stack_id, sims, maxstacks=None, maxbytes=None, diskCache=None):
         self._lock = threading.Lock()
         self._sims = sims
         self._maxstacks = maxstacks
+        self._maxbytes = maxbytes
+        self._diskCache = diskCache
+
+        # Sizes of all cached QImages, in least-recently-used order:
+        # [('tile', stack_id, tile_id)], [('prefix', stack_id, tile_id)]
+        # or [('layer', stack_id, (tile_id, ims))] -> bytes
+        self._entryBytes = OrderedDict()
+        self._usedBytes = 0
+
+        # Counters for lookups of composite tiles
+        self.hits = 0
+        self.misses = 0
 
         kwargs = {'first_uid' : first_stack_id,
                   'maxcaches' : maxstacks}
@@ -265,15 +432,28 @@ class _TilesCache( object ):
 
         # [stack_id][tile_id] -> bool
         self._tileCacheDirty = _MultiCache(default_factory=lambda: True, **kwargs)
+
+        # [stack_id][tile_id] -> bool
+        self._tileCacheRasterDirty = _MultiCache(default_factory=lambda: True, **kwargs)
+
+        # [stack_id][tile_id] -> (((QImage, opacity), ...), prefix_len, QImage)
+        self._tilePrefixCache = _MultiCache(default_factory=lambda: None, **kwargs)
         
-        # [stack_id][(ims, tile_id)] -> QImage or QGraphicsItem
-        self._layerCache = _MultiCache(**kwargs)
+        # The per-layer caches are nested, so that all layers of a tile (or all
+        # tiles of a layer) can be found without scanning the whole stack.
+        # Missing entries are dirty, have no image and a timestamp of 0.
+
+        # [stack_id][tile_id][ims] -> QImage or QGraphicsItem
+        self._layerCache = _MultiCache(default_factory=dict, **kwargs)
+
+        # [stack_id][tile_id][ims] -> QGraphicsItem
+        self._graphicsItemCache = _MultiCache(default_factory=dict, **kwargs)
         
-        # [stack_id][(ims, tile_id)] -> bool
-        self._layerCacheDirty = _MultiCache(default_factory=lambda: True, **kwargs)
+        # [stack_id][ims][tile_id] -> bool
+        self._layerCacheDirty = _MultiCache(default_factory=dict, **kwargs)
         
-        # [stack_id][(ims, tile_id)] -> float
-        self._layerCacheTimestamp = _MultiCache(default_factory=float, **kwargs)
+        # [stack_id][ims][tile_id] -> float
+        self._layerCacheTimestamp = _MultiCache(default_factory=dict, **kwargs)
         
 
     @property
@@ -284,11 +464,30 @@ class _TilesCache( object ):
         if self._maxstacks == maxstacks:
             return
         self._maxstacks = maxstacks
-        self._tileCache.set_maxcaches(self._maxstacks)
+        removed_stacks = self._tileCache.set_maxcaches(self._maxstacks)
         self._tileCacheDirty.set_maxcaches(self._maxstacks)
+        self._tileCacheRasterDirty.set_maxcaches(self._maxstacks)
+        self._tilePrefixCache.set_maxcaches(self._maxstacks)
         self._layerCache.set_maxcaches(self._maxstacks)
+        self._graphicsItemCache.set_maxcaches(self._maxstacks)
         self._layerCacheDirty.set_maxcaches(self._maxstacks)
         self._layerCacheTimestamp.set_maxcaches(self._maxstacks)
+        with self:
+            for stack_id in removed_stacks:
+                self._forgetStackEntries(stack_id)
+
+    @property
+    def maxbytes(self):
+        return self._maxbytes
+
+    def set_maxbytes(self, maxbytes):
+        with self:
+            self._maxbytes = maxbytes
+            self._evictIfNecessary()
+
+    @property
+    def usedBytes(self):
+        return self._usedBytes
 
     def __enter__(self):
         self._lock.acquire()
@@ -308,16 +507,43 @@ class _TilesCache( object ):
 
     def tile( self, stack_id, tile_id ):
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
-        return self._tileCache.caches[stack_id][tile_id]
+        img, progress = self._tileCache.caches[stack_id][tile_id]
+        if img is not None:
+            self.hits += 1
+            metrics.increment('tilecache.hits')
+            # The layers (and the partial composite) of a shown tile are
+            # needed for its next blend: they age together with the tile.
+            for layer_id in self._layerCache.caches[stack_id].get(tile_id, ()):
+                self._touchEntry( ('layer', stack_id, (tile_id, layer_id)) )
+            self._touchEntry( ('prefix', stack_id, tile_id) )
+            self._touchEntry( ('tile', stack_id, tile_id) )
+        else:
+            self.misses += 1
+            metrics.increment('tilecache.misses')
+        return img, progress
 
     def setTile( self, stack_id, tile_id, img, stack_visible, stack_occluded ):
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
+        progress = self._tileProgress(stack_id, tile_id, stack_visible, stack_occluded)
+        self._tileCache.caches[stack_id][tile_id] = (img, progress)
+        self._setEntryBytes( ('tile', stack_id, tile_id), img )
+
+    def updateTileProgress( self, stack_id, tile_id, stack_visible, stack_occluded ):
+        """
+        Recompute the progress of a tile without replacing its composite image.
+        """
+        assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
+        img, _ = self._tileCache.caches[stack_id][tile_id]
+        progress = self._tileProgress(stack_id, tile_id, stack_visible, stack_occluded)
+        self._tileCache.caches[stack_id][tile_id] = (img, progress)
+
+    def _tileProgress( self, stack_id, tile_id, stack_visible, stack_occluded ):
         if len(stack_visible) > 0:
             visible = numpy.asarray(stack_visible)
             occluded = numpy.asarray(stack_occluded)
             visibleAndNotOccluded = numpy.logical_and(visible, numpy.logical_not(occluded))
             if visibleAndNotOccluded.any():
-                dirty = numpy.asarray([self._layerCacheDirty.caches[stack_id][(ims, tile_id)]
+                dirty = numpy.asarray([self.layerDirty(stack_id, ims, tile_id)
                                        for ims in self._sims.viewImageSources()])
                 num = numpy.count_nonzero(numpy.logical_and(dirty, visibleAndNotOccluded) == True)
                 denom = float(numpy.count_nonzero(visibleAndNotOccluded))
@@ -326,7 +552,40 @@ class _TilesCache( object ):
                 progress = 1.0
         else:
             progress = 1.0
-        self._tileCache.caches[stack_id][tile_id] = (img, progress)
+        return progress
+
+    def tilePrefix( self, stack_id, tile_id ):
+        """
+        Return the partial composite of the given tile, as stored by setTilePrefix(), or None.
+        """
+        assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
+        prefix = self._tilePrefixCache.caches[stack_id].get(tile_id)
+        if prefix is not None:
+            self._touchEntry( ('prefix', stack_id, tile_id) )
+        return prefix
+
+    def setTilePrefix( self, stack_id, tile_id, patches, prefix_len, prefix_img ):
+        """
+        Store the partial composite of a tile.
+
+        patches    -- the (QImage, opacity) layer patches that were blended into 
+                      the last composite tile, from bottom to top.
+        prefix_len -- the number of patches that are blended into prefix_img
+        prefix_img -- the blend of patches[:prefix_len] (None if prefix_len is 0)
+        """
+        assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
+        self._tilePrefixCache.caches[stack_id][tile_id] = (tuple(patches), prefix_len, prefix_img)
+        self._setEntryBytes( ('prefix', stack_id, tile_id), prefix_img )
+
+    def clearTilePrefixes( self ):
+        """
+        Forget the partial composites of all tiles in all stacks.
+        """
+        assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
+        for stack_id in self._tilePrefixCache.caches:
+            self._tilePrefixCache.caches[stack_id].clear()
+        for key in [k for k in self._entryBytes if k[0] == 'prefix']:
+            self._usedBytes -= self._entryBytes.pop(key)
 
     def tileDirty( self, stack_id, tile_id ):
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
@@ -336,6 +595,14 @@ class _TilesCache( object ):
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
         self._tileCacheDirty.caches[stack_id][tile_id] = b
 
+    def tileRasterDirty( self, stack_id, tile_id ):
+        assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
+        return self._tileCacheRasterDirty.caches[stack_id][tile_id]
+
+    def setTileRasterDirty( self, stack_id, tile_id, b ):
+        assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
+        self._tileCacheRasterDirty.caches[stack_id][tile_id] = b
+
     def setTileDirtyAllStacks( self, tile_id, b):
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
         for stack_id in self._tileCacheDirty.caches:
@@ -347,32 +614,39 @@ class _TilesCache( object ):
         Unlike the QImage layers, the QGraphicsItem layers are not composited into the 'tile'. 
         """
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
+        items = self._graphicsItemCache.caches[stack_id].get(tile_id)
+        if not items:
+            return []
+        return items.values()
 
-        warnings.warn("FIXME: This is a slow way to look for the items we want.\n"
-                      "_TilesCache._layerCache should be a dict-of-dict-of-dict for faster lookup!")
-        qgraphicsitems = []
-        for (layer_id, t_id), img in self._layerCache.caches[stack_id].iteritems():
-            if t_id == tile_id and isinstance(img, QGraphicsItem):
-                qgraphicsitems.append(img)
-        return qgraphicsitems
-
-    def setAllTilesDirty( self ):
+    def setAllTilesDirty( self, raster=True ):
         """
         Mark all tiles in all stacks as dirty.
+        If raster is True, all tiles must also be re-blended.
         For speed, this is done by simply deleting all entries 
         (by default missing entries are considered dirty).
         """
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
         for stack_id in self._tileCacheDirty.caches:
             self._tileCacheDirty.caches[stack_id].clear()
+        if raster:
+            for stack_id in self._tileCacheRasterDirty.caches:
+                self._tileCacheRasterDirty.caches[stack_id].clear()
 
     def layer(self, stack_id, layer_id, tile_id ):
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
-        return self._layerCache.caches[stack_id][(layer_id,tile_id)]
+        self._touchEntry( ('layer', stack_id, (tile_id, layer_id)) )
+        layers = self._layerCache.caches[stack_id].get(tile_id)
+        if not layers:
+            return None
+        return layers.get(layer_id)
 
     def layerDirty(self, stack_id, layer_id, tile_id ):
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
-        return self._layerCacheDirty.caches[stack_id][(layer_id, tile_id)]
+        tiles = self._layerCacheDirty.caches[stack_id].get(layer_id)
+        if tiles is None:
+            return True
+        return tiles.get(tile_id, True)
 
     def setLayerDirtyAllStacks( self, layer_id, tile_id, b ):
         """
@@ -380,7 +654,7 @@ class _TilesCache( object ):
         """
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
         for stack_id in self._layerCacheDirty.caches:
-            self._layerCacheDirty.caches[stack_id][(layer_id, tile_id)] = b
+            self._layerCacheDirty.caches[stack_id][layer_id][tile_id] = b
 
     def setLayerDirtyAllTiles(self, layer_id):
         """
@@ -390,51 +664,212 @@ class _TilesCache( object ):
         """ 
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
         for stack_id in self._layerCacheDirty.caches:
-            dirty_entries = [(l_id, t_id) for (l_id, t_id) in self._layerCacheDirty.caches[stack_id].keys() if l_id == layer_id]
-            #dirty_entries = filter( lambda (l_id, t_id): l_id == layer_id, self._layerCacheDirty.caches[stack_id].keys() )
-            for entry in dirty_entries:
-                del self._layerCacheDirty.caches[stack_id][entry]
+            self._layerCacheDirty.caches[stack_id].pop(layer_id, None)
 
     def layerTimestamp(self, stack_id, layer_id, tile_id ):
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
-        return self._layerCacheTimestamp.caches[stack_id][(layer_id, tile_id)]
+        tiles = self._layerCacheTimestamp.caches[stack_id].get(layer_id)
+        if tiles is None:
+            return 0.0
+        return tiles.get(tile_id, 0.0)
 
     def addStack( self, stack_id ):
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
-        self._tileCache.add( stack_id )
+        if self._diskCache is not None and self._maxstacks and len(self._layerCache.caches) >= self._maxstacks:
+            # The oldest stack is about to be dropped.
+            self._spillStack( next(iter(self._layerCache.caches)) )
+        removed_stack = self._tileCache.add( stack_id )
         self._tileCacheDirty.add( stack_id, default_factory=lambda:True )
-        self._layerCache.add( stack_id )
-        self._layerCacheDirty.add( stack_id, default_factory=lambda:True )
-        self._layerCacheTimestamp.add( stack_id, default_factory=float )
+        self._tileCacheRasterDirty.add( stack_id, default_factory=lambda:True )
+        self._tilePrefixCache.add( stack_id, default_factory=lambda:None )
+        self._layerCache.add( stack_id, default_factory=dict )
+        self._graphicsItemCache.add( stack_id, default_factory=dict )
+        self._layerCacheDirty.add( stack_id, default_factory=dict )
+        self._layerCacheTimestamp.add( stack_id, default_factory=dict )
+        if removed_stack is not None:
+            self._forgetStackEntries( removed_stack )
 
 
     def touchStack( self, stack_id ):
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
         self._tileCache.touch( stack_id )
         self._tileCacheDirty.touch( stack_id )
+        self._tileCacheRasterDirty.touch( stack_id )
+        self._tilePrefixCache.touch( stack_id )
         self._layerCache.touch( stack_id )
+        self._graphicsItemCache.touch( stack_id )
         self._layerCacheDirty.touch( stack_id )
         self._layerCacheTimestamp.touch( stack_id )
 
 
     def updateTileIfNecessary( self, stack_id, layer_id, tile_id, req_timestamp, img):
         assert self._lock.locked(), "You must claim the _TileCache via a context manager before calling this function."
-        if req_timestamp > self._layerCacheTimestamp.caches[stack_id][(layer_id, tile_id)]:
-            self._layerCache.caches[stack_id][(layer_id, tile_id)] = img
-            self._layerCacheDirty.caches[stack_id][(layer_id, tile_id)] = False
-            self._layerCacheTimestamp.caches[stack_id][(layer_id, tile_id)] = req_timestamp
-            
-            # FIXME: We are currently keeping track of only 1 dirty bit.
-            #        It is set if any layer in the tile is dirty, regardless of 
-            #        whether or not that layer is a QImage or QGraphicsItem
-            #        This means that when a QGraphicsItem becomes dirty, the 
-            #        layer stack is re-blended.  It's a waste of time, because 
-            #        none of the raster layers changed (they were all clean and 
-            #        haven't changed since the last time the tile was blended.)
-            #        We could fix this inefficiency by tracking 2 dirty bits, for 
-            #        QImage layers and QGraphicsLayers, respectively, and checking
-            #        those bits in _blendTile()
+        if req_timestamp > self.layerTimestamp(stack_id, layer_id, tile_id):
+            self._layerCache.caches[stack_id][tile_id][layer_id] = img
+            if isinstance(img, QGraphicsItem):
+                self._graphicsItemCache.caches[stack_id][tile_id][layer_id] = img
+            self._layerCacheDirty.caches[stack_id][layer_id][tile_id] = False
+            self._layerCacheTimestamp.caches[stack_id][layer_id][tile_id] = req_timestamp
+            self._setEntryBytes( ('layer', stack_id, (tile_id, layer_id)), img )
+
+            # The tile needs a refresh (for its progress and QGraphicsItems),
+            # but it only has to be re-blended if a raster layer changed.
             self._tileCacheDirty.caches[stack_id][tile_id] = True
+            if not isinstance(img, QGraphicsItem):
+                self._tileCacheRasterDirty.caches[stack_id][tile_id] = True
+
+    def _setEntryBytes( self, key, img ):
+        """
+        Record the size of a (new) cached image and evict old entries if the
+        memory budget is exceeded.  QGraphicsItems are not accounted for.
+        """
+        self._usedBytes -= self._entryBytes.pop(key, 0)
+        if isinstance(img, QImage):
+            nbytes = img.byteCount()
+            self._entryBytes[key] = nbytes
+            self._usedBytes += nbytes
+            self._evictIfNecessary()
+
+    def _touchEntry( self, key ):
+        nbytes = self._entryBytes.pop(key, None)
+        if nbytes is not None:
+            self._entryBytes[key] = nbytes
+
+    def _evictIfNecessary( self ):
+        if self._maxbytes is None:
+            return
+        # Never evict the most recently used entry, even if it alone exceeds the budget.
+        while self._usedBytes > self._maxbytes and len(self._entryBytes) > 1:
+            key, nbytes = self._entryBytes.popitem(False) # least recently used first
+            self._usedBytes -= nbytes
+            kind, stack_id, entry_id = key
+            if kind == 'tile':
+                self._tileCache.caches[stack_id].pop(entry_id, None)
+                self._tileCacheDirty.caches[stack_id].pop(entry_id, None)
+                self._tileCacheRasterDirty.caches[stack_id].pop(entry_id, None)
+            elif kind == 'prefix':
+                self._tilePrefixCache.caches[stack_id].pop(entry_id, None)
+            else:
+                # Missing entries are dirty and have a timestamp of 0
+                tile_id, layer_id = entry_id
+                img = self._layerCache.caches[stack_id][tile_id].pop(layer_id, None)
+                dirty = self._layerCacheDirty.caches[stack_id][layer_id].pop(tile_id, True)
+                self._layerCacheTimestamp.caches[stack_id][layer_id].pop(tile_id, None)
+                if not dirty:
+                    self._spillLayer(stack_id, layer_id, tile_id, img)
+                # The next refresh of the tile must fetch the layer again
+                # (the tile is re-blended when it arrives).
+                self._tileCacheDirty.caches[stack_id][tile_id] = True
+                # The partial composite of the tile refers to the evicted image.
+                if self._tilePrefixCache.caches[stack_id].pop(tile_id, None) is not None:
+                    self._usedBytes -= self._entryBytes.pop( ('prefix', stack_id, tile_id), 0 )
+
+    def _spillLayer( self, stack_id, layer_id, tile_id, img ):
+        """
+        Write a clean layer tile that is dropped from memory to the disk cache.
+        Layers that can be requested directly are cheaper to fetch again.
+        """
+        if self._diskCache is not None and isinstance(img, QImage) \
+                and not getattr(layer_id, 'direct', False):
+            self._diskCache.put(layer_id, stack_id, tile_id, img)
+
+    def _spillStack( self, stack_id ):
+        for tile_id, layers in self._layerCache.caches[stack_id].iteritems():
+            for layer_id, img in layers.iteritems():
+                if not self.layerDirty(stack_id, layer_id, tile_id):
+                    self._spillLayer(stack_id, layer_id, tile_id, img)
+
+    def _forgetStackEntries( self, stack_id ):
+        """
+        Called after a whole stack was dropped from the caches.
+        """
+        for key in [k for k in self._entryBytes if k[1] == stack_id]:
+            self._usedBytes -= self._entryBytes.pop(key)
+
+
+class _TileFetch( object ):
+    """
+    A pending request for a single layer tile, as submitted to
+    the render pool by TileProvider._refreshTile().
+    """
+    def __init__(self, ims_req, prefetch=False, onFinished=None):
+        self.ims_req = ims_req
+        self.prefetch = prefetch
+        self.fn = None
+        self.task = None
+        self.cancelled = False
+        self._onFinished = onFinished
+        self._finished = False
+        self._finishedLock = threading.Lock()
+
+    def cancel(self):
+        """
+        Drop the task if it didn't start yet, and cancel the
+        underlying image request (e.g. a LazyflowRequest) otherwise.
+        """
+        self.cancelled = True
+        if self.task is not None:
+            self.task.cancel()
+        if hasattr(self.ims_req, 'cancel'):
+            self.ims_req.cancel()
+        # The task may never run.
+        self.finish()
+
+    def finish(self):
+        """
+        Called when the fetch is over (done, failed or cancelled).
+        Only the first call counts.
+        """
+        with self._finishedLock:
+            if self._finished:
+                return
+            self._finished = True
+        if self._onFinished is not None:
+            self._onFinished()
+
+
+class _FetchTracker( object ):
+    """
+    Counts the layer tile fetches of each stack that are not over yet,
+    and wakes up the threads that wait for tiles (see TileProvider.waitForTiles())
+    whenever one of them is over.
+    """
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._outstanding = defaultdict(int)
+        self._finishedCount = 0
+
+    @property
+    def finishedCount(self):
+        """
+        The number of fetches that are over (of all stacks).
+        """
+        with self._condition:
+            return self._finishedCount
+
+    def outstanding(self, stack_id):
+        with self._condition:
+            return self._outstanding.get(stack_id, 0)
+
+    def started(self, stack_id):
+        with self._condition:
+            self._outstanding[stack_id] += 1
+
+    def finished(self, stack_id):
+        with self._condition:
+            self._outstanding[stack_id] -= 1
+            if self._outstanding[stack_id] <= 0:
+                del self._outstanding[stack_id]
+            self._finishedCount += 1
+            self._condition.notify_all()
+
+    def wait(self, finishedCount, timeout=None):
+        """
+        Wait until more than finishedCount fetches are over, or until the timeout.
+        """
+        with self._condition:
+            if self._finishedCount == finishedCount:
+                self._condition.wait(timeout)
 
 
 class TileProvider( QObject ):
@@ -458,34 +893,65 @@ class TileProvider( QObject ):
     @axesSwapped.setter
     def axesSwapped(self, value):
         self._axesSwapped = value
+        for tp in self._levelProviders.itervalues():
+            tp.axesSwapped = value
+        self._checkDiskCacheGeometry()
 
     def __init__( self, tiling, stackedImageSources, cache_size=100,
-                  request_queue_size=100000, n_threads=2,
-                  parent=None ):
+                  request_queue_size=100000, n_threads=None,
+                  cache_memory_limit=None, disk_cache=None, parent=None ):
         """
         Keyword Arguments:
         cache_size                -- maximal number of encountered stacks
                                      to cache, i.e. slices if the imagesources
                                      draw from slicesources (default 10)
+        cache_memory_limit        -- maximal number of bytes occupied by cached
+                                     layer and composite tiles (default: 'tile_cache_memory_mb'
+                                     from volumina.config, where 0 means unlimited),
+                                     shared with the levels of the pyramid (see setPyramid())
+        disk_cache                -- a DiskTileCache for layer tiles evicted from memory
+                                     (default: one limited to 'tile_disk_cache_mb' from
+                                     volumina.config, in 'tile_disk_cache_dir'; 0 disables it),
+                                     or False for none
         request_queue_size        -- maximal number of request to queue up (default 100000)
-        n_threads                 -- maximal number of request threads; this determines the
-                                     maximal number of simultaneously running requests
-                                     to the pixelpipeline (default: 2)
+        n_threads                 -- ignored: the requests of all tile providers run in the
+                                     shared render pool (see get_render_pool())
         parent                    -- QObject
     
         """
     
         QObject.__init__( self, parent = parent )
 
+        # Image pyramid (see setPyramid())
+        self._pyramid = None
+        self._maxLevel = 0
+        self._levelProviders = {} # level -> TileProvider
+        self._level = 0 # our level, if we are the provider of a level
+
         self.tiling = tiling
+
+        # Only a disk cache that we created is closed by close().
+        self._ownsDiskCache = False
+        if disk_cache is None:
+            disk_cache_limit = cfg.getint('pixelpipeline', 'tile_disk_cache_mb') * 2**20
+            if disk_cache_limit > 0:
+                disk_cache = DiskTileCache(cfg.get('pixelpipeline', 'tile_disk_cache_dir'), disk_cache_limit)
+                self._ownsDiskCache = True
+        self._diskCache = disk_cache if disk_cache is not False else None
+        self._diskCacheGeometry = (False, QTransform(tiling.data2scene))
+
         self.axesSwapped = False
         self._sims = stackedImageSources
         self._request_queue_size = request_queue_size
-        self._n_threads = n_threads
+
+        if cache_memory_limit is None:
+            cache_memory_limit = cfg.getint('pixelpipeline', 'tile_cache_memory_mb') * 2**20 or None
+        self._cacheMemoryLimit = cache_memory_limit
 
         self._current_stack_id = self._sims.stackId
         self._cache = _TilesCache(self._current_stack_id, self._sims,
-                                  maxstacks=cache_size)
+                                  maxstacks=cache_size, maxbytes=cache_memory_limit,
+                                  diskCache=self._diskCache)
 
         self._sims.layerDirty.connect(self._onLayerDirty)
         self._sims.visibleChanged.connect(self._onVisibleChanged)
@@ -495,7 +961,47 @@ class TileProvider( QObject ):
         self._sims.stackIdChanged.connect(self._onStackIdChanged)
 
         self._keepRendering = True
+        self._skipped_blends = 0
+        self._reused_blend_layers = 0
+
+        # Layer tile requests that were submitted to the render pool,
+        # but didn't finish yet: [stack_id][(tile_no, ims)] -> _TileFetch
+        self._pendingFetches = defaultdict(dict)
+        self._pendingFetchesLock = threading.Lock()
+        self._fetchTracker = _FetchTracker()
+        self._cancelled_requests = 0
+        self._coalesced_requests = 0
+
+        # The part of the scene that is shown, and the point the user looks at
+        # (see setViewport()); tiles close to it are fetched first.
+        self._viewport = None
+        self._focus = None
     
+    def close( self ):
+        """
+        Stop following the StackedImageSources, cancel the pending fetches, and
+        close the providers of the pyramid levels and our own disk cache
+        (with its writer thread and directory).
+        The tile provider can't be used afterwards.
+        """
+        self._sims.layerDirty.disconnect(self._onLayerDirty)
+        self._sims.visibleChanged.disconnect(self._onVisibleChanged)
+        self._sims.opacityChanged.disconnect(self._onOpacityChanged)
+        self._sims.sizeChanged.disconnect(self._onSizeChanged)
+        self._sims.orderChanged.disconnect(self._onOrderChanged)
+        self._sims.stackIdChanged.disconnect(self._onStackIdChanged)
+
+        with self._pendingFetchesLock:
+            stack_ids = list(self._pendingFetches)
+        for stack_id in stack_ids:
+            self._cancelPendingFetches(stack_id)
+
+        for tp in self._levelProviders.itervalues():
+            tp.close()
+        self._levelProviders = {}
+        if self._ownsDiskCache:
+            self._diskCache.close()
+
     @property
     def cache_size(self):
         return self._cache.maxstacks
@@ -503,7 +1009,200 @@ class TileProvider( QObject ):
     def set_cache_size(self, new_size):
         self._cache.set_maxstacks(new_size)
 
-    def getTiles( self, rectF ):
+    @property
+    def cache_memory_limit(self):
+        return self._cacheMemoryLimit
+
+    def set_cache_memory_limit(self, nbytes):
+        """
+        Limit the memory (in bytes) occupied by cached tiles (of all levels
+        of the pyramid). None means unlimited.
+        """
+        self._cacheMemoryLimit = nbytes
+        self._splitCacheMemory()
+
+    def _splitCacheMemory(self):
+        """
+        Split the memory budget evenly among this level and the levels of
+        the pyramid that are in use: whichever level is shown, it covers
+        about the same number of (screen) pixels.
+        """
+        nbytes = self._cacheMemoryLimit
+        if nbytes is not None:
+            nbytes //= 1 + len(self._levelProviders)
+        self._cache.set_maxbytes(nbytes)
+        for tp in self._levelProviders.itervalues():
+            tp.set_cache_memory_limit(nbytes)
+
+    @property
+    def cache_memory_usage(self):
+        """
+        Number of bytes currently occupied by cached layer and composite tiles
+        (of all levels of the pyramid).
+        """
+        return self._cache.usedBytes + sum( tp.cache_memory_usage for tp in self._levelProviders.itervalues() )
+
+    @property
+    def metrics(self):
+        """
+        The PipelineMetrics (timings and counters) of the pixel pipeline,
+        which are shared by all tile providers.
+        """
+        return metrics
+
+    @property
+    def disk_cache(self):
+        """
+        The DiskTileCache (or None), to which layer tiles are evicted.
+        """
+        return self._diskCache
+
+    @property
+    def cache_hits(self):
+        """
+        Number of composite tile lookups that found a rendered image in the cache.
+        """
+        return self._cache.hits
+
+    @property
+    def cache_misses(self):
+        """
+        Number of composite tile lookups that found no image in the cache.
+        """
+        return self._cache.misses
+
+    @property
+    def skipped_blends(self):
+        """
+        Number of tile refreshes that did not need to re-blend the
+        composite tile, because only QGraphicsItem layers had changed.
+        """
+        return self._skipped_blends
+
+    @property
+    def reused_blend_layers(self):
+        """
+        Number of layer patches that did not need to be painted again when
+        re-blending composite tiles, because a cached partial composite was reused.
+        """
+        return self._reused_blend_layers
+
+    @property
+    def cancelled_requests(self):
+        """
+        Number of layer tile requests that were cancelled because
+        the stack they belong to was no longer shown.
+        """
+        return self._cancelled_requests
+
+    @property
+    def coalesced_requests(self):
+        """
+        Number of layer tile requests that were not submitted, because 
+        the same tile of the same layer was already being fetched.
+        """
+        return self._coalesced_requests
+
+    def setViewport( self, rectF, focus=None ):
+        """
+        Tell the tile provider which part of the scene is shown (rectF) and
+        where the user looks (focus, a QPointF; default: the center of rectF),
+        so that the visible tiles closest to the focus are fetched first.
+        Pending fetches that didn't start yet are re-prioritized when the
+        viewport changes.
+        """
+        rectF = QRectF(rectF)
+        focus = QPointF(focus) if focus is not None else rectF.center()
+        # Small movements of the focus don't change the order of the tiles.
+        if self._viewport is None or rectF != self._viewport or \
+                abs(focus.x() - self._focus.x()) + abs(focus.y() - self._focus.y()) >= self.tiling.blockSize / 2:
+            self._viewport = rectF
+            self._focus = focus
+            self._reprioritizePendingFetches()
+        for tp in self._levelProviders.itervalues():
+            tp.setViewport(rectF, focus)
+
+    def _reprioritizePendingFetches( self ):
+        """
+        Resubmit the pending (non-prefetch) fetches of the current stack
+        that didn't start yet, with priorities for the current viewport.
+        """
+        # Lazyflow requests can't be re-prioritized without cancelling them.
+        if USE_LAZYFLOW_THREADPOOL:
+            return
+        with self._pendingFetchesLock:
+            fetches = self._pendingFetches.get(self._current_stack_id, {}).items()
+        refresh_time = time.time()
+        for (tile_no, ims), fetch in fetches:
+            if not fetch.prefetch and fetch.task is not None and fetch.task.cancel():
+                fetch.task = submit_to_threadpool( fetch.fn, (False, -refresh_time, self._tilePriority(tile_no)), ims )
+
+    def _tilePriority( self, tile_no ):
+        """
+        The priority of the given tile within a refresh: the distance of its
+        center from the focus, doubled for tiles that are not visible at all.
+        Smaller values are fetched first.
+        """
+        if self._viewport is None:
+            return 0.0
+        rect = QRectF(self.tiling.imageRects[tile_no])
+        area = rect.width() * rect.height()
+        visible = rect.intersected(self._viewport)
+        visibleFraction = 0.0
+        if area > 0 and visible.isValid():
+            visibleFraction = visible.width() * visible.height() / area
+        distance = math.hypot( rect.center().x() - self._focus.x(), rect.center().y() - self._focus.y() )
+        return distance * (2.0 - visibleFraction)
+
+    def setPyramid( self, pyramid, max_level ):
+        """
+        Enable the level-of-detail mode: when the scene is shown at a small scale,
+        the tiles are rendered from a coarser level of an image pyramid.
+        
+        pyramid   -- callable: level -> StackedImageSources for the data downsampled 
+                     by a factor of 2**level (see ImagePump.pyramidLevel())
+        max_level -- the coarsest level to use (0 disables the level-of-detail mode)
+        """
+        self._pyramid = pyramid
+        self._maxLevel = max_level if pyramid is not None else 0
+        self._levelProviders = {}
+        self._splitCacheMemory()
+
+    def levelForScale( self, scale ):
+        """
+        The pyramid level that provides (at least) one data pixel 
+        per screen pixel, when the scene is shown at the given scale.
+        """
+        if self._maxLevel == 0 or scale >= 1.0 or scale <= 0.0:
+            return 0
+        level = int(math.floor(math.log(1.0/scale, 2)))
+        # Don't go beyond the level at which the whole slice fits into a single tile.
+        while level > 0 and max(self.tiling.sliceShape) < self.tiling.blockSize * 2**(level-1):
+            level -= 1
+        return min(level, self._maxLevel)
+
+    def _levelProvider( self, level ):
+        """
+        The TileProvider for the given (coarser) level of the pyramid.
+        Each level has its own tiling and tile cache, which gets a share of
+        our memory budget, and uses our disk cache (the layers of the levels
+        are different ImageSources).
+        """
+        if level not in self._levelProviders:
+            tp = TileProvider( self.tiling.downsampled(2**level), self._pyramid(level),
+                               cache_size=self.cache_size,
+                               cache_memory_limit=self.cache_memory_limit,
+                               disk_cache=self._diskCache if self._diskCache is not None else False )
+            tp._level = level
+            tp.axesSwapped = self.axesSwapped
+            if self._viewport is not None:
+                tp.setViewport( self._viewport, self._focus )
+            tp.sceneRectChanged.connect( self.sceneRectChanged )
+            self._levelProviders[level] = tp
+            self._splitCacheMemory()
+        return self._levelProviders[level]
+
+    def getTiles( self, rectF, scale=1.0 ):
         '''Get tiles in rect and request a refresh.
 
         Returns tiles intersecting with rectF immediately and requests
@@ -511,7 +1210,18 @@ class TileProvider( QObject ):
         tiles may be already (partially) updated. If you want to wait
         until the rendering is fully complete, call join().
 
+        scale is the scale at which the scene is shown (screen pixels per 
+        scene pixel). If a pyramid is set (see setPyramid()), the tiles of 
+        the appropriate level are returned; their ids refer to the tiling 
+        of that level.
+
         '''
+        level = self.levelForScale(scale)
+        if level > 0:
+            return self._levelProvider(level).getTiles(rectF)
+        return self._getTiles(rectF)
+
+    def _getTiles( self, rectF ):
         self.requestRefresh( rectF )
         tile_nos = self.tiling.intersected( rectF )
         stack_id = self._current_stack_id
@@ -527,17 +1237,29 @@ class TileProvider( QObject ):
                 QRectF(self.tiling.imageRects[tile_no]),
                 progress)
 
-    def waitForTiles(self, rectF=QRectF()):
+    def waitForTiles(self, rectF=QRectF(), timeout=None):
         """
-        This function is for testing purposes only.
-        Block until all tiles intersecting the given rect are complete.
+        Block until all tiles intersecting the given rect are complete,
+        or until the timeout (in seconds) expired.
+        Returns whether the tiles are complete.
+
+        The waiting thread sleeps while layer tiles are being fetched, and
+        refreshes the tiles (i.e. blends the new layer tiles) whenever a
+        fetch is over.
         """
-        finished = False
-        while not finished:
-            finished = True
-            tiles = self.getTiles(rectF)
-            for tile in tiles:
-                finished &= tile.progress >= 1.0
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            finishedCount = self._fetchTracker.finishedCount
+            if all( tile.progress >= 1.0 for tile in self._getTiles(rectF) ):
+                return True
+            remaining = deadline - time.time() if deadline is not None else None
+            if remaining is not None and remaining <= 0:
+                return False
+            if self._fetchTracker.outstanding(self._current_stack_id) == 0:
+                # Nothing is being fetched (e.g. a layer wasn't ready), so
+                # there may be no notification: look again after a while.
+                remaining = min(remaining, 0.1) if remaining is not None else 0.1
+            self._fetchTracker.wait(finishedCount, remaining)
 
     def requestRefresh( self, rectF, stack_id=None, prefetch=False, layer_indexes=None ):
         '''Requests tiles to be refreshed.
@@ -548,10 +1270,11 @@ class TileProvider( QObject ):
         '''
         stack_id = stack_id or self._current_stack_id
         tile_nos = self.tiling.intersected( rectF )
+        refresh_time = time.time()
         for tile_no in tile_nos:
-            self._refreshTile( stack_id, tile_no, prefetch, layer_indexes )
+            self._refreshTile( stack_id, tile_no, prefetch, layer_indexes, refresh_time )
 
-    def prefetch( self, rectF, through, layer_indexes=None ):
+    def prefetch( self, rectF, through, layer_indexes=None, scale=1.0 ):
         '''Request fetching of tiles in advance.
 
         Returns immediately. Prefetch will commence after all regular
@@ -564,6 +1287,11 @@ class TileProvider( QObject ):
         if self.cache_size == 0:
             return
 
+        level = self.levelForScale(scale)
+        if level > 0:
+            self._levelProvider(level).prefetch(rectF, through, layer_indexes)
+            return
+
         stack_id = (self._current_stack_id[0], tuple(enumerate(through)))
         with self._cache:
             if stack_id not in self._cache:
@@ -572,7 +1300,7 @@ class TileProvider( QObject ):
 
         self.requestRefresh(rectF, stack_id, prefetch=True, layer_indexes=layer_indexes)
 
-    def _refreshTile( self, stack_id, tile_no, prefetch=False, layer_indexes=None ):
+    def _refreshTile( self, stack_id, tile_no, prefetch=False, layer_indexes=None, refresh_time=None ):
         """
         Trigger a refresh of a particular tile.
         
@@ -600,11 +1328,13 @@ class TileProvider( QObject ):
         
         if not self.axesSwapped:
             # Who came up with this transform?
-            transform = QTransform(0,1,0,
-                                   1,0,0,
-                                   1,1,1)
+            transform = QTransform(LAYER_IMAGE_TRANSFORM)
         else:
             transform = QTransform().rotate(90).scale(1,-1)
+        if self.tiling.downsample != 1:
+            # The layer images stay in (downsampled) data resolution,
+            # they are only scaled up when they are drawn.
+            transform *= QTransform.fromScale(1.0/self.tiling.downsample, 1.0/self.tiling.downsample)
         transform *= self.tiling.data2scene
 
         try:
@@ -618,11 +1348,7 @@ class TileProvider( QObject ):
 
                 # Blend all (available) layers into the composite tile
                 # and store it in the tile cache.
-                tile_img = self._blendTile( stack_id, tile_no )
-                with self._cache:
-                    self._cache.setTile(stack_id, tile_no, tile_img,
-                                        self._sims.viewVisible(),
-                                        self._sims.viewOccluded())
+                self._updateTile( stack_id, tile_no )
 
             # refresh dirty layer tiles
             need_reblend = False
@@ -636,6 +1362,11 @@ class TileProvider( QObject ):
                          self._sims.isVisible(ims) ):
                     continue
 
+                if not (ims.direct and not prefetch) and \
+                        self._attachToPendingFetch( stack_id, tile_no, ims, prefetch ):
+                    # This layer tile is already being fetched.
+                    continue
+
                 rect = self.tiling.imageRects[tile_no]
                 dataRect = self.tiling.scene2data.mapRect(rect)
 
@@ -651,58 +1382,125 @@ class TileProvider( QObject ):
                     continue
 
                 timestamp = time.time()
-                fetch_fn = partial( self._fetch_tile_layer, timestamp, ims, transform, tile_no, stack_id, ims_req, self._cache )
 
                 if ims.direct and not prefetch:
                     # The ImageSource 'ims' is fast (it has the direct flag set to true),
                     # so we process the request synchronously here.
                     # This improves the responsiveness for layers that have the data readily available.
-                    fetch_fn()
+                    self._fetch_tile_layer( timestamp, ims, transform, tile_no, stack_id, ims_req, self._cache )
                     need_reblend = True
                 else:
+                    fetch = _TileFetch( ims_req, prefetch, partial(self._fetchTracker.finished, stack_id) )
+                    self._fetchTracker.started(stack_id)
+                    fetch.fn = partial( self._fetch_tile_layer, timestamp, ims, transform, tile_no, stack_id, ims_req, self._cache, fetch )
+                    with self._pendingFetchesLock:
+                        self._pendingFetches[stack_id][(tile_no, ims)] = fetch
+
                     # Tasks with 'smaller' priority values are processed first.
                     # We want non-prefetch tasks to take priority (False < True)
                     # and then more recent tasks to take priority (more recent -> process first)
-                    priority = (prefetch, -timestamp)
-                    submit_to_threadpool( fetch_fn, priority )
+                    # and then, within a refresh, the tiles closest to the focus of the view.
+                    priority = (prefetch, -(refresh_time or timestamp), self._tilePriority(tile_no))
+                    fetch.task = submit_to_threadpool( fetch.fn, priority, ims )
                     
 
             if need_reblend:
                 # We synchronously fetched at least one direct layer.
                 # We can immediately re-blend the composite tile.
-                tile_img = self._blendTile( stack_id, tile_no )
-                with self._cache:
-                    self._cache.setTile(stack_id, tile_no,
-                                        tile_img, self._sims.viewVisible(),
-                                        self._sims.viewOccluded() )
+                self._updateTile( stack_id, tile_no )
         except KeyError:
             pass
 
+    def _attachToPendingFetch( self, stack_id, tile_no, ims, prefetch ):
+        """
+        If the given layer tile is already being fetched, don't submit 
+        a duplicate request, but let the caller share the pending one.
+        A pending prefetch is promoted to the priority of a regular refresh,
+        if it didn't start yet.
+
+        Returns True if the request was coalesced with a pending one.
+        """
+        with self._pendingFetchesLock:
+            pending = self._pendingFetches.get(stack_id)
+            fetch = pending.get((tile_no, ims)) if pending else None
+        if fetch is None or fetch.cancelled:
+            return False
+
+        if fetch.prefetch and not prefetch:
+            fetch.prefetch = False
+            # Lazyflow requests can't be re-prioritized without cancelling them.
+            if not USE_LAZYFLOW_THREADPOOL and fetch.task is not None and fetch.task.cancel():
+                fetch.task = submit_to_threadpool( fetch.fn, (False, -time.time(), self._tilePriority(tile_no)), ims )
+
+        self._coalesced_requests += 1
+        return True
+
+    def _updateTile( self, stack_id, tile_nr ):
+        """
+        Bring the composite tile specified by (stack_id, tile_nr) up-to-date.
+
+        The QGraphicsItem layers are always synchronized with the stack,
+        but the QImage layers are only re-blended if one of them has changed
+        since the last blend.  Otherwise, only the progress of the tile is updated.
+        """
+        with self._cache:
+            raster_dirty = self._cache.tileRasterDirty(stack_id, tile_nr)
+            self._cache.setTileRasterDirty(stack_id, tile_nr, False)
+
+        self._updateGraphicsItems( stack_id, tile_nr )
+
+        if raster_dirty:
+            with metrics.timer('tileprovider.blend'):
+                tile_img = self._blendTile( stack_id, tile_nr )
+            with self._cache:
+                self._cache.setTile(stack_id, tile_nr, tile_img,
+                                    self._sims.viewVisible(),
+                                    self._sims.viewOccluded())
+        else:
+            self._skipped_blends += 1
+            with self._cache:
+                self._cache.updateTileProgress(stack_id, tile_nr,
+                                               self._sims.viewVisible(),
+                                               self._sims.viewOccluded())
+
+    def _updateGraphicsItems( self, stack_id, tile_nr ):
+        """
+        Update the opacity, visibility and z-order of the QGraphicsItem
+        layers of the patch specified by (stack_id, tile_nr).
+        """
+        for i, (visible, layerOpacity, layerImageSource) in enumerate(reversed(self._sims)):
+            image_type = layerImageSource.image_type()
+            if not issubclass(image_type, QGraphicsItem):
+                continue
+            with self._cache:
+                patch = self._cache.layer(stack_id, layerImageSource, tile_nr )
+            if patch is not None:
+                assert isinstance(patch, image_type), \
+                    "This ImageSource is producing a type of image that is not consistent with it's declared image_type()"
+                # This is a QGraphicsItem, so we don't blend it into the final tile.
+                # (The ImageScene will just draw it on top of everything.)
+                if patch.opacity() != layerOpacity or patch.isVisible() != visible:
+                    patch.setOpacity(layerOpacity)
+                    patch.setVisible(visible)
+                patch.setZValue(i)  # The sims ("stacked image sources") are ordered from 
+                                    # top-to-bottom (see imagepump.py), but in Qt,
+                                    # higher Z-values are shown on top.
+                                    # Note that the current loop is iterating in reverse order.
+
     def _blendTile( self, stack_id, tile_nr): 
         """
         Blend all of the QImage layers of the patch
         specified by (stack_id, tile_nr) into a single QImage.
+
+        The blend of the layers below the lowest changed layer is kept
+        in the cache, so that the next change to an upper layer (e.g. 
+        while painting labels) only re-blends the layers above it.
         """
-        qimg = None
-        p = None
-        for i, (visible, layerOpacity, layerImageSource) in enumerate(reversed(self._sims)):
-            image_type = layerImageSource.image_type()
-            if issubclass(image_type, QGraphicsItem):
-                with self._cache:
-                    patch = self._cache.layer(stack_id, layerImageSource, tile_nr )
-                if patch is not None:
-                    assert isinstance(patch, image_type), \
-                        "This ImageSource is producing a type of image that is not consistent with it's declared image_type()"
-                    # This is a QGraphicsItem, so we don't blend it into the final tile.
-                    # (The ImageScene will just draw it on top of everything.)
-                    # But this is a convenient place to update the opacity/visible state.
-                    if patch.opacity() != layerOpacity or patch.isVisible() != visible:
-                        patch.setOpacity(layerOpacity)
-                        patch.setVisible(visible)
-                    patch.setZValue(i)  # The sims ("stacked image sources") are ordered from 
-                                        # top-to-bottom (see imagepump.py), but in Qt,
-                                        # higher Z-values are shown on top.
-                                        # Note that the current loop is iterating in reverse order.
+        # Collect the (available) visible layer patches, from bottom to top.
+        patches = []
+        for visible, layerOpacity, layerImageSource in reversed(self._sims):
+            if issubclass(layerImageSource.image_type(), QGraphicsItem):
+                # Handled in _updateGraphicsItems()
                 continue
 
             # No need to fetch non-visible image tiles.
@@ -711,27 +1509,55 @@ class TileProvider( QObject ):
 
             with self._cache:
                 patch = self._cache.layer(stack_id, layerImageSource, tile_nr )
-            
-            # patch might be a QGraphicsItem instead of QImage,
-            # in which case it is handled separately,
-            # not composited into the tile.
 
             if patch is not None:
                 assert isinstance(patch, QImage), \
                     "Unknown tile layer type: {}. Expected QImage or QGraphicsItem".format(type(patch))
-                if qimg is None:
-                    qimg = QImage(self.tiling.imageRects[tile_nr].size(), QImage.Format_ARGB32_Premultiplied)
-                    qimg.fill(0xffffffff) # Use a hex constant instead.
-                    p = QPainter(qimg)
-                p.setOpacity(layerOpacity)
-                p.drawImage(0,0, patch)
-        
-        if p is not None:
-            p.end()
+                patches.append( (patch, layerOpacity) )
 
-        return qimg
+        if not patches:
+            return None
+
+        with self._cache:
+            prefix = self._cache.tilePrefix(stack_id, tile_nr)
+
+        # Find the lowest layer that changed since the last blend,
+        # and reuse the old partial composite if it lies below that layer.
+        first_changed = 0
+        reuse_len, reuse_img = 0, None
+        if prefix is not None:
+            old_patches, old_prefix_len, old_prefix_img = prefix
+            for (patch, opacity), (old_patch, old_opacity) in zip(patches, old_patches):
+                if patch is not old_patch or opacity != old_opacity:
+                    break
+                first_changed += 1
+            if old_prefix_len <= first_changed:
+                reuse_len, reuse_img = old_prefix_len, old_prefix_img
+
+        # The topmost layer is never part of the prefix.
+        prefix_len = min(first_changed, len(patches)-1)
+        if reuse_len > prefix_len:
+            reuse_len, reuse_img = 0, None
+
+        if prefix_len == reuse_len:
+            prefix_img = reuse_img
+        else:
+            prefix_img = self._paintPatches( tile_nr, reuse_img, patches[reuse_len:prefix_len] )
+        self._reused_blend_layers += reuse_len
+
+        with self._cache:
+            self._cache.setTilePrefix(stack_id, tile_nr, patches, prefix_len, prefix_img)
+
+        return self._paintPatches( tile_nr, prefix_img, patches[prefix_len:] )
+
+    def _paintPatches( self, tile_nr, base_img, patches ):
+        """
+        Paint the given (QImage, opacity) patches over a copy of base_img
+        (or over a new white tile, if base_img is None).
+        """
+        return paint_patches( self.tiling.imageSize(tile_nr), base_img, patches )
 
-    def _fetch_tile_layer(self, timestamp, ims, transform, tile_nr, stack_id, ims_req, cache):
+    def _fetch_tile_layer(self, timestamp, ims, transform, tile_nr, stack_id, ims_req, cache, fetch=None):
         """
         Fetch a single tile from a layer (ImageSource).
         
@@ -753,7 +1579,13 @@ class TileProvider( QObject ):
         cache
             The value of self._cache at the time the ims_req was created.
             (The cache can be replaced occasionally. See TileProvider._onSizeChanged().)
+        fetch
+            The _TileFetch handle of this request, if it was submitted to the render pool.
         """
+        if fetch is not None:
+            if fetch.cancelled:
+                return
+            metrics.observe('renderpool.queue_wait', 1000.0*(time.time() - timestamp))
         try:
             try:
                 with cache:
@@ -765,18 +1597,28 @@ class TileProvider( QObject ):
             tile_rect = QRectF( self.tiling.imageRects[tile_nr] )
 
             if timestamp > layerTimestamp:
-                img = ims_req.wait()
-                if isinstance(img, QImage):
-                    img = img.transformed(transform)
-                elif isinstance(img, QGraphicsItem):
-                    # FIXME: It *seems* like applying the same transform to QImages and QGraphicsItems
-                    #        makes sense here, but for some strange reason it isn't right.
-                    #        For QGraphicsItems, it seems obvious that this is the correct transform.
-                    #        I do not understand the formula that produces 'transform', which is used for QImage tiles.
-                    img.setTransform(QTransform.fromTranslate(tile_rect.left(), tile_rect.top()), combine=True)
-                    img.setTransform(self.tiling.data2scene, combine=True)
-                else:
-                    assert False, "Unexpected image type: {}".format( type(img) )
+                # Layer tiles that were evicted from memory can be read back
+                # from the disk cache (already transformed).
+                img = None
+                if self._diskCache is not None and not ims.direct:
+                    img = self._diskCache.get(ims, stack_id, tile_nr)
+                if img is None:
+                    # Only now (in the render pool, within the limits of the layer)
+                    # start the request, e.g. all channels of an RGBA layer at once.
+                    if hasattr(ims_req, 'submit'):
+                        ims_req.submit()
+                    img = ims_req.wait()
+                    if isinstance(img, QImage):
+                        img = img.transformed(transform)
+                    elif isinstance(img, QGraphicsItem):
+                        # FIXME: It *seems* like applying the same transform to QImages and QGraphicsItems
+                        #        makes sense here, but for some strange reason it isn't right.
+                        #        For QGraphicsItems, it seems obvious that this is the correct transform.
+                        #        I do not understand the formula that produces 'transform', which is used for QImage tiles.
+                        img.setTransform(QTransform.fromTranslate(tile_rect.left(), tile_rect.top()), combine=True)
+                        img.setTransform(self.tiling.data2scene, combine=True)
+                    else:
+                        assert False, "Unexpected image type: {}".format( type(img) )
 
                 with cache:
                     try:
@@ -788,7 +1630,48 @@ class TileProvider( QObject ):
                         and cache is self._cache:
                     self.sceneRectChanged.emit( tile_rect )
         except BaseException:
-            sys.excepthook( *sys.exc_info() )
+            # A cancelled image request may fail in any way; nobody is waiting for it.
+            if fetch is None or not fetch.cancelled:
+                sys.excepthook( *sys.exc_info() )
+        finally:
+            if fetch is not None:
+                with self._pendingFetchesLock:
+                    pending = self._pendingFetches.get(stack_id)
+                    if pending is not None and pending.get((tile_nr, ims)) is fetch:
+                        del pending[(tile_nr, ims)]
+                fetch.finish()
+
+    def _forgetPendingFetches(self, ims, tile_nos=None):
+        """
+        Called when the given layer became dirty: the pending fetches of 
+        its tiles (all tiles, if tile_nos is None) will deliver outdated data, 
+        so new requests must not be coalesced with them.
+        """
+        with self._pendingFetchesLock:
+            for pending in self._pendingFetches.itervalues():
+                if tile_nos is None:
+                    keys = [key for key in pending if key[1] is ims]
+                else:
+                    keys = [(tile_no, ims) for tile_no in tile_nos]
+                for key in keys:
+                    pending.pop(key, None)
+
+    def _cancelPendingFetches(self, stack_id):
+        """
+        Cancel all layer tile requests of the given stack that didn't finish yet.
+        Their tiles are marked dirty again, so they will be requested 
+        anew if the stack is shown again.
+        """
+        with self._pendingFetchesLock:
+            fetches = self._pendingFetches.pop(stack_id, {})
+        for fetch in fetches.itervalues():
+            fetch.cancel()
+        self._cancelled_requests += len(fetches)
+
+        with self._cache:
+            if stack_id in self._cache:
+                for tile_no, ims in fetches:
+                    self._cache.setTileDirty(stack_id, tile_no, True)
 
 
     
@@ -826,14 +1709,23 @@ class TileProvider( QObject ):
             # Everything is dirty.
             # This is a FAST PATH for quickly setting all tiles dirty.
             # (It makes a HUGE difference for very large tiling scenes.)
+            self._forgetPendingFetches(dirtyImgSrc)
+            if self._diskCache is not None:
+                self._diskCache.invalidate(dirtyImgSrc)
             with self._cache:
                 self._cache.setLayerDirtyAllTiles(dirtyImgSrc)
                 if visibleAndNotOccluded:
-                    self._cache.setAllTilesDirty()
+                    # The composite tiles are only re-blended once 
+                    # the new layer images have actually arrived.
+                    self._cache.setAllTilesDirty(raster=False)
         else:
             # Slow path: Mark intersecting tiles as dirty.
+            tile_nos = self.tiling.intersected(sceneRect)
+            self._forgetPendingFetches(dirtyImgSrc, tile_nos)
+            if self._diskCache is not None:
+                self._diskCache.invalidate(dirtyImgSrc, tile_nos)
             with self._cache:
-                for tile_no in self.tiling.intersected(sceneRect):
+                for tile_no in tile_nos:
                     self._cache.setLayerDirtyAllStacks(dirtyImgSrc, tile_no, True)
                     if visibleAndNotOccluded:
                         self._cache.setTileDirtyAllStacks(tile_no, True)
@@ -854,6 +1746,9 @@ class TileProvider( QObject ):
             else:
                 self._cache.addStack( newId )
         self._current_stack_id = newId
+
+        # Nobody is waiting for the tiles of the old plane anymore.
+        self._cancelPendingFetches( oldId )
         self.sceneRectChanged.emit(QRectF())
 
     def _onVisibleChanged(self, ims, visible):
@@ -863,6 +1758,7 @@ class TileProvider( QObject ):
         """
         with self._cache:
             self._cache.setAllTilesDirty()
+            self._cache.clearTilePrefixes()
         if not self._sims.isOccluded( ims ):
             self.sceneRectChanged.emit(QRectF())
 
@@ -873,6 +1769,7 @@ class TileProvider( QObject ):
         """
         with self._cache:
             self._cache.setAllTilesDirty()
+            self._cache.clearTilePrefixes()
         if self._sims.isVisible( ims ) and not self._sims.isOccluded( ims ):
             self.sceneRectChanged.emit(QRectF())
 
@@ -881,10 +1778,44 @@ class TileProvider( QObject ):
         Called when the StackedImageSources object we depend on has changed it's size.
         This is rare, but it means that the entire tile cache is obsolete.
         """
+        # The pending fetches deliver into the old cache, so new requests
+        # must not be coalesced with them.
+        with self._pendingFetchesLock:
+            pending = self._pendingFetches
+            self._pendingFetches = defaultdict(dict)
+        for fetches in pending.itervalues():
+            for fetch in fetches.itervalues():
+                fetch.cancel()
+            self._cancelled_requests += len(fetches)
+
+        old_cache = self._cache
         self._cache = _TilesCache(self._current_stack_id, self._sims,
-                                  maxstacks=self.cache_size)
+                                  maxstacks=self.cache_size,
+                                  maxbytes=old_cache.maxbytes,
+                                  diskCache=self._diskCache)
+        self._cache.hits = old_cache.hits
+        self._cache.misses = old_cache.misses
+        self._checkDiskCacheGeometry()
+
+        # The pyramid levels follow the geometry of our tiling.
+        for level, tp in self._levelProviders.iteritems():
+            tp.tiling.data2scene = QTransform.fromScale(2**level, 2**level) * self.tiling.data2scene
+            tp._onSizeChanged()
         self.sceneRectChanged.emit(QRectF())
 
+    def _checkDiskCacheGeometry(self):
+        """
+        The layer tiles in the disk cache are already transformed into the scene,
+        so they become obsolete when the scene is rotated or its axes are swapped.
+        (The levels of the pyramid leave that to the provider of level 0.)
+        """
+        if self._diskCache is None or self._level > 0:
+            return
+        geometry = (self.axesSwapped, QTransform(self.tiling.data2scene))
+        if geometry != self._diskCacheGeometry:
+            self._diskCacheGeometry = geometry
+            self._diskCache.clear()
+
     def _onOrderChanged(self):
         """
         Called when the order of ImageSource objects the StackedImageSources
@@ -892,4 +1823,5 @@ class TileProvider( QObject ):
         """
         with self._cache:
             self._cache.setAllTilesDirty()
+            self._cache.clearTilePrefixes()
         self.sceneRectChanged.emit(QRectF())
@@ -0,0 +1,134 @@
+###############################################################################
+#   volumina: volume slicing and editing library
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the Lesser GNU General Public License
+# as published by the Free Software Foundation; either version 2.1
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# See the files LICENSE.lgpl2 and LICENSE.lgpl3 for full text of the
+# GNU Lesser General Public License version 2.1 and 3 respectively.
+# This information is also available on the ilastik web site at:
+#		   http://ilastik.org/license/
+###############################################################################
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# Upper bounds of the histogram buckets (the last bucket is unbounded)
+MSEC_BOUNDS = (0.1, 0.3, 1, 3, 10, 30, 100, 300, 1000, 3000)
+COUNT_BOUNDS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+
+class Histogram( object ):
+    """
+    Distribution of the observed values of a metric (e.g. durations in msec).
+    """
+    def __init__(self, bounds=MSEC_BOUNDS):
+        self.bounds = tuple(bounds)
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def snapshot(self):
+        return { 'count'   : self.count,
+                 'total'   : self.total,
+                 'mean'    : self.mean,
+                 'min'     : self.min,
+                 'max'     : self.max,
+                 'bounds'  : list(self.bounds),
+                 'buckets' : list(self.buckets) }
+
+class PipelineMetrics( object ):
+    """
+    Counters and histograms of the pixel pipeline, which are cheap enough
+    to be collected all the time (unlike the DEBUG log output).
+
+    Metrics are created when they are first used, e.g.
+
+        metrics.increment('tilecache.hits')
+        with metrics.timer('tileprovider.blend'):
+            ...
+
+    Durations are measured in msec.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def increment(self, name, n=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def observe(self, name, value, bounds=MSEC_BOUNDS):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram(bounds)
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, 1000.0*(time.time() - start))
+
+    def counter(self, name):
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def histogram(self, name):
+        """
+        A snapshot (dict) of the given histogram, or None if nothing was observed yet.
+        """
+        with self._lock:
+            histogram = self._histograms.get(name)
+            return histogram.snapshot() if histogram is not None else None
+
+    def snapshot(self):
+        with self._lock:
+            return { 'counters'   : dict(self._counters),
+                     'histograms' : dict( (name, h.snapshot()) for name, h in self._histograms.iteritems() ) }
+
+    def toJSON(self, **kwargs):
+        return json.dumps( self.snapshot(), sort_keys=True, **kwargs )
+
+    def dump(self, path):
+        """
+        Write a snapshot of all metrics to the given file (as JSON).
+        """
+        with open(path, 'w') as f:
+            f.write( self.toJSON(indent=2) )
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+# The metrics of all views, image sources and tile providers
+metrics = PipelineMetrics()
@@ -1,15 +1,26 @@
 from concurrent.futures.thread import ThreadPoolExecutor, _WorkItem
-import concurrent.futures._base 
+import concurrent.futures._base
 import Queue
+import heapq
+import os
+import time
+import multiprocessing
+from collections import defaultdict
+
+from pipelineMetrics import metrics
 
 class PrioritizedTask(_WorkItem):
     """
     A task object that executes requests for layer data (i.e. from ImageSource objects).
     Used by the global renderer_pool (a thread pool).
     """
-    def __init__(self, fut, func, priority):
+    def __init__(self, fut, func, priority, group=None, limit=None):
         super(PrioritizedTask, self).__init__(fut, func, [], {})
         self.priority = priority
+        self.group = group
+        self.limit = limit
+        self.submitted = time.time()
+        self._queue = None
 
     def __lt__(self, other):
         """
@@ -20,33 +31,204 @@ class PrioritizedTask(_WorkItem):
             "Can't compare {} with {}".format( type(self), type(other) )
         return self.priority < other.priority
 
+    def run(self):
+        try:
+            super(PrioritizedTask, self).run()
+        finally:
+            if self._queue is not None:
+                self._queue.taskFinished(self)
+
+class WorkerLimitTuner(object):
+    """
+    Adjusts the number of workers of a PrioritizedThreadPoolExecutor from
+    the observed queue latency (the time from submit() until a worker starts
+    the task) and the CPU utilization of the process: workers are added while
+    tasks wait although the CPUs are idle (i.e. the workers wait for I/O),
+    and removed while the CPUs are saturated.
+    """
+    def __init__(self, min_workers, max_workers, interval=1.0, target_latency=0.05,
+                 clock=time.time, cpu_time=None, n_cpus=None):
+        """
+        interval       -- seconds between adjustments
+        target_latency -- queue latency (seconds) above which workers are added
+        clock          -- wall time function
+        cpu_time       -- CPU time (user + system) of the process (default: from os.times())
+        n_cpus         -- number of CPUs (default: multiprocessing.cpu_count())
+        """
+        assert 1 <= min_workers <= max_workers
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.interval = interval
+        self.target_latency = target_latency
+        self._clock = clock
+        self._cpu_time = cpu_time or (lambda: sum(os.times()[:2]))
+        self._n_cpus = n_cpus or multiprocessing.cpu_count()
+        self._last = (self._clock(), self._cpu_time())
+        self._latency = 0.0
+        self._count = 0
+
+    def observe(self, latency):
+        self._latency += latency
+        self._count += 1
+
+    def update(self, limit):
+        """
+        Return the new worker limit, given the current one.
+        """
+        now, cpu = self._clock(), self._cpu_time()
+        elapsed = now - self._last[0]
+        if elapsed < self.interval:
+            return limit
+        utilization = (cpu - self._last[1]) / (elapsed * self._n_cpus)
+        latency = self._latency / self._count if self._count else 0.0
+        self._last = (now, cpu)
+        self._latency = 0.0
+        self._count = 0
+
+        if utilization > 0.9 and limit > max(self.min_workers, self._n_cpus):
+            # More threads only compete for the CPUs.
+            limit -= 1
+        elif utilization < 0.75 and latency > self.target_latency and limit < self.max_workers:
+            limit += 1
+        return max(self.min_workers, min(limit, self.max_workers))
+
+class _FairPriorityQueue(Queue.Queue):
+    """
+    The work queue of the PrioritizedThreadPoolExecutor.
+
+    Tasks are handed out by priority, but at most 'limit' at the same time
+    (the other workers wait), and at most a given number of tasks of the
+    same group (e.g. ImageSource) at the same time, so that a slow layer
+    cannot occupy all workers.  Among tasks of equal priority, the group
+    with fewer running tasks goes first.
+    """
+    def __init__(self, limit, max_per_group=None, tuner=None):
+        Queue.Queue.__init__(self)
+        self.limit = limit
+        self.max_per_group = max_per_group
+        self._tuner = tuner
+
+    def _init(self, maxsize):
+        self._groups = {} # group -> heap of tasks
+        self._limits = {} # group -> maximal number of running tasks
+        self._running = defaultdict(int)
+        self._nrunning = 0
+        self._sentinels = 0
+
+    def _groupLimit(self, group):
+        n = self._limits.get(group)
+        if n is None:
+            n = self.max_per_group
+        if n is None or group is None:
+            return self.limit
+        if n <= 0:
+            n += self.limit
+        return max(1, n)
+
+    def _available(self):
+        if self._nrunning >= self.limit:
+            return []
+        return [ g for g, tasks in self._groups.iteritems()
+                 if self._running[g] < self._groupLimit(g) ]
+
+    def _qsize(self, len=len):
+        return self._sentinels + sum( len(self._groups[g]) for g in self._available() )
+
+    def _put(self, task):
+        if task is None:
+            # Tells a worker to exit
+            self._sentinels += 1
+            return
+        heapq.heappush( self._groups.setdefault(task.group, []), task )
+        if task.limit is not None:
+            self._limits[task.group] = task.limit
+
+    def _get(self):
+        if self._sentinels:
+            self._sentinels -= 1
+            return None
+        group = min( self._available(), key=lambda g: (self._groups[g][0].priority, self._running[g]) )
+        tasks = self._groups[group]
+        task = heapq.heappop(tasks)
+        if not tasks:
+            del self._groups[group]
+        self._running[group] += 1
+        self._nrunning += 1
+        task._queue = self
+
+        latency = time.time() - task.submitted
+        metrics.observe('renderpool.queue_latency', 1000.0*latency)
+        if self._tuner is not None:
+            self._tuner.observe(latency)
+            limit = self._tuner.update(self.limit)
+            if limit > self.limit:
+                self.not_empty.notify_all()
+            self.limit = limit
+        return task
+
+    def taskFinished(self, task):
+        with self.mutex:
+            self._running[task.group] -= 1
+            self._nrunning -= 1
+            if not self._running[task.group]:
+                del self._running[task.group]
+                if task.group not in self._groups:
+                    self._limits.pop(task.group, None)
+            self.not_empty.notify_all()
+
+    def setLimit(self, limit):
+        with self.mutex:
+            self.limit = limit
+            self.not_empty.notify_all()
+
 class PrioritizedThreadPoolExecutor(ThreadPoolExecutor):
     """
     The executor type for the render_pool
     (a thread pool for executing requests for layer data.)
-    
+
     Differences from base class (ThreadPoolExecutor):
-      - self._work_queue is a PriorityQueue, not a plain Queue.Queue
+      - self._work_queue is a _FairPriorityQueue, not a plain Queue.Queue
       - self.submit() creates a PrioritizedTask (which has a less-than operator
         and can therefore be prioritized), not a generic _WorkItem
+      - the number of concurrently running tasks can be changed, or tuned
+        automatically (see WorkerLimitTuner)
     """
-    def __init__(self, max_workers):
-        super(PrioritizedThreadPoolExecutor, self).__init__(max_workers)
-        self._work_queue = Queue.PriorityQueue()
+    def __init__(self, max_workers, max_per_group=None, tuner=None):
+        """
+        max_workers   -- the number of workers (initially, if a tuner is given)
+        max_per_group -- the maximal number of running tasks of the same group:
+                         None for no limit, or if <= 0, relative to the number
+                         of workers (e.g. -1 for all but one of them)
+        tuner         -- a WorkerLimitTuner
+        """
+        super(PrioritizedThreadPoolExecutor, self).__init__(tuner.max_workers if tuner else max_workers)
+        self._work_queue = _FairPriorityQueue(max_workers, max_per_group, tuner)
+
+    @property
+    def workerLimit(self):
+        """
+        The number of tasks that are run at the same time.
+        """
+        return self._work_queue.limit
 
-    def submit(self, func, priority):
+    def setWorkerLimit(self, n):
+        self._work_queue.setLimit( max(1, min(n, self._max_workers)) )
+
+    def submit(self, func, priority, group=None, limit=None):
         """
         Mostly copied from ThreadPoolExecutor.submit(), but here we replace '_WorkItem' with 'PrioritizedTask'.
         Also, we pass the 'prefetch' and 'timestamp' parameters.
+        group -- tasks of the same group (any hashable, e.g. an ImageSource)
+                 are limited to max_per_group running tasks
+        limit -- overrides max_per_group for the group of this task
         """
         with self._shutdown_lock:
             if self._shutdown:
                 raise RuntimeError('cannot schedule new futures after shutdown')
 
             fut = concurrent.futures._base.Future()
-            w = PrioritizedTask(fut, func, priority)
+            w = PrioritizedTask(fut, func, priority, group, limit)
 
             self._work_queue.put(w)
             self._adjust_thread_count()
             return fut
-
@@ -32,6 +32,7 @@ from PyQt4.QtGui import QApplication, QWidget
 
 #volumina
 import volumina.pixelpipeline.imagepump
+from volumina.pixelpipeline.conversionPool import startConversionPool
 from eventswitch import EventSwitch
 from imageScene2D import ImageScene2D
 from imageView2D import ImageView2D
@@ -151,6 +152,10 @@ class VolumeEditor( QObject ):
         super(VolumeEditor, self).__init__(parent=parent)
         self._sync_along = tuple(syncAlongAxes)
 
+        # Fork the conversion processes (if enabled) before the scenes
+        # start any threads.
+        startConversionPool()
+
         ##
         ## properties
         ##
@@ -186,6 +191,7 @@ class VolumeEditor( QObject ):
         for scene, name, pump in zip(self.imageScenes, names, self.imagepumps):
             scene.setObjectName(name)
             scene.stackedImageSources = pump.stackedImageSources
+            scene.setPyramid(lambda level, pump=pump: pump.pyramidLevel(level).stackedImageSources)
 
         self.cacheSize = 50
 
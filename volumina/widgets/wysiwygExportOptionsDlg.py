@@ -38,6 +38,8 @@ else:
 
 from volumina.widgets.multiStepProgressDialog import MultiStepProgressDialog
 from volumina.utility import PreferencesManager
+from volumina.slicingtools import SliceProjection
+from volumina.offscreenRenderer import OffscreenRenderer
 
 class WysiwygExportOptionsDlg(QDialog):
     TOO_MANY_PLACEHOLDER = "File pattern invalid! Pattern may not contain placeholder '{0}'. Use '{{{{{0}}}}}' instead."
@@ -318,6 +320,8 @@ class WysiwygExportHelper(MultiStepProgressDialog):
         
         self.exportloop = None
         self.timer = None
+        self.renderer = None
+        self.painter = None
         
         # connect signals
         self.buttonBox.button(QDialogButtonBox.Cancel).clicked.connect(self.cancel)
@@ -366,10 +370,24 @@ class WysiwygExportHelper(MultiStepProgressDialog):
         else:            
             self.view._sliceIntersectionMarker.setVisible(False)
 
-        # create plain image and painter
-        self.img = QImage(w, h, QImage.Format_RGB16)
-        self.img.fill(Qt.black)
-        self.painter = QPainter(self.img)
+        if not show_markers:
+            # Render the frames in the background, without moving the view.
+            projection = SliceProjection( abscissa=slice_axes[0], ordinate=slice_axes[1],
+                                          along=list(self.dlg.along) )
+            self.renderer = OffscreenRenderer( self.view.scene()._stackedImageSources._layerStackModel,
+                                               projection )
+            if self.renderer.hasItemLayers():
+                # Layers of QGraphicsItems (e.g. segmentation edges) are only
+                # rendered by the scene.
+                self.renderer.shutdown()
+                self.renderer = None
+
+        if self.renderer is None:
+            # The view itself is moved to each position and rendered
+            # (e.g. to include the markers, which are part of the view).
+            self.img = QImage(w, h, QImage.Format_RGB16)
+            self.img.fill(Qt.black)
+            self.painter = QPainter(self.img)
                         
         # prepare export loop
         self.exportloop = self.loopGenerator(rect, pos, start, stop, iter_axes, 
@@ -384,13 +402,19 @@ class WysiwygExportHelper(MultiStepProgressDialog):
         steps = reduce(mul, map(len, ranges), 1.0)
 
         getter = itemgetter(*iter_axes if iter_axes else [slice(0)])
-        file_names = []
-        for i, pos in enumerate(product(*ranges)):
-            coords = getter(pos)
-            file_names.append(self._filename(folder, pattern, fileExt, iter_coords, coords, padding))
-            self._saveImg(pos, rect, file_names[-1])
-            self.setStepProgress(100 * i / steps)
-            yield
+        positions = list(product(*ranges))
+        file_names = [self._filename(folder, pattern, fileExt, iter_coords, getter(pos), padding)
+                      for pos in positions]
+        if self.renderer is not None:
+            frames = [(pos, rect.toRect(), fname) for pos, fname in zip(positions, file_names)]
+            for written in self.renderer.exportSteps(frames, timeout=0.05, format=QImage.Format_RGB16):
+                self.setStepProgress(100 * written / steps)
+                yield
+        else:
+            for i, (pos, fname) in enumerate(zip(positions, file_names)):
+                self._saveImg(pos, rect, fname)
+                self.setStepProgress(100 * i / steps)
+                yield
         self.setStepProgress(100)
         self.finishStep()
 
@@ -440,7 +464,14 @@ class WysiwygExportHelper(MultiStepProgressDialog):
         self.buttonBox.button(QDialogButtonBox.Ok).setEnabled(True)
         
         # close painter
-        self.painter.end()
+        if self.painter is not None:
+            self.painter.end()
+            self.painter = None
+
+        # stop rendering in the background
+        if self.renderer is not None:
+            self.renderer.shutdown()
+            self.renderer = None
         
         # reset viewer position
         self._setPos5D(self.currentPos5D)